@@ -24,17 +24,20 @@
 import asyncio
 import threading
 import asyncio
+import bisect
 import itertools
-from collections import defaultdict
-from typing import TYPE_CHECKING, Dict, Optional, Set, Tuple, NamedTuple, Sequence, List
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+from typing import (TYPE_CHECKING, Dict, Optional, Set, Tuple, NamedTuple, Sequence, List,
+                    Iterable, Callable, Any)
 
 from aiorpcx import TaskGroup
 
 from . import bitcoin, util
 from .bitcoin import COINBASE_MATURITY
-from .util import profiler, bfh, TxMinedInfo, UnrelatedTransactionException, with_lock
+from .util import profiler, bfh, TxMinedInfo, UnrelatedTransactionException
 from .transaction import Transaction, TxOutput, TxInput, PartialTxInput, TxOutpoint, PartialTransaction
-from .synchronizer import Synchronizer
+from .synchronizer import Synchronizer, history_status
 from .verifier import SPV
 from .blockchain import hash_header
 from .i18n import _
@@ -50,6 +53,9 @@ TX_HEIGHT_LOCAL = -2
 TX_HEIGHT_UNCONF_PARENT = -1
 TX_HEIGHT_UNCONFIRMED = 0
 
+# max number of whole-wallet query results kept for readers that do not wait for the locks
+SNAPSHOT_CACHE_SIZE = 16
+
 
 class HistoryItem(NamedTuple):
     txid: str
@@ -67,6 +73,70 @@ class TxWalletDelta(NamedTuple):
     fee: Optional[int]
 
 
+class HistoryIndex:
+    """The history of the whole wallet, ordered by txpos, with running balances.
+
+    Entries are (re)placed with bisect as transactions get added, removed or
+    (un)verified, and running balances are only recomputed from the first
+    position that changed. As new transactions usually go at the end, reading
+    the history, or a page of it, does not touch the rest of the wallet.
+    """
+
+    def __init__(self):
+        self._keys = []  # type: List[Tuple[Tuple[float, int], str]]  # sorted (txpos, txid)
+        self._key_by_txid = {}  # type: Dict[str, Tuple[Tuple[float, int], str]]
+        self._deltas = {}  # type: Dict[str, int]
+        self._balances = []  # type: List[int]  # running balance after each entry
+        self._first_stale = 0  # balances from this position on need to be recomputed
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, txid: str):
+        return txid in self._key_by_txid
+
+    def update(self, txid: str, txpos: Tuple[float, int], delta: int) -> None:
+        key = (txpos, txid)
+        old_key = self._key_by_txid.get(txid)
+        if old_key == key and self._deltas[txid] == delta:
+            return
+        if old_key is not None:
+            self._remove_key(old_key)
+        i = bisect.bisect_left(self._keys, key)
+        self._keys.insert(i, key)
+        self._key_by_txid[txid] = key
+        self._deltas[txid] = delta
+        self._first_stale = min(self._first_stale, i)
+
+    def remove(self, txid: str) -> None:
+        key = self._key_by_txid.pop(txid, None)
+        if key is None:
+            return
+        self._remove_key(key)
+        del self._deltas[txid]
+
+    def _remove_key(self, key) -> None:
+        i = bisect.bisect_left(self._keys, key)
+        assert self._keys[i] == key
+        del self._keys[i]
+        self._first_stale = min(self._first_stale, i)
+
+    def _update_balances(self) -> None:
+        i = min(self._first_stale, len(self._keys))
+        del self._balances[i:]
+        balance = self._balances[-1] if self._balances else 0
+        for _, txid in itertools.islice(self._keys, i, None):
+            balance += self._deltas[txid]
+            self._balances.append(balance)
+        self._first_stale = len(self._keys)
+
+    def get_items(self, start: int = None, stop: int = None) -> List[Tuple[str, int, int]]:
+        """Returns (txid, delta, balance) of entries [start:stop], oldest first."""
+        self._update_balances()
+        return [(txid, self._deltas[txid], balance)
+                for (_, txid), balance in zip(self._keys[start:stop], self._balances[start:stop])]
+
+
 class AddressSynchronizer(Logger):
     """
     inherited by wallet
@@ -93,11 +163,32 @@ class AddressSynchronizer(Logger):
         self.up_to_date = False
         # thread local storage for caching stuff
         self.threadlocal_cache = threading.local()
-
-        self._get_addr_balance_cache = {}
+        # results of the last whole-wallet queries, see _read_snapshot
+        self._snapshots = OrderedDict()  # type: OrderedDict[Tuple, Tuple[int, int, Any]]
+        # bumped when a write section starts and when it ends (odd while one is
+        # in progress), see _write_section
+        self._state_version = 0
+        self._write_depth = 0
 
         self.load_and_cleanup()
 
+    @contextmanager
+    def _write_section(self):
+        """Changes to the wallet history and balances are made in here, with self.lock held.
+        Until the outermost section is over, readers can still be served the snapshots
+        taken before it started, see _read_snapshot.
+        """
+        with self.lock:
+            self._write_depth += 1
+            if self._write_depth == 1:
+                self._state_version += 1
+            try:
+                yield
+            finally:
+                self._write_depth -= 1
+                if self._write_depth == 0:
+                    self._state_version += 1
+
     def with_transaction_lock(func):
         def func_wrapper(self: 'AddressSynchronizer', *args, **kwargs):
             with self.transaction_lock:
@@ -134,6 +225,19 @@ class AddressSynchronizer(Logger):
                 h.append((tx_hash, tx_height))
         return h
 
+    def get_address_history_status(self, addr: str) -> Optional[str]:
+        """Returns the status of db.get_addr_history(addr), as announced by servers.
+        It is only recomputed after the history of the address changed.
+        """
+        status = self._history_status.get(addr, Ellipsis)
+        if status is not Ellipsis:
+            return status
+        # writers drop the cached status with self.lock held
+        with self.lock:
+            if addr not in self._history_status:
+                self._history_status[addr] = history_status(self.db.get_addr_history(addr))
+            return self._history_status[addr]
+
     def get_address_history_len(self, addr: str) -> int:
         """Return number of transactions where address is involved."""
         return len(self._history_local.get(addr, ()))
@@ -188,7 +292,18 @@ class AddressSynchronizer(Logger):
             util.register_callback(self.on_blockchain_updated, ['blockchain_updated'])
 
     def on_blockchain_updated(self, event, *args):
-        self._get_addr_balance_cache = {}  # invalidate cache
+        # only the balances with coinbase outputs maturing in the new block(s) change
+        local_height = self.get_local_height()
+        with self._write_section():
+            prev_height = self._balance_cache_height
+            self._balance_cache_height = local_height
+            if prev_height is None or local_height < prev_height:
+                self._clear_balance_cache()  # the balances might have been computed at a greater height
+                return
+            mempool_height = local_height + 1  # height of next block
+            for addr, mature_height in list(self._immature_coinbase_addrs.items()):
+                if mature_height <= mempool_height:
+                    self._invalidate_addr_balance(addr)
 
     async def stop(self):
         if self.network:
@@ -211,6 +326,14 @@ class AddressSynchronizer(Logger):
         if self.synchronizer:
             self.synchronizer.add(address)
 
+    def add_addresses(self, addresses: Sequence[str]) -> None:
+        """Like add_address, for many addresses at once."""
+        new_addresses = self.db.add_empty_addr_histories(addresses)
+        if new_addresses:
+            self.set_up_to_date(False)
+        if self.synchronizer and addresses:
+            self.synchronizer.add_many(addresses)
+
     def get_conflicting_transactions(self, tx_hash, tx: Transaction, include_self=False):
         """Returns a set of transaction hashes from the wallet history that are
         directly conflicting with tx, i.e. they have common outpoints being
@@ -256,7 +379,7 @@ class AddressSynchronizer(Logger):
             raise Exception("cannot add tx without txid to wallet history")
         # we need self.transaction_lock but get_tx_height will take self.lock
         # so we need to take that too here, to enforce order of locks
-        with self.lock, self.transaction_lock:
+        with self._write_section(), self.transaction_lock:
             # NOTE: returning if tx in self.transactions might seem like a good idea
             # BUT we track is_mine inputs in a txn, and during subsequent calls
             # of add_transaction tx, we might learn of more-and-more inputs of
@@ -307,7 +430,8 @@ class AddressSynchronizer(Logger):
                         pass
                     else:
                         self.db.add_txi_addr(tx_hash, addr, ser, v)
-                        self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
+                        self._invalidate_addr_balance(addr)
+                        self._utxo_index_dirty.add(addr)
             for txi in tx.inputs():
                 if txi.is_coinbase_input():
                     continue
@@ -325,7 +449,8 @@ class AddressSynchronizer(Logger):
                 addr = txo.address
                 if addr and self.is_mine(addr):
                     self.db.add_txo_addr(tx_hash, addr, n, v, is_coinbase)
-                    self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
+                    self._invalidate_addr_balance(addr)
+                    self._utxo_index_dirty.add(addr)
                     # give v to txi that spends me
                     next_tx = self.db.get_spent_outpoint(tx_hash, n)
                     if next_tx is not None:
@@ -342,7 +467,7 @@ class AddressSynchronizer(Logger):
         """Removes a transaction AND all its dependents/children
         from the wallet history.
         """
-        with self.lock, self.transaction_lock:
+        with self._write_section(), self.transaction_lock:
             to_remove = {tx_hash}
             to_remove |= self.get_depending_transactions(tx_hash)
             for txid in to_remove:
@@ -369,13 +494,14 @@ class AddressSynchronizer(Logger):
                     if spending_txid == tx_hash:
                         self.db.remove_spent_outpoint(prevout_hash, prevout_n)
 
-        with self.lock, self.transaction_lock:
+        with self._write_section(), self.transaction_lock:
             self.logger.info(f"removing tx from history {tx_hash}")
             tx = self.db.remove_transaction(tx_hash)
             remove_from_spent_outpoints()
             self._remove_tx_from_local_history(tx_hash)
             for addr in itertools.chain(self.db.get_txi_addresses(tx_hash), self.db.get_txo_addresses(tx_hash)):
-                self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
+                self._invalidate_addr_balance(addr)
+                self._utxo_index_dirty.add(addr)
             self.db.remove_txi(tx_hash)
             self.db.remove_txo(tx_hash)
             self.db.remove_tx_fee(tx_hash)
@@ -402,16 +528,18 @@ class AddressSynchronizer(Logger):
         self.add_transaction(tx, allow_unrelated=True)
 
     def receive_history_callback(self, addr: str, hist, tx_fees: Dict[str, int]):
-        with self.lock:
+        with self._write_section():
             old_hist = self.get_address_history(addr)
             for tx_hash, height in old_hist:
                 if (tx_hash, height) not in hist:
                     # make tx local
                     self.unverified_tx.pop(tx_hash, None)
                     self.db.remove_verified_tx(tx_hash)
+                    self._on_tx_height_changed(tx_hash)
                     if self.verifier:
                         self.verifier.remove_spv_proof_for_tx(tx_hash)
             self.db.set_addr_history(addr, hist)
+            self._history_status.pop(addr, None)
 
         for tx_hash, tx_height in hist:
             # add it in case it was previously unconfirmed
@@ -423,15 +551,76 @@ class AddressSynchronizer(Logger):
             self.add_transaction(tx, allow_unrelated=True)
 
         # Store fees
-        for tx_hash, fee_sat in tx_fees.items():
-            self.db.add_tx_fee_from_server(tx_hash, fee_sat)
+        with self._write_section():
+            for tx_hash, fee_sat in tx_fees.items():
+                self.db.add_tx_fee_from_server(tx_hash, fee_sat)
 
     @profiler
     def load_local_history(self):
         self._history_local = {}  # type: Dict[str, Set[str]]  # address -> set(txid)
+        self._history_index = HistoryIndex()
+        self._history_index_dirty = set()  # type: Set[str]  # txids to re-place in _history_index
+        # unspent outputs of each address: address -> prevout_str -> (value, is_coinbase)
+        self._utxo_index = {}  # type: Dict[str, Dict[str, Tuple[int, bool]]]
+        self._utxo_index_dirty = set()  # type: Set[str]  # addresses to rescan
         self._address_history_changed_events = defaultdict(asyncio.Event)  # address -> Event
+        self._history_status = {}  # type: Dict[str, Optional[str]]  # address -> status of its history
         for txid in itertools.chain(self.db.list_txi(), self.db.list_txo()):
             self._add_tx_to_local_history(txid)
+        self._utxo_index_dirty.update(self._history_local)
+        self._balance_cache_height = None  # type: Optional[int]
+        self._clear_balance_cache()
+
+    def _read_snapshot(self, key: Tuple, compute: Callable[[], Any]) -> Any:
+        """Returns compute(), run with the wallet locks held, and keeps the result
+        (which must be immutable) as the snapshot for key.
+        If the locks are busy, the last snapshot for key is returned instead, as long
+        as it is the last complete state: no write section ended since it was taken
+        (one might be in progress), and the local height is the same.
+        Otherwise, readers wait for the locks.
+        """
+        local_height = self.get_local_height()
+        acquired = []
+        try:
+            for lock in (self.lock, self.transaction_lock):
+                snapshot = self._snapshots.get(key)
+                is_complete = (snapshot is not None
+                               and snapshot[1] == local_height
+                               and self._state_version - snapshot[0] <= 1)
+                if not lock.acquire(blocking=not is_complete):
+                    return snapshot[2]
+                acquired.append(lock)
+            value = compute()
+            if self._write_depth:
+                return value  # a write section of this thread is not over
+            self._snapshots[key] = (self._state_version, local_height, value)
+            self._snapshots.move_to_end(key)
+            while len(self._snapshots) > SNAPSHOT_CACHE_SIZE:
+                self._snapshots.popitem(last=False)
+            return value
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+
+    def _clear_balance_cache(self) -> None:
+        self._get_addr_balance_cache = {}  # type: Dict[str, Tuple[int, int, int]]
+        # address -> mempool height at which its first immature coinbase output matures
+        self._immature_coinbase_addrs = {}  # type: Dict[str, int]
+        # balance of the whole wallet, and the balances of the addresses it is made of
+        self._wallet_balance = (0, 0, 0)
+        self._wallet_balance_parts = {}  # type: Dict[str, Tuple[int, int, int]]
+        self._wallet_balance_dirty = set(self._history_local)  # type: Set[str]
+
+    def _invalidate_addr_balance(self, addr: str) -> None:
+        self._get_addr_balance_cache.pop(addr, None)
+        self._immature_coinbase_addrs.pop(addr, None)
+        self._wallet_balance_dirty.add(addr)
+
+    def _on_tx_height_changed(self, tx_hash: str) -> None:
+        # the tx moves in the history, and its coins might change from confirmed to not
+        self._history_index_dirty.add(tx_hash)
+        for addr in itertools.chain(self.db.get_txi_addresses(tx_hash), self.db.get_txo_addresses(tx_hash)):
+            self._invalidate_addr_balance(addr)
 
     @profiler
     def check_history(self):
@@ -455,11 +644,16 @@ class AddressSynchronizer(Logger):
                 self.remove_transaction(txid)
 
     def clear_history(self):
-        with self.lock:
+        with self._write_section():
             with self.transaction_lock:
                 self.db.clear_history()
                 self._history_local.clear()
-                self._get_addr_balance_cache = {}  # invalidate cache
+                self._history_index = HistoryIndex()
+                self._history_index_dirty.clear()
+                self._utxo_index.clear()
+                self._utxo_index_dirty.clear()
+                self._history_status.clear()
+                self._clear_balance_cache()
 
     def get_txpos(self, tx_hash):
         """Returns (height, txpos) tuple, even if the tx is unverified."""
@@ -485,13 +679,29 @@ class AddressSynchronizer(Logger):
                 self.threadlocal_cache.local_height = orig_val
         return f
 
-    @with_lock
-    @with_transaction_lock
     @with_local_height_cached
-    def get_history(self, *, domain=None) -> Sequence[HistoryItem]:
-        # get domain
+    def get_history(self, *, domain=None, start: int = None, stop: int = None) -> Sequence[HistoryItem]:
+        """Returns the history items [start:stop], oldest first.
+        The history of the whole wallet is read from an index kept up to date
+        incrementally (or from a snapshot, see _read_snapshot); for a domain of
+        addresses, it is computed from scratch.
+        """
         if domain is None:
-            domain = self.get_addresses()
+            return list(self._read_snapshot(('history', start, stop),
+                                            lambda: tuple(self._get_wallet_history(start, stop))))
+        with self.lock, self.transaction_lock:
+            return self._get_domain_history(domain)[start:stop]
+
+    def _get_wallet_history(self, start: Optional[int], stop: Optional[int]) -> Sequence[HistoryItem]:
+        history = self._get_history_index().get_items(start, stop)
+        return [HistoryItem(txid=tx_hash,
+                            tx_mined_status=self.get_tx_height(tx_hash),
+                            delta=delta,
+                            fee=self.get_tx_fee(tx_hash),
+                            balance=balance)
+                for tx_hash, delta, balance in history]
+
+    def _get_domain_history(self, domain) -> Sequence[HistoryItem]:
         domain = set(domain)
         # 1. Get the history of each address in the domain, maintain the
         #    delta of a tx as the sum of its deltas on domain addresses
@@ -507,7 +717,7 @@ class AddressSynchronizer(Logger):
             tx_mined_status = self.get_tx_height(tx_hash)
             fee = self.get_tx_fee(tx_hash)
             history.append((tx_hash, tx_mined_status, delta, fee))
-        history.sort(key = lambda x: self.get_txpos(x[0]), reverse=True)
+        history.sort(key = lambda x: (self.get_txpos(x[0]), x[0]), reverse=True)
         # 3. add balance
         c, u, x = self.get_balance(domain)
         balance = c + u + x
@@ -526,8 +736,28 @@ class AddressSynchronizer(Logger):
 
         return h2
 
+    def get_history_len(self) -> int:
+        """Returns the number of transactions in the history of the whole wallet."""
+        with self.lock, self.transaction_lock:
+            return len(self._get_history_index())
+
+    def _get_history_index(self) -> HistoryIndex:
+        # re-place the transactions whose position or delta might have changed
+        # note: the caller must hold self.lock and self.transaction_lock
+        for tx_hash in self._history_index_dirty:
+            addrs = set(filter(self.is_mine, itertools.chain(self.db.get_txi_addresses(tx_hash),
+                                                             self.db.get_txo_addresses(tx_hash))))
+            if not addrs:
+                self._history_index.remove(tx_hash)
+                continue
+            delta = sum(self.get_tx_delta(tx_hash, addr) for addr in addrs)
+            self._history_index.update(tx_hash, self.get_txpos(tx_hash), delta)
+        self._history_index_dirty.clear()
+        return self._history_index
+
     def _add_tx_to_local_history(self, txid):
         with self.transaction_lock:
+            self._history_index_dirty.add(txid)
             for addr in itertools.chain(self.db.get_txi_addresses(txid), self.db.get_txo_addresses(txid)):
                 cur_hist = self._history_local.get(addr, set())
                 cur_hist.add(txid)
@@ -536,6 +766,7 @@ class AddressSynchronizer(Logger):
 
     def _remove_tx_from_local_history(self, txid):
         with self.transaction_lock:
+            self._history_index_dirty.add(txid)
             for addr in itertools.chain(self.db.get_txi_addresses(txid), self.db.get_txo_addresses(txid)):
                 cur_hist = self._history_local.get(addr, set())
                 try:
@@ -563,26 +794,35 @@ class AddressSynchronizer(Logger):
     def add_unverified_tx(self, tx_hash, tx_height):
         if self.db.is_in_verified_tx(tx_hash):
             if tx_height in (TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT):
-                with self.lock:
+                with self._write_section():
                     self.db.remove_verified_tx(tx_hash)
+                    self._on_tx_height_changed(tx_hash)
                 if self.verifier:
                     self.verifier.remove_spv_proof_for_tx(tx_hash)
         else:
-            with self.lock:
+            with self._write_section():
                 # tx will be verified only if height > 0
-                self.unverified_tx[tx_hash] = tx_height
+                if self.unverified_tx.get(tx_hash) != tx_height:
+                    self.unverified_tx[tx_hash] = tx_height
+                    self._on_tx_height_changed(tx_hash)
 
     def remove_unverified_tx(self, tx_hash, tx_height):
-        with self.lock:
+        with self._write_section():
             new_height = self.unverified_tx.get(tx_hash)
             if new_height == tx_height:
                 self.unverified_tx.pop(tx_hash, None)
+                self._on_tx_height_changed(tx_hash)
 
     def add_verified_tx(self, tx_hash: str, info: TxMinedInfo):
         # Remove from the unverified map and add to the verified map
-        with self.lock:
+        with self._write_section():
+            prev_height = self.get_tx_height(tx_hash).height
             self.unverified_tx.pop(tx_hash, None)
             self.db.add_verified_tx(tx_hash, info)
+            if prev_height != info.height:
+                self._on_tx_height_changed(tx_hash)
+            else:
+                self._history_index_dirty.add(tx_hash)  # its txpos is now known
         tx_mined_status = self.get_tx_height(tx_hash)
         util.trigger_callback('verified', self, tx_hash, tx_mined_status)
 
@@ -594,25 +834,25 @@ class AddressSynchronizer(Logger):
     def undo_verifications(self, blockchain, above_height):
         '''Used by the verifier when a reorg has happened'''
         txs = set()
-        with self.lock:
-            for tx_hash in self.db.list_verified_tx():
+        with self._write_section():
+            for tx_hash in self.db.list_verified_tx_above_height(above_height):
                 info = self.db.get_verified_tx(tx_hash)
                 tx_height = info.height
-                if tx_height > above_height:
-                    header = blockchain.read_header(tx_height)
-                    if not header or hash_header(header) != info.header_hash:
-                        self.db.remove_verified_tx(tx_hash)
-                        # NOTE: we should add these txns to self.unverified_tx,
-                        # but with what height?
-                        # If on the new fork after the reorg, the txn is at the
-                        # same height, we will not get a status update for the
-                        # address. If the txn is not mined or at a diff height,
-                        # we should get a status update. Unless we put tx into
-                        # unverified_tx, it will turn into local. So we put it
-                        # into unverified_tx with the old height, and if we get
-                        # a status update, that will overwrite it.
-                        self.unverified_tx[tx_hash] = tx_height
-                        txs.add(tx_hash)
+                header = blockchain.read_header(tx_height)
+                if not header or hash_header(header) != info.header_hash:
+                    self.db.remove_verified_tx(tx_hash)
+                    # NOTE: we should add these txns to self.unverified_tx,
+                    # but with what height?
+                    # If on the new fork after the reorg, the txn is at the
+                    # same height, we will not get a status update for the
+                    # address. If the txn is not mined or at a diff height,
+                    # we should get a status update. Unless we put tx into
+                    # unverified_tx, it will turn into local. So we put it
+                    # into unverified_tx with the old height, and if we get
+                    # a status update, that will overwrite it.
+                    self.unverified_tx[tx_hash] = tx_height
+                    self._on_tx_height_changed(tx_hash)
+                    txs.add(tx_hash)
         return txs
 
     def get_local_height(self) -> int:
@@ -623,7 +863,7 @@ class AddressSynchronizer(Logger):
         return self.network.get_local_height() if self.network else self.db.get('stored_height', 0)
 
     def add_future_tx(self, tx: Transaction, wanted_height: int) -> bool:
-        with self.lock:
+        with self._write_section():
             tx_was_added = self.add_transaction(tx)
             if tx_was_added:
                 self.future_tx[tx.txid()] = wanted_height
@@ -772,22 +1012,61 @@ class AddressSynchronizer(Logger):
         out = {}
         for prevout_str, v in coins.items():
             tx_height, value, is_cb = v
-            prevout = TxOutpoint.from_str(prevout_str)
-            utxo = PartialTxInput(prevout=prevout, is_coinbase_output=is_cb)
-            utxo._trusted_address = address
-            utxo._trusted_value_sats = value
-            utxo.block_height = tx_height
-            utxo.spent_height = spent.get(prevout_str, None)
-            out[prevout] = utxo
+            utxo = self._make_txo(address, prevout_str, value, is_cb,
+                                  block_height=tx_height, spent_height=spent.get(prevout_str, None))
+            out[utxo.prevout] = utxo
         return out
 
+    @classmethod
+    def _make_txo(cls, address: str, prevout_str: str, value: int, is_cb: bool, *,
+                  block_height: int, spent_height: Optional[int]) -> PartialTxInput:
+        utxo = PartialTxInput(prevout=TxOutpoint.from_str(prevout_str), is_coinbase_output=is_cb)
+        utxo._trusted_address = address
+        utxo._trusted_value_sats = value
+        utxo.block_height = block_height
+        utxo.spent_height = spent_height
+        return utxo
+
     def get_addr_utxo(self, address: str) -> Dict[TxOutpoint, PartialTxInput]:
-        out = self.get_addr_outputs(address)
-        for k, v in list(out.items()):
-            if v.spent_height is not None:
-                out.pop(k)
+        with self.lock, self.transaction_lock:
+            records = self._get_utxo_records([address])
+        out = {}
+        for address, prevout_str, value, is_cb, tx_height in records:
+            utxo = self._make_txo(address, prevout_str, value, is_cb,
+                                  block_height=tx_height, spent_height=None)
+            out[utxo.prevout] = utxo
         return out
 
+    def _get_utxo_records(self, addrs: Iterable[str] = None) -> Sequence[Tuple[str, str, int, bool, int]]:
+        """Returns (address, prevout_str, value, is_coinbase, tx_height) of the unspent
+        outputs of addrs, or of the whole wallet.
+        note: the caller must hold self.lock and self.transaction_lock
+        """
+        utxo_index = self._get_utxo_index()
+        if addrs is None:
+            addrs = utxo_index.keys()
+        records = []
+        for addr in addrs:
+            for prevout_str, (value, is_cb) in utxo_index.get(addr, {}).items():
+                tx_height = self.get_tx_height(prevout_str.split(':')[0]).height
+                records.append((addr, prevout_str, value, is_cb, tx_height))
+        return records
+
+    def _get_utxo_index(self) -> Dict[str, Dict[str, Tuple[int, bool]]]:
+        # rescan the addresses whose outputs were added/spent/removed since last time
+        # note: the caller must hold self.lock and self.transaction_lock
+        for addr in self._utxo_index_dirty:
+            received, sent = self.get_addr_io(addr)
+            utxos = {prevout_str: (value, is_cb)
+                     for prevout_str, (tx_height, value, is_cb) in received.items()
+                     if prevout_str not in sent}
+            if utxos and self.is_mine(addr):
+                self._utxo_index[addr] = utxos
+            else:
+                self._utxo_index.pop(addr, None)
+        self._utxo_index_dirty.clear()
+        return self._utxo_index
+
     # return the total amount ever received by an address
     def get_addr_received(self, address):
         received, sent = self.get_addr_io(address)
@@ -808,11 +1087,14 @@ class AddressSynchronizer(Logger):
         received, sent = self.get_addr_io(address)
         c = u = x = 0
         mempool_height = self.get_local_height() + 1  # height of next block
+        mature_height = None  # mempool height at which the first immature coinbase output matures
         for txo, (tx_height, v, is_cb) in received.items():
             if txo in excluded_coins:
                 continue
             if is_cb and tx_height + COINBASE_MATURITY > mempool_height:
                 x += v
+                if mature_height is None or tx_height + COINBASE_MATURITY < mature_height:
+                    mature_height = tx_height + COINBASE_MATURITY
             elif tx_height > 0:
                 c += v
             else:
@@ -826,8 +1108,10 @@ class AddressSynchronizer(Logger):
         # cache result.
         if not excluded_coins:
             # Cache needs to be invalidated if a transaction is added to/
-            # removed from history; or on new blocks (maturity...)
+            # removed from history; or on new blocks if a coinbase output matures
             self._get_addr_balance_cache[address] = result
+            if mature_height is not None:
+                self._immature_coinbase_addrs[address] = mature_height
         return result
 
     @with_local_height_cached
@@ -850,33 +1134,44 @@ class AddressSynchronizer(Logger):
         else:
             block_height = self.get_local_height()
         coins = []
-        if domain is None:
-            domain = self.get_addresses()
-        domain = set(domain)
-        if excluded_addresses:
-            domain = set(domain) - set(excluded_addresses)
+        if not confirmed_spending_only:
+            # only unspent outputs are wanted: read them from the index, instead of
+            # going through the history of every address in the domain
+            # not from a snapshot: coin selection must not spend coins that are already gone
+            with self.lock, self.transaction_lock:
+                records = self._get_utxo_records(set(domain) if domain is not None else None)
+            excluded_addresses = set(excluded_addresses or ())
+            txos = [self._make_txo(addr, prevout_str, value, is_cb, block_height=tx_height, spent_height=None)
+                    for addr, prevout_str, value, is_cb, tx_height in records
+                    if addr not in excluded_addresses]
+        else:
+            if domain is None:
+                domain = self.get_addresses()
+            domain = set(domain)
+            if excluded_addresses:
+                domain = set(domain) - set(excluded_addresses)
+            txos = [txo for addr in domain for txo in self.get_addr_outputs(addr).values()]
         mempool_height = block_height + 1  # height of next block
-        for addr in domain:
-            txos = self.get_addr_outputs(addr)
-            for txo in txos.values():
-                if txo.spent_height is not None:
-                    if not confirmed_spending_only:
-                        continue
-                    if confirmed_spending_only and 0 < txo.spent_height <= block_height:
-                        continue
-                if confirmed_funding_only and not (0 < txo.block_height <= block_height):
+        for txo in txos:
+            if txo.spent_height is not None:
+                if not confirmed_spending_only:
                     continue
-                if nonlocal_only and txo.block_height in (TX_HEIGHT_LOCAL, TX_HEIGHT_FUTURE):
+                if confirmed_spending_only and 0 < txo.spent_height <= block_height:
                     continue
-                if (mature_only and txo.is_coinbase_output()
-                        and txo.block_height + COINBASE_MATURITY > mempool_height):
-                    continue
-                coins.append(txo)
+            if confirmed_funding_only and not (0 < txo.block_height <= block_height):
+                continue
+            if nonlocal_only and txo.block_height in (TX_HEIGHT_LOCAL, TX_HEIGHT_FUTURE):
+                continue
+            if (mature_only and txo.is_coinbase_output()
+                    and txo.block_height + COINBASE_MATURITY > mempool_height):
                 continue
+            coins.append(txo)
         return coins
 
     def get_balance(self, domain=None, *, excluded_addresses: Set[str] = None,
                     excluded_coins: Set[str] = None) -> Tuple[int, int, int]:
+        if domain is None and not excluded_addresses and not excluded_coins:
+            return self._read_snapshot(('balance',), self._get_wallet_balance)
         if domain is None:
             domain = self.get_addresses()
         if excluded_addresses is None:
@@ -891,6 +1186,22 @@ class AddressSynchronizer(Logger):
             xx += x
         return cc, uu, xx
 
+    @with_local_height_cached
+    def _get_wallet_balance(self) -> Tuple[int, int, int]:
+        # the balance of the whole wallet is kept up to date from the
+        # addresses whose balance changed since last time
+        with self.lock:
+            cc, uu, xx = self._wallet_balance
+            for addr in self._wallet_balance_dirty:
+                c0, u0, x0 = self._wallet_balance_parts.pop(addr, (0, 0, 0))
+                c, u, x = self.get_addr_balance(addr) if self.is_mine(addr) else (0, 0, 0)
+                if c or u or x:
+                    self._wallet_balance_parts[addr] = c, u, x
+                cc, uu, xx = cc + c - c0, uu + u - u0, xx + x - x0
+            self._wallet_balance_dirty.clear()
+            self._wallet_balance = cc, uu, xx
+            return self._wallet_balance
+
     def is_used(self, address: str) -> bool:
         return self.get_address_history_len(address) != 0
 
@@ -96,6 +96,24 @@ def _CKD_pub(parent_pubkey: bytes, parent_chaincode: bytes, child_index: bytes)
     return child_pubkey, child_chaincode
 
 
+def CKD_pub_range(parent_pubkey: bytes, parent_chaincode: bytes, start: int, stop: int) -> List[bytes]:
+    """Public keys of the children start..stop-1 of a node, from its public key only.
+    Same as CKD_pub(...)[0] for each child index, but in bulk.
+    """
+    if start < 0: raise ValueError('the bip32 index needs to be non-negative')
+    if stop > BIP32_PRIME: raise Exception('not possible to derive hardened child from parent pubkey')
+    tweaks = []
+    for child_index in range(start, stop):
+        I = hmac_oneshot(parent_chaincode, parent_pubkey + child_index.to_bytes(4, byteorder='big'), hashlib.sha512)
+        tweaks.append(I[0:32])
+    try:
+        return ecc.ECPubkey(parent_pubkey).tweak_add_many(tweaks)
+    except ecc.InvalidECPointException:
+        # derive one by one: CKD_pub raises for the first invalid index, as it would without bulk
+        return [CKD_pub(parent_pubkey, parent_chaincode, child_index)[0]
+                for child_index in range(start, stop)]
+
+
 def xprv_header(xtype: str, *, net=None) -> bytes:
     if net is None:
         net = constants.net
@@ -534,6 +534,10 @@ assert len(__b58chars) == 58
 __b43chars = b'0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ$*+-./:'
 assert len(__b43chars) == 43
 
+# byte -> digit lookup tables for base_decode, -1 for forbidden characters
+__b58digits = [__b58chars.find(bytes([c])) for c in range(256)]
+__b43digits = [__b43chars.find(bytes([c])) for c in range(256)]
+
 
 class BaseDecodeError(BitcoinException): pass
 
@@ -546,12 +550,7 @@ def base_encode(v: bytes, *, base: int) -> str:
     chars = __b58chars
     if base == 43:
         chars = __b43chars
-    long_value = 0
-    power_of_base = 1
-    for c in v[::-1]:
-        # naive but slow variant:   long_value += (256**i) * c
-        long_value += power_of_base * c
-        power_of_base <<= 8
+    long_value = int.from_bytes(v, byteorder='big')
     result = bytearray()
     while long_value >= base:
         div, mod = divmod(long_value, base)
@@ -580,32 +579,19 @@ def base_decode(v: Union[bytes, str], *, base: int, length: int = None) -> Optio
     chars = __b58chars
     if base == 43:
         chars = __b43chars
+    digits = __b58digits if base == 58 else __b43digits
     long_value = 0
-    power_of_base = 1
-    for c in v[::-1]:
-        digit = chars.find(bytes([c]))
+    for c in v:
+        digit = digits[c]
         if digit == -1:
             raise BaseDecodeError('Forbidden character {} for base {}'.format(c, base))
-        # naive but slow variant:   long_value += digit * (base**i)
-        long_value += digit * power_of_base
-        power_of_base *= base
-    result = bytearray()
-    while long_value >= 256:
-        div, mod = divmod(long_value, 256)
-        result.append(mod)
-        long_value = div
-    result.append(long_value)
-    nPad = 0
-    for c in v:
-        if c == chars[0]:
-            nPad += 1
-        else:
-            break
-    result.extend(b'\x00' * nPad)
+        long_value = long_value * base + digit
+    result = long_value.to_bytes(max(1, (long_value.bit_length() + 7) // 8), 'big')
+    nPad = len(v) - len(v.lstrip(chars[0:1]))
+    result = b'\x00' * nPad + result
     if length is not None and len(result) != length:
         return None
-    result.reverse()
-    return bytes(result)
+    return result
 
 
 class InvalidChecksum(BaseDecodeError):
@@ -21,9 +21,13 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import os
+import hashlib
+import json
+import mmap
 import threading
 import time
-from typing import Optional, Dict, Mapping, Sequence
+from collections import OrderedDict
+from typing import Optional, Dict, Mapping, Sequence, List, Tuple
 
 from . import util
 from .bitcoin import hash_encode, int_to_hex, rev_hex
@@ -39,6 +43,10 @@ _logger = get_logger(__name__)
 HEADER_SIZE = 80  # bytes
 MAX_TARGET = 0x00000000FFFF0000000000000000000000000000000000000000000000000000
 
+HEADER_CACHE_SIZE = 2016  # parsed headers kept in memory, per chain
+CHAINWORK_INDEX_SUFFIX = '.chainwork'  # note: files in forks/ with a '.' are not chains
+_NULL_HASH = bytes(32)
+
 
 class MissingHeader(Exception):
     pass
@@ -101,6 +109,7 @@ def read_blockchains(config: 'SimpleConfig'):
         header_after_cp = best_chain.read_header(constants.net.max_checkpoint()+1)
         if not header_after_cp or not best_chain.can_connect(header_after_cp, check_height=False):
             _logger.info("[blockchain] deleting best chain. cannot connect header after last cp to last cp.")
+            best_chain.close_headers_mmap()
             os.unlink(best_chain.path())
             best_chain.update_size()
     # forks
@@ -113,6 +122,9 @@ def read_blockchains(config: 'SimpleConfig'):
     def delete_chain(filename, reason):
         _logger.info(f"[blockchain] deleting chain {filename}: {reason}")
         os.unlink(os.path.join(fdir, filename))
+        index_path = os.path.join(fdir, filename + CHAINWORK_INDEX_SUFFIX)
+        if os.path.exists(index_path):
+            os.unlink(index_path)
 
     def instantiate_chain(filename):
         __, forkpoint, prev_hash, first_hash = filename.split('_')
@@ -154,17 +166,14 @@ def read_blockchains(config: 'SimpleConfig'):
 def get_best_chain() -> 'Blockchain':
     return blockchains[constants.net.GENESIS]
 
-# block hash -> chain work; up to and including that block
-_CHAINWORK_CACHE = {
-    "0000000000000000000000000000000000000000000000000000000000000000": 0,  # virtual block at height -1
-}  # type: Dict[str, int]
-
 
 def init_headers_file_for_best_chain():
     b = get_best_chain()
     filename = b.path()
     length = HEADER_SIZE * len(constants.net.CHECKPOINTS) * 2016
     if not os.path.exists(filename) or os.path.getsize(filename) < length:
+        with b.lock:
+            b.invalidate_caches()
         with open(filename, 'wb') as f:
             if length > 0:
                 f.seek(length - 1)
@@ -174,6 +183,50 @@ def init_headers_file_for_best_chain():
         b.update_size()
 
 
+def import_headers_snapshot(path: str) -> int:
+    """Seed the best chain from a local headers snapshot: a file of raw 80-byte
+    headers starting at genesis. Periods within the checkpoint region must end
+    with the checkpointed block hash; the ones after it are verified like chunks
+    downloaded from a server. Import stops at the first period that fails.
+    Returns the height of the last header imported, or -1.
+    """
+    b = get_best_chain()
+    num_headers = os.path.getsize(path) // HEADER_SIZE
+    if num_headers == 0:
+        return -1
+    with open(path, 'rb') as f:
+        f.seek((num_headers - 1) * HEADER_SIZE)
+        last_raw_header = f.read(HEADER_SIZE)
+    # note: not get_hash, it would return checkpoints we might not have the headers of
+    header = b.read_header(num_headers - 1)
+    if header and hash_header(header) == hash_raw_header(bh2u(last_raw_header)):
+        return -1  # already imported
+    num_checkpoints = len(constants.net.CHECKPOINTS)
+    height = -1
+    with open(path, 'rb') as f, b.lock:
+        for index in range((num_headers + 2015) // 2016):
+            data = f.read(2016 * HEADER_SIZE)
+            data = data[:len(data) // HEADER_SIZE * HEADER_SIZE]
+            last_height = index * 2016 + len(data) // HEADER_SIZE - 1
+            try:
+                if index < num_checkpoints:
+                    if len(data) != 2016 * HEADER_SIZE:
+                        break
+                    Blockchain.verify_raw_headers(data, b.get_hash(index * 2016 - 1), b.get_target(index - 1),
+                                                  expected_hashes={2015: constants.net.CHECKPOINTS[index][0]})
+                else:
+                    b.verify_chunk(index, data)
+            except Exception as e:
+                _logger.info(f"[blockchain] headers snapshot: chunk {index} failed verification: {repr(e)}")
+                break
+            # note: never truncate headers we already have beyond the checkpoints
+            if index < num_checkpoints or last_height > b.height():
+                b.save_chunk(index, data)
+            height = last_height
+    _logger.info(f"[blockchain] imported headers snapshot up to height {height}")
+    return height
+
+
 class Blockchain(Logger):
     """
     Manages blockchain headers and their verification
@@ -193,6 +246,21 @@ class Blockchain(Logger):
         self._forkpoint_hash = forkpoint_hash  # blockhash at forkpoint. "first hash"
         self._prev_hash = prev_hash  # blockhash immediately before forkpoint
         self.lock = threading.RLock()
+        self._size = 0
+        # Read-only view of the headers file, mapped again once it grew. It is kept
+        # when headers are appended, and closed before the file is overwritten,
+        # truncated or replaced (on Windows, a mapped file cannot be truncated).
+        self._headers_mmap = None  # type: Optional[mmap.mmap]
+        # Block hashes (internal byte order), in one bytearray of 2016*32 bytes per
+        # 2016 headers from our forkpoint. All-zero means not computed yet.
+        self._hash_cache = {}  # type: Dict[int, bytearray]
+        self._header_cache = OrderedDict()  # type: OrderedDict[int, dict]  # height -> parsed header (LRU)
+        # For each complete retarget period of the chain: the hash of its last block,
+        # the cumulative chainwork up to that block, and the target computed from
+        # the period. Persisted next to the headers file, loaded lazily, and extended
+        # when saved headers complete a period.
+        self._period_index = None  # type: Optional[List[Tuple[str, int, int]]]
+        self._period_index_dirty = False
         self.update_size()
 
     @property
@@ -288,7 +356,55 @@ class Blockchain(Logger):
     @with_lock
     def update_size(self) -> None:
         p = self.path()
-        self._size = os.path.getsize(p)//HEADER_SIZE if os.path.exists(p) else 0
+        size = os.path.getsize(p)//HEADER_SIZE if os.path.exists(p) else 0
+        if size < self._size:
+            self.invalidate_caches(from_delta=size)
+        # if the file grew, _read_raw_header maps it again once it needs the new part
+        self._size = size
+
+    @with_lock
+    def close_headers_mmap(self) -> None:
+        if self._headers_mmap is not None:
+            self._headers_mmap.close()
+            self._headers_mmap = None
+
+    @with_lock
+    def invalidate_caches(self, *, from_delta: int = 0) -> None:
+        """Forget what we cached about the headers at and after forkpoint + from_delta."""
+        if from_delta >= self._size:
+            # appending: nothing is cached beyond our tip, and what is mapped does not change
+            return
+        self.close_headers_mmap()
+        period, i = divmod(from_delta, 2016)
+        for p in [p for p in self._hash_cache if p > period]:
+            del self._hash_cache[p]
+        if period in self._hash_cache:
+            hashes = self._hash_cache[period]
+            hashes[i*32:] = bytes(len(hashes) - i*32)
+        for height in [h for h in self._header_cache if h - self.forkpoint >= from_delta]:
+            del self._header_cache[height]
+        if self._period_index is not None:
+            # keep the periods that end before from_delta
+            num_periods = max(0, (self.forkpoint + from_delta) // 2016)
+            if len(self._period_index) > num_periods:
+                del self._period_index[num_periods:]
+                self._period_index_dirty = True
+
+    @with_lock
+    def _read_raw_header(self, delta: int) -> bytes:
+        for attempt in range(2):
+            if self._headers_mmap is None:
+                name = self.path()
+                self.assert_headers_file_available(name)
+                with open(name, 'rb') as f:
+                    if os.fstat(f.fileno()).st_size > 0:
+                        self._headers_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            h = self._headers_mmap[delta * HEADER_SIZE:(delta + 1) * HEADER_SIZE] if self._headers_mmap else b''
+            if len(h) == HEADER_SIZE:
+                return h
+            # the file might have grown since it was mapped
+            self.close_headers_mmap()
+        raise Exception('Expected to read a full header. This was only {} bytes'.format(len(h)))
 
     @classmethod
     def verify_header(cls, header: dict, prev_hash: str, target: int, expected_header_hash: str=None) -> None:
@@ -306,21 +422,58 @@ class Blockchain(Logger):
         if block_hash_as_num > target:
             raise Exception(f"insufficient proof of work: {block_hash_as_num} vs target {target}")
 
+    @classmethod
+    def verify_raw_headers(cls, data: bytes, prev_hash: str, target: int,
+                           expected_hashes: Mapping[int, str] = None) -> str:
+        """Verify consecutive serialized headers, all expected to have the given target.
+        Works on the raw bytes: only error messages convert hashes to hex.
+        expected_hashes maps positions in data to the header hash expected there.
+        Returns the hash of the last header.
+        """
+        if len(data) % HEADER_SIZE != 0:
+            raise InvalidHeader('Invalid header length: {}'.format(len(data)))
+        expected_hashes = {i: bfh(h)[::-1] for i, h in (expected_hashes or {}).items()}
+        check_pow = not constants.net.TESTNET
+        bits = cls.target_to_bits(target).to_bytes(4, byteorder='little') if check_pow else None
+        prev = bfh(prev_hash)[::-1]
+        data = memoryview(data)
+        for i in range(len(data) // HEADER_SIZE):
+            raw_header = data[i*HEADER_SIZE:(i+1)*HEADER_SIZE]
+            _hash = hashlib.sha256(hashlib.sha256(raw_header).digest()).digest()
+            expected = expected_hashes.get(i)
+            if expected is not None and expected != _hash:
+                raise Exception("hash mismatches with expected: {} vs {}".format(hash_encode(expected), hash_encode(_hash)))
+            if raw_header[4:36] != prev:
+                raise Exception("prev hash mismatch: %s vs %s" % (hash_encode(prev), hash_encode(bytes(raw_header[4:36]))))
+            if check_pow:
+                if raw_header[72:76] != bits:
+                    raise Exception("bits mismatch: %s vs %s" % (int.from_bytes(bits, byteorder='little'),
+                                                                 int.from_bytes(raw_header[72:76], byteorder='little')))
+                block_hash_as_num = int.from_bytes(_hash, byteorder='little')
+                if block_hash_as_num > target:
+                    raise Exception(f"insufficient proof of work: {block_hash_as_num} vs target {target}")
+            prev = _hash
+        return hash_encode(prev)
+
     def verify_chunk(self, index: int, data: bytes) -> None:
         num = len(data) // HEADER_SIZE
         start_height = index * 2016
         prev_hash = self.get_hash(start_height - 1)
         target = self.get_target(index-1)
-        for i in range(num):
-            height = start_height + i
+        # the hashes we already know: genesis, checkpoints, and the headers we have.
+        # Below the last checkpoint, the headers file might be zero-filled, and the
+        # checkpoint at the end of the chunk already commits to the headers before it.
+        last_height = start_height + num - 1
+        first_header_height = max(start_height, constants.net.max_checkpoint() + 1)
+        known_heights = set(range(first_header_height, min(last_height, self.height()) + 1))
+        known_heights.update(h for h in (0, last_height) if start_height <= h)
+        expected_hashes = {}
+        for height in known_heights:
             try:
-                expected_header_hash = self.get_hash(height)
+                expected_hashes[height - start_height] = self.get_hash(height)
             except MissingHeader:
-                expected_header_hash = None
-            raw_header = data[i*HEADER_SIZE : (i+1)*HEADER_SIZE]
-            header = deserialize_header(raw_header, index*2016 + i)
-            self.verify_header(header, prev_hash, target, expected_header_hash)
-            prev_hash = hash_header(header)
+                pass
+        self.verify_raw_headers(data, prev_hash, target, expected_hashes)
 
     @with_lock
     def path(self):
@@ -354,6 +507,7 @@ class Blockchain(Logger):
             delta_bytes = 0
         truncate = not chunk_within_checkpoint_region
         self.write(chunk, delta_bytes, truncate)
+        self._extend_period_index()
         self.swap_with_parent()
 
     def swap_with_parent(self) -> None:
@@ -393,6 +547,8 @@ class Blockchain(Logger):
         # parent's new name will be something new (not child's old name)
         self.assert_headers_file_available(self.path())
         child_old_name = self.path()
+        self.close_headers_mmap()
+        parent.close_headers_mmap()
         with open(self.path(), 'rb') as f:
             my_data = f.read()
         self.assert_headers_file_available(parent.path())
@@ -409,7 +565,14 @@ class Blockchain(Logger):
         self._forkpoint_hash, parent._forkpoint_hash = parent._forkpoint_hash, hash_raw_header(bh2u(parent_data[:HEADER_SIZE]))
         self._prev_hash, parent._prev_hash = parent._prev_hash, self._prev_hash
         # parent's new name
+        self.close_headers_mmap()
+        parent.close_headers_mmap()
         os.replace(child_old_name, parent.path())
+        # heights moved between the two files
+        self.invalidate_caches()
+        parent.invalidate_caches()
+        self._reset_period_index()
+        parent._reset_period_index()
         self.update_size()
         parent.update_size()
         # update pointers
@@ -434,6 +597,7 @@ class Blockchain(Logger):
     def write(self, data: bytes, offset: int, truncate: bool=True) -> None:
         filename = self.path()
         self.assert_headers_file_available(filename)
+        self.invalidate_caches(from_delta=offset // HEADER_SIZE)
         with open(filename, 'rb+') as f:
             if truncate and offset != self._size * HEADER_SIZE:
                 f.seek(offset)
@@ -452,6 +616,7 @@ class Blockchain(Logger):
         assert delta == self.size(), (delta, self.size())
         assert len(data) == HEADER_SIZE
         self.write(data, delta*HEADER_SIZE)
+        self._extend_period_index()
         self.swap_with_parent()
 
     @with_lock
@@ -462,17 +627,18 @@ class Blockchain(Logger):
             return self.parent.read_header(height)
         if height > self.height():
             return
-        delta = height - self.forkpoint
-        name = self.path()
-        self.assert_headers_file_available(name)
-        with open(name, 'rb') as f:
-            f.seek(delta * HEADER_SIZE)
-            h = f.read(HEADER_SIZE)
-            if len(h) < HEADER_SIZE:
-                raise Exception('Expected to read a full header. This was only {} bytes'.format(len(h)))
-        if h == bytes([0])*HEADER_SIZE:
-            return None
-        return deserialize_header(h, height)
+        header = self._header_cache.get(height)
+        if header is None:
+            h = self._read_raw_header(height - self.forkpoint)
+            if h == bytes([0])*HEADER_SIZE:
+                return None
+            header = deserialize_header(h, height)
+            self._header_cache[height] = header
+            if len(self._header_cache) > HEADER_CACHE_SIZE:
+                self._header_cache.popitem(last=False)
+        else:
+            self._header_cache.move_to_end(height)
+        return dict(header)  # callers may modify it
 
     def header_at_tip(self) -> Optional[dict]:
         """Return latest header."""
@@ -508,10 +674,28 @@ class Blockchain(Logger):
             h, t = self.checkpoints[index]
             return h
         else:
-            header = self.read_header(height)
-            if header is None:
-                raise MissingHeader(height)
-            return hash_header(header)
+            return hash_encode(self._get_raw_hash(height))
+
+    @with_lock
+    def _get_raw_hash(self, height: int) -> bytes:
+        if height < self.forkpoint:
+            return self.parent._get_raw_hash(height)
+        if height > self.height():
+            raise MissingHeader(height)
+        period, i = divmod(height - self.forkpoint, 2016)
+        hashes = self._hash_cache.get(period)
+        if hashes is not None:
+            h = bytes(hashes[i*32:(i+1)*32])
+            if h != _NULL_HASH:
+                return h
+        raw_header = self._read_raw_header(height - self.forkpoint)
+        if raw_header == bytes([0])*HEADER_SIZE:
+            raise MissingHeader(height)
+        h = sha256d(raw_header)
+        if hashes is None:
+            hashes = self._hash_cache[period] = bytearray(2016 * 32)
+        hashes[i*32:(i+1)*32] = h
+        return h
 
     def get_target(self, index: int) -> int:
         # compute target from chunk x, used in chunk x+1
@@ -522,7 +706,12 @@ class Blockchain(Logger):
         if index < len(self.checkpoints):
             h, t = self.checkpoints[index]
             return t
-        # new target
+        entry = self._get_valid_period_entry(index)
+        if entry is not None:
+            return entry[2]
+        return self._compute_target(index)
+
+    def _compute_target(self, index: int) -> int:
         first = self.read_header(index * 2016)
         last = self.read_header(index * 2016 + 2015)
         if not first or not last:
@@ -574,25 +763,106 @@ class Blockchain(Logger):
             # On testnet/regtest, difficulty works somewhat different.
             # It's out of scope to properly implement that.
             return height
-        last_retarget = height // 2016 * 2016 - 1
-        cached_height = last_retarget
-        while _CHAINWORK_CACHE.get(self.get_hash(cached_height)) is None:
-            if cached_height <= -1:
-                break
-            cached_height -= 2016
-        assert cached_height >= -1, cached_height
-        running_total = _CHAINWORK_CACHE[self.get_hash(cached_height)]
-        while cached_height < last_retarget:
-            cached_height += 2016
-            work_in_single_header = self.chainwork_of_header_at_height(cached_height)
-            work_in_chunk = 2016 * work_in_single_header
-            running_total += work_in_chunk
-            _CHAINWORK_CACHE[self.get_hash(cached_height)] = running_total
-        cached_height += 2016
-        work_in_single_header = self.chainwork_of_header_at_height(cached_height)
+        last_period = height // 2016 - 1  # last complete period before height
+        running_total = self._get_period_chainwork(last_period) if last_period >= 0 else 0
+        work_in_single_header = self.chainwork_of_header_at_height(height)
         work_in_last_partial_chunk = (height % 2016 + 1) * work_in_single_header
         return running_total + work_in_last_partial_chunk
 
+    def _period_index_path(self) -> str:
+        return self.path() + CHAINWORK_INDEX_SUFFIX
+
+    @with_lock
+    def _reset_period_index(self) -> None:
+        self._period_index = []
+        self._period_index_dirty = False
+        if os.path.exists(self._period_index_path()):
+            os.unlink(self._period_index_path())
+
+    @with_lock
+    def _load_period_index(self) -> List[Tuple[str, int, int]]:
+        if self._period_index is None:
+            self._period_index = []
+            try:
+                with open(self._period_index_path(), 'r') as f:
+                    d = json.load(f)
+                self._period_index = [(h, int(work, 16), int(target, 16)) for h, work, target in d['periods']]
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                self.logger.info(f'ignoring chainwork index: {repr(e)}')
+        return self._period_index
+
+    @with_lock
+    def _save_period_index(self) -> None:
+        if not self._period_index_dirty:
+            return
+        path = self._period_index_path()
+        if not os.path.exists(os.path.dirname(path)):
+            return
+        index = self._period_index or []
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'periods': [(h, hex(work), hex(target)) for h, work, target in index]}, f)
+        os.replace(tmp_path, path)
+        self._period_index_dirty = False
+
+    @with_lock
+    def _get_valid_period_entry(self, index: int) -> Optional[Tuple[str, int, int]]:
+        """Entry of the period index, if we have it and it matches the chain.
+        As a block hash commits to all previous blocks, a matching entry
+        implies that all the entries before it are valid too.
+        """
+        entries = self._load_period_index()
+        if index >= len(entries):
+            return None
+        entry = entries[index]
+        try:
+            valid = entry[0] == self.get_hash(index * 2016 + 2015)
+        except MissingHeader:
+            valid = False
+        if not valid:
+            del entries[index:]
+            self._period_index_dirty = True
+            return None
+        return entry
+
+    @with_lock
+    def _get_period_chainwork(self, index: int) -> int:
+        """Chainwork up to and including the last block of period index."""
+        entry = self._get_valid_period_entry(index)
+        if entry is not None:
+            return entry[1]
+        entries = self._period_index
+        # drop entries from where the chain diverged, and extend from the last valid one
+        while entries and self._get_valid_period_entry(len(entries) - 1) is None:
+            continue
+        running_total = entries[-1][1] if entries else 0
+        for i in range(len(entries), index + 1):
+            work_in_single_header = self.chainwork_of_header_at_height(i * 2016)
+            running_total += 2016 * work_in_single_header
+            if i < len(self.checkpoints):
+                target = self.checkpoints[i][1]
+            else:
+                target = self._compute_target(i)
+            entries.append((self.get_hash(i * 2016 + 2015), running_total, target))
+            self._period_index_dirty = True
+        self._save_period_index()
+        return running_total
+
+    @with_lock
+    def _extend_period_index(self) -> None:
+        """Adds the periods completed by the saved headers to the period index."""
+        if constants.net.TESTNET:
+            return  # get_chainwork does not use it
+        last_period = (self.height() + 1) // 2016 - 1
+        if last_period < len(self._load_period_index()):
+            return
+        try:
+            self._get_period_chainwork(last_period)
+        except MissingHeader:
+            pass  # left to get_chainwork
+
     def can_connect(self, header: dict, check_height: bool=True) -> bool:
         if header is None:
             return False
@@ -541,6 +541,16 @@ class Commands:
         """Return the list of known servers (candidates for connecting)."""
         return self.network.get_servers()
 
+    @command('n')
+    async def getnetworkstats(self, chrome_trace=False):
+        """Return statistics about the recent requests sent to each connected server.
+        With --chrome_trace, return them as Chrome trace JSON instead.
+        Requests are only traced if the 'network_request_trace' config option is set.
+        """
+        if chrome_trace:
+            return self.network.get_chrome_trace()
+        return self.network.get_request_stats()
+
     @command('')
     async def version(self):
         """Return the version of Electrum."""
@@ -1303,6 +1313,7 @@ command_options = {
     'iknowwhatimdoing': (None, "Acknowledge that I understand the full implications of what I am about to do"),
     'gossip':      (None, "Apply command to gossip node instead of wallet"),
     'connection_string':      (None, "Lightning network node ID or network address"),
+    'chrome_trace': (None, "Export as Chrome trace JSON"),
 }
 
 
@@ -43,7 +43,7 @@ from .network import Network
 from .util import (json_decode, to_bytes, to_string, profiler, standardize_path, constant_time_compare)
 from .invoices import PR_PAID, PR_EXPIRED
 from .util import log_exceptions, ignore_exceptions, randrange
-from .wallet import Wallet, Abstract_Wallet
+from .wallet import Wallet, Abstract_Wallet, shutdown_derivation_pool
 from .storage import WalletStorage
 from .wallet_db import WalletDB
 from .commands import known_commands, Commands
@@ -552,6 +552,7 @@ class Daemon(Logger):
                 async with TaskGroup() as group:
                     for k, wallet in self._wallets.items():
                         await group.spawn(wallet.stop())
+                shutdown_derivation_pool()
                 self.logger.info("stopping network and taskgroup")
                 async with ignore_after(2):
                     async with TaskGroup() as group:
@@ -26,17 +26,17 @@
 import base64
 import hashlib
 import functools
-from typing import Union, Tuple, Optional
+from typing import Union, Tuple, Optional, Iterable, List
 from ctypes import (
     byref, c_byte, c_int, c_uint, c_char_p, c_size_t, c_void_p, create_string_buffer,
-    CFUNCTYPE, POINTER, cast
+    CFUNCTYPE, POINTER, cast, memmove
 )
 
 from .util import bfh, bh2u, assert_bytes, to_bytes, InvalidPassword, profiler, randrange
 from .crypto import (sha256d, aes_encrypt_with_iv, aes_decrypt_with_iv, hmac_oneshot)
 from . import constants
 from .logging import get_logger
-from .ecc_fast import _libsecp256k1, SECP256K1_EC_UNCOMPRESSED
+from .ecc_fast import _libsecp256k1, SECP256K1_EC_UNCOMPRESSED, SECP256K1_EC_COMPRESSED
 
 _logger = get_logger(__name__)
 
@@ -269,6 +269,29 @@ class ECPubkey(object):
             return POINT_AT_INFINITY
         return ECPubkey._from_libsecp256k1_pubkey_ptr(pubkey_sum)
 
+    def tweak_add_many(self, tweaks: Iterable[bytes]) -> List[bytes]:
+        """Returns self + t*G for each 32-byte tweak t, as compressed pubkey bytes.
+        Like adding ECPrivkey(t) to self for each t, but without the intermediate
+        objects: self is only parsed once.
+        """
+        if self.is_at_infinity(): raise Exception('point is at infinity')
+        pubkey = self._to_libsecp256k1_pubkey_ptr()
+        tweaked = create_string_buffer(64)
+        serialized = create_string_buffer(33)
+        serialized_size = c_size_t(33)
+        ret = []
+        for tweak in tweaks:
+            if not is_secret_within_curve_range(tweak):
+                raise InvalidECPointException('Invalid secret scalar (not within curve order)')
+            memmove(tweaked, pubkey, 64)
+            if not _libsecp256k1.secp256k1_ec_pubkey_tweak_add(_libsecp256k1.ctx, tweaked, tweak):
+                raise InvalidECPointException()
+            serialized_size.value = 33
+            _libsecp256k1.secp256k1_ec_pubkey_serialize(
+                _libsecp256k1.ctx, serialized, byref(serialized_size), tweaked, SECP256K1_EC_COMPRESSED)
+            ret.append(serialized.raw)
+        return ret
+
     def __eq__(self, other) -> bool:
         if not isinstance(other, ECPubkey):
             return False
@@ -30,12 +30,14 @@ import traceback
 import asyncio
 import socket
 from typing import Tuple, Union, List, TYPE_CHECKING, Optional, Set, NamedTuple, Any, Sequence, Dict
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
 from ipaddress import IPv4Network, IPv6Network, ip_address, IPv6Address, IPv4Address
 import itertools
 import logging
 import hashlib
 import functools
+import json
+import time
 
 import aiorpcx
 from aiorpcx import TaskGroup
@@ -71,6 +73,18 @@ BUCKET_NAME_OF_ONION_SERVERS = 'onion'
 
 MAX_INCOMING_MSG_SIZE = 1_000_000  # in bytes
 
+REQUEST_TRACE_SIZE = 1000  # number of requests remembered per interface, if tracing is enabled
+
+# max number of last results kept for subscriptions nobody listens to anymore
+STALE_SUBSCRIPTION_CACHE_SIZE = 10_000
+
+# One-byte ids for the methods whose subscription keys are stored compactly.
+# note: append only; the ids are only used in memory, but must stay unique.
+_COMPACT_RPC_METHOD_IDS = {
+    'blockchain.scripthash.subscribe': 1,
+    'blockchain.headers.subscribe': 2,
+}
+
 _KNOWN_NETWORK_PROTOCOLS = {'t', 's'}
 PREFERRED_NETWORK_PROTOCOL = 's'
 assert PREFERRED_NETWORK_PROTOCOL in _KNOWN_NETWORK_PROTOCOLS
@@ -132,16 +146,104 @@ def assert_list_or_tuple(val: Any) -> None:
         raise RequestCorrupted(f'{val!r} should be a list or tuple')
 
 
+class RequestTrace(NamedTuple):
+    method: str
+    param_size: int  # bytes, json-encoded
+    send_time: float  # unix timestamp
+    recv_time: float  # unix timestamp
+    response_size: int  # bytes, json-encoded
+    outcome: str  # 'ok', 'error', 'timeout' or 'cancelled'
+
+    def latency(self) -> float:
+        return self.recv_time - self.send_time
+
+
+class RequestTracer:
+    """Ring buffer of the most recent requests sent on an interface."""
+
+    def __init__(self, size: int = REQUEST_TRACE_SIZE):
+        self.traces = deque(maxlen=size)  # type: deque[RequestTrace]
+
+    def is_enabled(self) -> bool:
+        return self.traces.maxlen > 0
+
+    def record(self, trace: RequestTrace) -> None:
+        self.traces.append(trace)
+
+    def get_summary(self) -> dict:
+        """Per-method statistics of the requests in the buffer."""
+        summary = {}
+        for trace in list(self.traces):
+            d = summary.setdefault(trace.method, {
+                'count': 0,
+                'outcomes': defaultdict(int),
+                'bytes_sent': 0,
+                'bytes_received': 0,
+                'latencies': [],
+            })
+            d['count'] += 1
+            d['outcomes'][trace.outcome] += 1
+            d['bytes_sent'] += trace.param_size
+            d['bytes_received'] += trace.response_size
+            d['latencies'].append(trace.latency())
+        for d in summary.values():
+            latencies = sorted(d.pop('latencies'))
+            d['outcomes'] = dict(d['outcomes'])
+            d['latency_avg_ms'] = round(1000 * sum(latencies) / len(latencies), 3)
+            d['latency_p95_ms'] = round(1000 * latencies[int(0.95 * (len(latencies) - 1))], 3)
+            d['latency_max_ms'] = round(1000 * latencies[-1], 3)
+        return summary
+
+    def get_chrome_trace_events(self, *, pid: int = 1, tid: int = 1) -> List[dict]:
+        """Complete ('X') events in the Chrome trace event format.
+        Timestamps and durations are in microseconds.
+        """
+        return [{
+            'name': trace.method,
+            'cat': 'request',
+            'ph': 'X',
+            'ts': int(trace.send_time * 1_000_000),
+            'dur': int(trace.latency() * 1_000_000),
+            'pid': pid,
+            'tid': tid,
+            'args': {
+                'param_size': trace.param_size,
+                'response_size': trace.response_size,
+                'outcome': trace.outcome,
+            },
+        } for trace in list(self.traces)]
+
+
+def _json_size(obj) -> int:
+    try:
+        return len(json.dumps(obj))
+    except (TypeError, ValueError):
+        return 0
+
+
 class NotificationSession(RPCSession):
 
     def __init__(self, *args, interface: 'Interface', **kwargs):
         super(NotificationSession, self).__init__(*args, **kwargs)
-        self.subscriptions = defaultdict(list)
-        self.cache = {}
+        # Subscriptions are shared by everything using this session, e.g. all the
+        # wallets loaded in a daemon: there is one upstream subscription per key,
+        # and notifications are fanned out to every queue interested in it.
+        self.subscriptions = {}  # type: Dict[Any, List[asyncio.Queue]]
+        self.cache = {}  # last result, for keys in self.subscriptions
+        self._subscription_keys_by_queue = defaultdict(set)  # reverse index, for unsubscribe
+        self._inflight_subscriptions = {}  # type: Dict[Any, asyncio.Future]
+        # We can't unsubscribe from the server, so keys without subscribers stay known
+        # (notifications for them are expected), but their results are only kept in a bounded LRU.
+        self._unsubscribed_keys = set()
+        self._stale_cache = OrderedDict()
         self.default_timeout = NetworkTimeout.Generic.NORMAL
         self._msg_counter = itertools.count(start=1)
         self.interface = interface
         self.cost_hard_limit = 0  # disable aiorpcx resource limits
+        self._stale_cache_size = STALE_SUBSCRIPTION_CACHE_SIZE
+        if interface:
+            self._stale_cache_size = int(interface.network.config.get(
+                'network_stale_subscription_cache_size', STALE_SUBSCRIPTION_CACHE_SIZE))
 
     async def handle_request(self, request):
         self.maybe_log(f"--> {request}")
@@ -153,6 +255,8 @@ class NotificationSession(RPCSession):
                     self.cache[key] = result
                     for queue in self.subscriptions[key]:
                         await queue.put(request.args)
+                elif key in self._unsubscribed_keys:
+                    self._put_stale_cache(key, result)
                 else:
                     raise Exception(f'unexpected notification')
             else:
@@ -166,6 +270,9 @@ class NotificationSession(RPCSession):
         # aiorpcx. the timeout arg here in most cases should not be set
         msg_id = next(self._msg_counter)
         self.maybe_log(f"<-- {args} {kwargs} (id: {msg_id})")
+        send_time = time.time()
+        outcome = 'cancelled'
+        response = None
         try:
             # note: RPCSession.send_request raises TaskTimeout in case of a timeout.
             # TaskTimeout is a subclass of CancelledError, which is *suppressed* in TaskGroups
@@ -173,13 +280,36 @@ class NotificationSession(RPCSession):
                 super().send_request(*args, **kwargs),
                 timeout)
         except (TaskTimeout, asyncio.TimeoutError) as e:
+            outcome = 'timeout'
             raise RequestTimedOut(f'request timed out: {args} (id: {msg_id})') from e
         except CodeMessageError as e:
+            outcome = 'error'
             self.maybe_log(f"--> {repr(e)} (id: {msg_id})")
             raise
+        except Exception:
+            outcome = 'error'
+            raise
         else:
+            outcome = 'ok'
             self.maybe_log(f"--> {response} (id: {msg_id})")
             return response
+        finally:
+            self._trace_request(args, send_time=send_time, response=response, outcome=outcome)
+
+    def _trace_request(self, args, *, send_time: float, response, outcome: str) -> None:
+        if not self.interface: return
+        tracer = self.interface.request_tracer
+        if not tracer.is_enabled(): return
+        method = str(args[0]) if args else ''
+        params = args[1] if len(args) > 1 else None
+        tracer.record(RequestTrace(
+            method=method,
+            param_size=_json_size(params),
+            send_time=send_time,
+            recv_time=time.time(),
+            response_size=_json_size(response) if outcome == 'ok' else 0,
+            outcome=outcome,
+        ))
 
     def set_default_timeout(self, timeout):
         self.sent_request_timeout = timeout
@@ -188,27 +318,167 @@ class NotificationSession(RPCSession):
     async def subscribe(self, method: str, params: List, queue: asyncio.Queue):
         # note: until the cache is written for the first time,
         # each 'subscribe' call might make a request on the network.
+        # Concurrent subscribers to the same key share a single in-flight request.
         key = self.get_hashable_key_for_rpc_call(method, params)
-        self.subscriptions[key].append(queue)
+        self._add_subscriber(key, queue)
         if key in self.cache:
             result = self.cache[key]
         else:
-            result = await self.send_request(method, params)
-            self.cache[key] = result
+            fut = self._inflight_subscriptions.get(key)
+            if fut is None:
+                fut = asyncio.ensure_future(self.send_request(method, params))
+                self._inflight_subscriptions[key] = fut
+                fut.add_done_callback(functools.partial(self._on_subscription_response, key))
+            # shielded: one subscriber getting cancelled must not cancel the request for the others
+            result = await asyncio.shield(fut)
         await queue.put(params + [result])
 
+    async def subscribe_many(self, method: str, params_list: Sequence[List], queue: asyncio.Queue):
+        """Like subscribe, for many params at once. The ones that are neither
+        cached nor already being requested are sent as a single JSON-RPC batch.
+        If any of them failed, the first error is raised once the others are handled.
+        """
+        if len(params_list) == 1:
+            return await self.subscribe(method, params_list[0], queue)
+        loop = asyncio.get_event_loop()
+        # (params, cached result, or the future of the request for it)
+        pending = []  # type: List[Tuple[List, Any, Optional[asyncio.Future]]]
+        to_request = []  # type: List[Tuple[List, asyncio.Future]]
+        for params in params_list:
+            key = self.get_hashable_key_for_rpc_call(method, params)
+            self._add_subscriber(key, queue)
+            fut = None
+            # read the cache now: a concurrent unsubscribe might drop the key while we await
+            result = self.cache.get(key)
+            if key not in self.cache:
+                fut = self._inflight_subscriptions.get(key)
+                if fut is None:
+                    fut = loop.create_future()
+                    self._inflight_subscriptions[key] = fut
+                    fut.add_done_callback(functools.partial(self._on_subscription_response, key))
+                    to_request.append((params, fut))
+            pending.append((params, result, fut))
+        if to_request:
+            try:
+                results = await self.send_batch_request(method, [params for params, fut in to_request])
+            except BaseException as e:
+                for params, fut in to_request:
+                    if isinstance(e, asyncio.CancelledError):
+                        fut.cancel()
+                    else:
+                        fut.set_exception(e)
+                raise
+            for (params, fut), result in zip(to_request, results):
+                if isinstance(result, Exception):
+                    fut.set_exception(result)
+                else:
+                    fut.set_result(result)
+        first_error = None
+        for params, result, fut in pending:
+            if fut is not None:
+                try:
+                    result = await asyncio.shield(fut)
+                except Exception as e:
+                    first_error = first_error or e
+                    continue
+            await queue.put(params + [result])
+        if first_error is not None:
+            raise first_error
+
+    async def send_batch_request(self, method: str, params_list: Sequence[List], *,
+                                 timeout=None, raise_errors: bool = False) -> list:
+        """Send a JSON-RPC batch calling method once for each params.
+        Error responses are returned as exceptions, in place of their result,
+        unless raise_errors is set: then the first one is raised.
+        """
+        msg_id = next(self._msg_counter)
+        self.maybe_log(f"<-- batch of {len(params_list)} {method} (id: {msg_id})")
+        send_time = time.time()
+        outcome = 'cancelled'
+        results = None
+
+        async def send():
+            async with self.send_batch(raise_errors=raise_errors) as batch:
+                for params in params_list:
+                    batch.add_request(method, params)
+            return list(batch.results)
+        try:
+            results = await asyncio.wait_for(send(), timeout)
+        except (TaskTimeout, asyncio.TimeoutError) as e:
+            outcome = 'timeout'
+            raise RequestTimedOut(f'batch request timed out: {method} (id: {msg_id})') from e
+        except Exception:
+            outcome = 'error'
+            raise
+        else:
+            outcome = 'ok'
+            self.maybe_log(f"--> {results} (id: {msg_id})")
+            return results
+        finally:
+            self._trace_request((method, params_list), send_time=send_time, response=results, outcome=outcome)
+
+    def _add_subscriber(self, key, queue: asyncio.Queue) -> None:
+        if key not in self.subscriptions:
+            self.subscriptions[key] = []
+            self._unsubscribed_keys.discard(key)
+            if key in self._stale_cache:
+                self.cache[key] = self._stale_cache.pop(key)
+        self.subscriptions[key].append(queue)
+        self._subscription_keys_by_queue[queue].add(key)
+
+    def _on_subscription_response(self, key, fut: asyncio.Future) -> None:
+        self._inflight_subscriptions.pop(key, None)
+        if fut.cancelled() or fut.exception() is not None:
+            return
+        if key in self.subscriptions:
+            self.cache[key] = fut.result()
+        else:
+            self._put_stale_cache(key, fut.result())
+
+    def _put_stale_cache(self, key, result) -> None:
+        self._stale_cache[key] = result
+        self._stale_cache.move_to_end(key)
+        while len(self._stale_cache) > self._stale_cache_size:
+            self._stale_cache.popitem(last=False)
+
     def unsubscribe(self, queue):
         """Unsubscribe a callback to free object references to enable GC."""
         # note: we can't unsubscribe from the server, so we keep receiving
         # subsequent notifications
-        for v in self.subscriptions.values():
-            if queue in v:
-                v.remove(queue)
+        for key in self._subscription_keys_by_queue.pop(queue, ()):
+            queues = self.subscriptions.get(key)
+            if queues and queue in queues:
+                queues.remove(queue)
+            if queues is not None and not queues:
+                del self.subscriptions[key]
+                self._unsubscribed_keys.add(key)
+                if key in self.cache:
+                    self._put_stale_cache(key, self.cache.pop(key))
 
     @classmethod
     def get_hashable_key_for_rpc_call(cls, method, params):
-        """Hashable index for subscriptions and cache"""
-        return str(method) + repr(params)
+        """Hashable index for subscriptions and cache.
+        Common subscriptions get a compact bytes key: a method id byte,
+        followed by the binary scripthash if there is one.
+        """
+        method_id = _COMPACT_RPC_METHOD_IDS.get(method)
+        if method_id is not None:
+            if not params:
+                return bytes((method_id,))
+            if len(params) == 1 and isinstance(params[0], str) and len(params[0]) == 64:
+                try:
+                    key = bytes((method_id,)) + bytes.fromhex(params[0])
+                except ValueError:
+                    pass
+                else:
+                    if len(key) == 33:  # fromhex skips whitespace
+                        return key
+        key = (str(method), *params)
+        try:
+            hash(key)
+        except TypeError:
+            return str(method) + repr(params)
+        return key
 
     def maybe_log(self, msg: str) -> None:
         if not self.interface: return
@@ -334,6 +604,27 @@ class ServerAddr:
         return hash((self.host, self.port, self.protocol))
 
 
+class _ResumableSSLContext(ssl.SSLContext):
+    """SSLContext that offers the last TLS session negotiated through it
+    when opening a new connection, so that reconnecting to the same
+    server can use an abbreviated handshake.
+    """
+    tls_session = None  # type: Optional[ssl.SSLSession]
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = self.tls_session
+        return super().wrap_bio(incoming, outgoing, server_side=server_side,
+                                server_hostname=server_hostname, session=session)
+
+
+def _create_ssl_context(*, cafile: str) -> _ResumableSSLContext:
+    # same settings as ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=cafile)
+    sslc = _ResumableSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    sslc.load_verify_locations(cafile=cafile)
+    return sslc
+
+
 def _get_cert_path_for_host(*, config: 'SimpleConfig', host: str) -> str:
     filename = host
     try:
@@ -375,6 +666,11 @@ class Interface(Logger):
 
         # Dump network messages (only for this interface).  Set at runtime from the console.
         self.debug = False
+        # off by default: measuring the requests costs a json.dumps of each of them
+        trace_size = 0
+        if network.config.get('network_request_trace', False):
+            trace_size = int(network.config.get('network_request_trace_size', REQUEST_TRACE_SIZE))
+        self.request_tracer = RequestTracer(size=trace_size)
 
         self.taskgroup = SilentTaskGroup()
 
@@ -463,23 +759,43 @@ class Interface(Logger):
             return None
 
         # see if we already have cert for this server; or get it for the first time
-        ca_sslc = ssl.create_default_context(purpose=ssl.Purpose.SERVER_AUTH, cafile=ca_path)
         if not self._is_saved_ssl_cert_available():
+            ca_sslc = _create_ssl_context(cafile=ca_path)
             try:
                 await self._try_saving_ssl_cert_for_first_time(ca_sslc)
             except (OSError, ConnectError, aiorpcx.socks.SOCKSError) as e:
                 raise ErrorGettingSSLCertFromServer(e) from e
         # now we have a file saved in our certificate store
-        siz = os.stat(self.cert_path).st_size
-        if siz == 0:
+        st = os.stat(self.cert_path)
+        # contexts are reused across reconnects, as they hold the TLS session to resume
+        cache_key = (st.st_size, st.st_mtime_ns)
+        cached = self.network.tls_contexts.get(self.server)
+        if cached and cached[0] == cache_key:
+            sslc = cached[1]
+        elif st.st_size == 0:
             # CA signed cert
-            sslc = ca_sslc
+            sslc = _create_ssl_context(cafile=ca_path)
         else:
             # pinned self-signed cert
-            sslc = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=self.cert_path)
+            sslc = _create_ssl_context(cafile=self.cert_path)
             sslc.check_hostname = 0
+        self.network.tls_contexts[self.server] = (cache_key, sslc)
+        if self.proxy:
+            # resumed sessions would make our connections through the proxy linkable
+            sslc.tls_session = None
         return sslc
 
+    def _remember_tls_session(self, sslc: Optional[ssl.SSLContext]) -> None:
+        if not isinstance(sslc, _ResumableSSLContext) or self.proxy:
+            return
+        asyncio_transport = self.session.transport._asyncio_transport  # type: asyncio.BaseTransport
+        ssl_object = asyncio_transport.get_extra_info("ssl_object")  # type: Optional[ssl.SSLObject]
+        if ssl_object is None:
+            return
+        if ssl_object.session_reused:
+            self.logger.info("resumed TLS session")
+        sslc.tls_session = ssl_object.session
+
     def handle_disconnect(func):
         @functools.wraps(func)
         async def wrapper_func(self: 'Interface', *args, **kwargs):
@@ -597,10 +913,15 @@ class Interface(Logger):
         if can_return_early and index in self._requested_chunks:
             return
         self.logger.info(f"requesting chunk from height {height}")
-        size = 2016
-        if tip is not None:
-            size = min(size, tip - index * 2016 + 1)
-            size = max(size, 0)
+        size = _get_chunk_size(index, tip)
+        hexdata = await self._fetch_chunk(index, size)
+        conn = self.blockchain.connect_chunk(index, hexdata)
+        if not conn:
+            return conn, 0
+        return conn, size
+
+    async def _fetch_chunk(self, index: int, size: int) -> str:
+        """Returns the (not yet verified) hex of `size` headers starting at chunk `index`."""
         try:
             self._requested_chunks.add(index)
             res = await self.session.send_request('blockchain.block.headers', [index * 2016, size])
@@ -619,10 +940,67 @@ class Interface(Logger):
             raise RequestCorrupted(f"server uses too low 'max' count for block.headers: {res['max']} < 2016")
         if res['count'] != size:
             raise RequestCorrupted(f"expected {size} headers but only got {res['count']}")
-        conn = self.blockchain.connect_chunk(index, res['hex'])
-        if not conn:
-            return conn, 0
-        return conn, res['count']
+        return res['hex']
+
+    def _get_chunk_sources(self, tip: int) -> List['Interface']:
+        """Interfaces that can serve headers up to tip, starting with ourselves.
+        Only servers following our chain are used: beyond the checkpoints, a
+        chunk of a fork would connect just as well.
+        """
+        with self.network.interfaces_lock:
+            others = list(self.network.interfaces.values())
+        others = [iface for iface in others
+                  if iface is not self and iface.session and iface.tip >= tip
+                  and iface.blockchain == self.blockchain]
+        return [self] + others
+
+    async def _fetch_chunk_via(self, source: 'Interface', index: int, tip: int) -> Tuple['Interface', str]:
+        size = _get_chunk_size(index, tip)
+        if source is not self:
+            try:
+                return source, await source._fetch_chunk(index, size)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.info(f"failed to get chunk {index} from {source.server}: {repr(e)}")
+        return self, await self._fetch_chunk(index, size)
+
+    async def _request_chunks(self, height: int, tip: int) -> Tuple[bool, int]:
+        """Fetches and connects the chunks from height up to tip.
+        Up to 'header_sync_window' chunks are downloaded concurrently, spread over
+        the connected interfaces, but they are verified and saved in order.
+        Returns whether all chunks could be connected, and the height to continue from.
+        """
+        first_index, last_index = height // 2016, tip // 2016
+        window = max(1, int(self.network.config.get('header_sync_window', 8)))
+        if window == 1 or first_index == last_index:
+            could_connect, num_headers = await self.request_chunk(height, tip)
+            if not could_connect:
+                return False, height
+            return True, first_index * 2016 + num_headers
+        self.logger.info(f"requesting chunks {first_index}-{last_index} (window {window})")
+        sources = self._get_chunk_sources(tip)
+        fetch_tasks = {}  # type: Dict[int, asyncio.Future]
+        next_index = first_index
+        try:
+            for index in range(first_index, last_index + 1):
+                while next_index <= last_index and next_index < index + window:
+                    source = sources[(next_index - first_index) % len(sources)]
+                    fetch_tasks[next_index] = asyncio.ensure_future(self._fetch_chunk_via(source, next_index, tip))
+                    next_index += 1
+                source, hexdata = await fetch_tasks.pop(index)
+                could_connect = self.blockchain.connect_chunk(index, hexdata)
+                if not could_connect and source is not self:
+                    # the other server might be on a different chain; ask our own server
+                    hexdata = await self._fetch_chunk(index, _get_chunk_size(index, tip))
+                    could_connect = self.blockchain.connect_chunk(index, hexdata)
+                if not could_connect:
+                    return False, max(height, index * 2016)
+                util.trigger_callback('network_updated')
+        finally:
+            for task in fetch_tasks.values():
+                task.cancel()
+        return True, tip + 1
 
     def is_main_server(self) -> bool:
         return (self.network.interface == self or
@@ -641,6 +1019,7 @@ class Interface(Logger):
                 raise GracefulDisconnect(e)  # probably 'unsupported protocol version'
             if exit_early:
                 return
+            self._remember_tls_session(sslc)
             if ver[1] != version.PROTOCOL_VERSION:
                 raise GracefulDisconnect(f'server violated protocol-version-negotiation. '
                                          f'we asked for {version.PROTOCOL_VERSION!r}, they sent {ver[1]!r}')
@@ -740,14 +1119,14 @@ class Interface(Logger):
         while last is None or height <= next_height:
             prev_last, prev_height = last, height
             if next_height > height + 10:
-                could_connect, num_headers = await self.request_chunk(height, next_height)
+                could_connect, new_height = await self._request_chunks(height, next_height)
                 if not could_connect:
-                    if height <= constants.net.max_checkpoint():
+                    if new_height <= constants.net.max_checkpoint():
                         raise GracefulDisconnect('server chain conflicts with checkpoints or genesis')
-                    last, height = await self.step(height)
+                    last, height = await self.step(new_height)
                     continue
                 util.trigger_callback('network_updated')
-                height = (height // 2016 * 2016) + num_headers
+                height = new_height
                 assert height <= next_height+1, (height, self.tip)
                 last = 'catchup'
             else:
@@ -916,6 +1295,29 @@ class Interface(Logger):
         # do request
         res = await self.session.send_request('blockchain.transaction.get_merkle', [tx_hash, tx_height])
         # check response
+        self._assert_valid_merkle_response(res)
+        return res
+
+    async def get_merkle_for_transactions(self, txs: Sequence[Tuple[str, int]]) -> List[Union[dict, Exception]]:
+        """Like get_merkle_for_transaction, for many (tx_hash, tx_height) in a
+        single JSON-RPC batch. Error responses are returned in place of their result.
+        """
+        for tx_hash, tx_height in txs:
+            if not is_hash256_str(tx_hash):
+                raise Exception(f"{repr(tx_hash)} is not a txid")
+            if not is_non_negative_integer(tx_height):
+                raise Exception(f"{repr(tx_height)} is not a block height")
+        results = await self.session.send_batch_request(
+            'blockchain.transaction.get_merkle', [[tx_hash, tx_height] for tx_hash, tx_height in txs])
+        if len(results) != len(txs):
+            raise RequestCorrupted(f'expected {len(txs)} results, got {len(results)}')
+        for res in results:
+            if not isinstance(res, Exception):
+                self._assert_valid_merkle_response(res)
+        return results
+
+    @classmethod
+    def _assert_valid_merkle_response(cls, res: Any) -> None:
         block_height = assert_dict_contains_field(res, field_name='block_height')
         merkle = assert_dict_contains_field(res, field_name='merkle')
         pos = assert_dict_contains_field(res, field_name='pos')
@@ -925,13 +1327,31 @@ class Interface(Logger):
         assert_list_or_tuple(merkle)
         for item in merkle:
             assert_hash256_str(item)
-        return res
 
     async def get_transaction(self, tx_hash: str, *, timeout=None) -> str:
         if not is_hash256_str(tx_hash):
             raise Exception(f"{repr(tx_hash)} is not a txid")
         raw = await self.session.send_request('blockchain.transaction.get', [tx_hash], timeout=timeout)
-        # validate response
+        self._deserialize_transaction_response(tx_hash, raw)
+        return raw
+
+    async def get_transactions(self, tx_hashes: Sequence[str]) -> List[Union[Transaction, Exception]]:
+        """Like get_transaction, for many txids in a single JSON-RPC batch.
+        Returns the validated transactions, already deserialized and with their txid cached.
+        Error responses are returned in place of their result.
+        """
+        for tx_hash in tx_hashes:
+            if not is_hash256_str(tx_hash):
+                raise Exception(f"{repr(tx_hash)} is not a txid")
+        results = await self.session.send_batch_request(
+            'blockchain.transaction.get', [[tx_hash] for tx_hash in tx_hashes])
+        if len(results) != len(tx_hashes):
+            raise RequestCorrupted(f'expected {len(tx_hashes)} results, got {len(results)}')
+        return [res if isinstance(res, Exception) else self._deserialize_transaction_response(tx_hash, res)
+                for tx_hash, res in zip(tx_hashes, results)]
+
+    @classmethod
+    def _deserialize_transaction_response(cls, tx_hash: str, raw: Any) -> Transaction:
         if not is_hex_str(raw):
             raise RequestCorrupted(f"received garbage (non-hex) as tx data (txid {tx_hash}): {raw!r}")
         tx = Transaction(raw)
@@ -941,14 +1361,34 @@ class Interface(Logger):
             raise RequestCorrupted(f"cannot deserialize received transaction (txid {tx_hash})") from e
         if tx.txid() != tx_hash:
             raise RequestCorrupted(f"received tx does not match expected txid {tx_hash} (got {tx.txid()})")
-        return raw
+        return tx
 
     async def get_history_for_scripthash(self, sh: str) -> List[dict]:
         if not is_hash256_str(sh):
             raise Exception(f"{repr(sh)} is not a scripthash")
         # do request
         res = await self.session.send_request('blockchain.scripthash.get_history', [sh])
-        # check response
+        self._assert_valid_history_response(sh, res)
+        return res
+
+    async def get_history_for_scripthashes(self, shs: Sequence[str]) -> List[Union[List[dict], Exception]]:
+        """Like get_history_for_scripthash, for many scripthashes in a single
+        JSON-RPC batch. Error responses are returned in place of their result.
+        """
+        for sh in shs:
+            if not is_hash256_str(sh):
+                raise Exception(f"{repr(sh)} is not a scripthash")
+        results = await self.session.send_batch_request(
+            'blockchain.scripthash.get_history', [[sh] for sh in shs])
+        if len(results) != len(shs):
+            raise RequestCorrupted(f'expected {len(shs)} results, got {len(results)}')
+        for sh, res in zip(shs, results):
+            if not isinstance(res, Exception):
+                self._assert_valid_history_response(sh, res)
+        return results
+
+    @classmethod
+    def _assert_valid_history_response(cls, sh: str, res: Any) -> None:
         assert_list_or_tuple(res)
         prev_height = 1
         for tx_item in res:
@@ -971,13 +1411,9 @@ class Interface(Logger):
             # a recently mined tx could be included in both last block and mempool?
             # Still, it's simplest to just disregard the response.
             raise RequestCorrupted(f"server history has non-unique txids for sh={sh}")
-        return res
 
     async def send_batch_request(self, method, params: List[List[Any]], raise_errors: bool = False):
-        async with self.session.send_batch(raise_errors=raise_errors) as batch:
-            for param in params:
-                batch.add_request(method, param)
-        return batch.results
+        return await self.session.send_batch_request(method, params, raise_errors=raise_errors)
 
     async def listunspent_for_scripthash(self, sh: str) -> List[dict]:
         if not is_hash256_str(sh):
@@ -1195,6 +1631,15 @@ class Interface(Logger):
         return res
 
 
+def _get_chunk_size(index: int, tip: Optional[int]) -> int:
+    """Number of headers to request for chunk `index`, not going beyond tip."""
+    size = 2016
+    if tip is not None:
+        size = min(size, tip - index * 2016 + 1)
+        size = max(size, 0)
+    return size
+
+
 def _assert_header_does_not_check_against_any_chain(header: dict) -> None:
     chain_bad = blockchain.check_header(header) if 'mock' not in header else header['mock']['check'](header)
     if chain_bad:
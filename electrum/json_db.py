@@ -25,6 +25,7 @@
 import threading
 import copy
 import json
+from typing import Optional, Dict, Tuple, Sequence
 
 from . import util
 from .logging import Logger
@@ -48,14 +49,19 @@ def locked(func):
 class StoredObject:
 
     db = None
+    _path = None
 
     def __setattr__(self, key, value):
         if self.db:
-            self.db.set_modified(True)
+            if self._path is not None:
+                self.db.record_change(self._path)
+            else:
+                self.db.set_modified(True)
         object.__setattr__(self, key, value)
 
-    def set_db(self, db):
+    def set_db(self, db, path=None):
         self.db = db
+        object.__setattr__(self, '_path', path)
 
     def to_json(self):
         d = dict(vars(self))
@@ -74,9 +80,10 @@ class StoredDict(dict):
         self.db = db
         self.lock = self.db.lock if self.db else threading.RLock()
         self.path = path
-        # recursively convert dicts to StoredDict
+        # recursively convert dicts to StoredDict.
+        # no change is recorded here: the parent records its own path.
         for k, v in list(data.items()):
-            self.__setitem__(k, v)
+            self._set_item(k, v)
 
     def convert_key(self, key):
         """Convert int keys to str keys, as only those are allowed in json."""
@@ -85,6 +92,20 @@ class StoredDict(dict):
         #             suddenly the keys are str...
         return str(int(key)) if isinstance(key, int) else key
 
+    def _record_change(self, key):
+        if self.db:
+            self.db.record_change(self.path + [key])
+
+    def _attach(self, db, path):
+        """Moves this dict (and its children) to 'path' of 'db'."""
+        self.db = db
+        self.path = path
+        for k, v in self.items():
+            if isinstance(v, (StoredDict, StoredList)):
+                v._attach(db, path + [k])
+            elif isinstance(v, StoredObject):
+                v.set_db(db, path + [k])
+
     @locked
     def __setitem__(self, key, v):
         key = self.convert_key(key)
@@ -92,12 +113,14 @@ class StoredDict(dict):
         # early return to prevent unnecessary disk writes
         if not is_new and self[key] == v:
             return
+        self._set_item(key, v)
+        self._record_change(key)
+
+    def _set_item(self, key, v):
+        key = self.convert_key(key)
         # recursively set db and path
         if isinstance(v, StoredDict):
-            v.db = self.db
-            v.path = self.path + [key]
-            for k, vv in v.items():
-                v[k] = vv
+            v._attach(self.db, self.path + [key])
         # recursively convert dict to StoredDict.
         # _convert_dict is called breadth-first
         elif isinstance(v, dict):
@@ -105,24 +128,25 @@ class StoredDict(dict):
                 v = self.db._convert_dict(self.path, key, v)
             if not self.db or self.db._should_convert_to_stored_dict(key):
                 v = StoredDict(v, self.db, self.path + [key])
+        elif isinstance(v, StoredList):
+            v._attach(self.db, self.path + [key])
+        elif isinstance(v, list):
+            v = StoredList(v, self.db, self.path + [key])
         # convert_value is called depth-first
         if isinstance(v, dict) or isinstance(v, str):
             if self.db:
                 v = self.db._convert_value(self.path, key, v)
         # set parent of StoredObject
         if isinstance(v, StoredObject):
-            v.set_db(self.db)
+            v.set_db(self.db, self.path + [key])
         # set item
         dict.__setitem__(self, key, v)
-        if self.db:
-            self.db.set_modified(True)
 
     @locked
     def __delitem__(self, key):
         key = self.convert_key(key)
         dict.__delitem__(self, key)
-        if self.db:
-            self.db.set_modified(True)
+        self._record_change(key)
 
     @locked
     def __getitem__(self, key):
@@ -141,8 +165,7 @@ class StoredDict(dict):
             r = dict.pop(self, key)
         else:
             r = dict.pop(self, key, v)
-        if self.db:
-            self.db.set_modified(True)
+        self._record_change(key)
         return r
 
     @locked
@@ -150,7 +173,109 @@ class StoredDict(dict):
         key = self.convert_key(key)
         return dict.get(self, key, default)
 
+    @locked
+    def clear(self):
+        dict.clear(self)
+        if self.db:
+            self.db.record_change(self.path)
+
 
+class StoredList(list):
+    """List stored in a StoredDict.
+
+    Appends are recorded as such, so that the journal does not have to
+    repeat the whole list (e.g. the receiving addresses) for each new item.
+    """
+
+    __slots__ = ('db', 'lock', 'path')
+
+    def __init__(self, data, db, path):
+        list.__init__(self, data)
+        self.db = db
+        self.lock = self.db.lock if self.db else threading.RLock()
+        self.path = path
+
+    def _attach(self, db, path):
+        self.db = db
+        if db:
+            self.lock = db.lock
+        self.path = path
+
+    def _record_change(self, *, appended: bool = False):
+        if self.db:
+            self.db.record_change(self.path, list_len=len(self) if appended else None)
+
+    # copies are plain lists: they must not record changes to our path, nor share our lock
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        result = []
+        memo[id(self)] = result
+        result.extend(copy.deepcopy(item, memo) for item in self)
+        return result
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+    # note: the change is recorded and made under the lock, so that a write of
+    #       the db can not happen in between (e.g. after an append is recorded)
+
+    @locked
+    def append(self, item):
+        self._record_change(appended=True)
+        list.append(self, item)
+
+    @locked
+    def extend(self, items):
+        self._record_change(appended=True)
+        list.extend(self, items)
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    @locked
+    def insert(self, index, item):
+        list.insert(self, index, item)
+        self._record_change()
+
+    @locked
+    def remove(self, item):
+        list.remove(self, item)
+        self._record_change()
+
+    @locked
+    def pop(self, *args):
+        r = list.pop(self, *args)
+        self._record_change()
+        return r
+
+    @locked
+    def clear(self):
+        list.clear(self)
+        self._record_change()
+
+    @locked
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self._record_change()
+
+    @locked
+    def reverse(self):
+        list.reverse(self)
+        self._record_change()
+
+    @locked
+    def __setitem__(self, index, item):
+        list.__setitem__(self, index, item)
+        self._record_change()
+
+    @locked
+    def __delitem__(self, index):
+        list.__delitem__(self, index)
+        self._record_change()
 
 
 class JsonDB(Logger):
@@ -160,14 +285,85 @@ class JsonDB(Logger):
         self.lock = threading.RLock()
         self.data = data
         self._modified = False
+        self._use_journal = False
+        # path -> None, or the length of the list at that path before it was appended to.
+        # None if the next write has to be a full snapshot.
+        self._journal = None  # type: Optional[Dict[Tuple[str, ...], Optional[int]]]
 
     def set_modified(self, b):
         with self.lock:
             self._modified = b
+            if b:
+                # we do not know what changed
+                self._journal = None
 
     def modified(self):
         return self._modified
 
+    def record_change(self, path: Sequence[str], *, list_len: int = None) -> None:
+        """Marks the value at 'path' as changed.
+        'list_len': the value is a list that is only being appended to,
+                    and this was its length before.
+        """
+        with self.lock:
+            self._modified = True
+            if self._journal is None:
+                return
+            if not path:
+                self._journal = None
+                return
+            path = tuple(path)
+            if path not in self._journal:
+                self._journal[path] = list_len
+            elif list_len is None:
+                self._journal[path] = None
+
+    def enable_journal(self) -> None:
+        """Writes will only append the changes, see dump_journal."""
+        with self.lock:
+            self._use_journal = True
+            if not self._modified:
+                # whatever we were loaded from is the snapshot
+                self._journal = {}
+
+    def is_journal_available(self) -> bool:
+        return self._journal is not None
+
+    def reset_journal(self) -> None:
+        """To be called once a full snapshot has been written."""
+        with self.lock:
+            self._journal = {} if self._use_journal else None
+
+    @locked
+    def dump_journal(self) -> Optional[str]:
+        """Serializes the changes since the last write, as a list of records:
+            ["set", path, value], ["del", path], ["extend", path, items]
+        Values are taken from the current state, so a path is only listed once.
+        Returns None if nothing changed.
+        """
+        records = []
+        written = set()
+        for path in sorted(self._journal, key=len):
+            if any(path[:i] in written for i in range(len(path))):
+                continue  # covered by a parent
+            written.add(path)
+            value = self.data
+            for key in path:
+                if not isinstance(value, dict) or key not in value:
+                    records.append(['del', path])
+                    break
+                value = dict.__getitem__(value, key)
+            else:
+                list_len = self._journal[path]
+                if list_len is not None and isinstance(value, list) and len(value) >= list_len:
+                    records.append(['extend', path, value[list_len:]])
+                else:
+                    records.append(['set', path, value])
+        self._journal.clear()
+        if not records:
+            return None
+        return json.dumps(records, cls=JsonDBJsonEncoder)
+
     @locked
     def get(self, key, default=None):
         v = self.data.get(key)
@@ -187,6 +383,9 @@ class JsonDB(Logger):
             if self.data.get(key) != value:
                 self.data[key] = copy.deepcopy(value)
                 return True
+            elif isinstance(value, (dict, list)) and not isinstance(self.data.get(key), (StoredDict, StoredList)):
+                # not tracked (e.g. keystores), so it might have been changed in place
+                self.record_change([key])
         elif key in self.data:
             self.data.pop(key)
             return True
@@ -206,3 +405,23 @@ class JsonDB(Logger):
 
     def _should_convert_to_stored_dict(self, key) -> bool:
         return True
+
+
+def apply_journal_record(data: dict, record: list) -> None:
+    """Applies a record of JsonDB.dump_journal to the deserialized json."""
+    op, path = record[0], record[1]
+    if not path:
+        raise ValueError('empty journal path')
+    for key in path[:-1]:
+        data = data.get(key)
+        if not isinstance(data, dict):
+            return  # the parent is gone, and so is the value
+    key = path[-1]
+    if op == 'set':
+        data[key] = record[2]
+    elif op == 'del':
+        data.pop(key, None)
+    elif op == 'extend':
+        data.setdefault(key, []).extend(record[2])
+    else:
+        raise ValueError(f'unknown journal record: {op!r}')
@@ -378,6 +378,12 @@ class MasterPublicKeyMixin(ABC):
         """
         pass
 
+    def derive_pubkey_range(self, for_change: int, start: int, stop: int) -> List[bytes]:
+        """Returns the pubkeys at paths (for_change, n) for start <= n < stop.
+        May raise CannotDerivePubkey.
+        """
+        return [self.derive_pubkey(for_change, n) for n in range(start, stop)]
+
     def get_pubkey_derivation(
             self,
             pubkey: bytes,
@@ -439,9 +445,8 @@ class Xpub(MasterPublicKeyMixin):
 
     def __init__(self, *, derivation_prefix: str = None, root_fingerprint: str = None):
         self.xpub = None
-        self.xpub_receive = None
-        self.xpub_change = None
         self._xpub_bip32_node = None  # type: Optional[BIP32Node]
+        self._chain_nodes = {}  # type: Dict[int, Tuple[bytes, bytes]]  # for_change -> (pubkey, chaincode)
 
         # "key origin" info (subclass should persist these):
         self._derivation_prefix = derivation_prefix  # type: Optional[str]
@@ -523,20 +528,25 @@ class Xpub(MasterPublicKeyMixin):
             self._derivation_prefix = derivation_prefix
         self.is_requesting_to_be_rewritten_to_wallet_file = True
 
-    @lru_cache(maxsize=None)
-    def derive_pubkey(self, for_change: int, n: int) -> bytes:
+    def get_chain_node(self, for_change: int) -> Tuple[bytes, bytes]:
+        """Returns (pubkey, chaincode) of the receiving (0) or change (1) chain."""
         for_change = int(for_change)
         if for_change not in (0, 1):
             raise CannotDerivePubkey("forbidden path")
-        xpub = self.xpub_change if for_change else self.xpub_receive
-        if xpub is None:
-            rootnode = self.get_bip32_node_for_xpub()
-            xpub = rootnode.subkey_at_public_derivation((for_change,)).to_xpub()
-            if for_change:
-                self.xpub_change = xpub
-            else:
-                self.xpub_receive = xpub
-        return self.get_pubkey_from_xpub(xpub, (n,))
+        chain_node = self._chain_nodes.get(for_change)
+        if chain_node is None:
+            node = self.get_bip32_node_for_xpub().subkey_at_public_derivation((for_change,))
+            chain_node = node.eckey.get_public_key_bytes(compressed=True), node.chaincode
+            self._chain_nodes[for_change] = chain_node
+        return chain_node
+
+    @lru_cache(maxsize=None)
+    def derive_pubkey(self, for_change: int, n: int) -> bytes:
+        return self.derive_pubkey_range(for_change, n, n + 1)[0]
+
+    def derive_pubkey_range(self, for_change: int, start: int, stop: int) -> List[bytes]:
+        pubkey, chaincode = self.get_chain_node(for_change)
+        return bip32.CKD_pub_range(pubkey, chaincode, start, stop)
 
     @classmethod
     def get_pubkey_from_xpub(self, xpub: str, sequence) -> bytes:
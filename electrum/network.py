@@ -26,13 +26,15 @@ import queue
 import os
 import random
 import re
-from collections import defaultdict
+from collections import defaultdict, deque
 import threading
 import socket
+import ssl
 import json
 import sys
 import asyncio
-from typing import NamedTuple, Optional, Sequence, List, Dict, Tuple, TYPE_CHECKING, Iterable, Set, Any
+from typing import (NamedTuple, Optional, Sequence, List, Dict, Tuple, TYPE_CHECKING, Iterable, Set, Any,
+                    Callable, Awaitable, Deque, Union)
 import traceback
 import concurrent
 from concurrent import futures
@@ -77,6 +79,8 @@ _logger = get_logger(__name__)
 NUM_TARGET_CONNECTED_SERVERS = 10
 NUM_STICKY_SERVERS = 4
 NUM_RECENT_SERVERS = 20
+NUM_STANDBY_SERVERS = 2
+SERVER_INFO_CACHE_TTL = 3600  # seconds
 
 
 def parse_servers(result: Sequence[Tuple[str, str, List[str]]]) -> Dict[str, dict]:
@@ -236,6 +240,106 @@ class UntrustedServerReturnedError(NetworkException):
                 f"[DO NOT TRUST THIS MESSAGE] original_exception: {repr(self.original_exception)}>")
 
 
+class RequestHedger:
+    """Tail-latency reduction for idempotent requests.
+
+    If the primary request has not been answered within the p95 latency
+    observed for that kind of request, the same request is also sent to a
+    secondary server, and whichever valid answer arrives first is used.
+    The fraction of requests that get hedged is capped by `budget`, and
+    nothing is hedged before MIN_SAMPLES latencies have been observed.
+    """
+
+    MIN_SAMPLES = 20
+
+    def __init__(self, *, budget: float = 0.05, min_delay: float = 0.05,
+                 default_delay: float = 2.0, window: int = 200):
+        self.budget = budget
+        self.min_delay = min_delay
+        self.default_delay = default_delay
+        self._window = window
+        self._latencies = {}  # type: Dict[str, Deque[float]]
+        self.num_requests = 0
+        self.num_hedged = 0
+
+    def record_latency(self, key: str, seconds: float) -> None:
+        samples = self._latencies.get(key)
+        if samples is None:
+            samples = self._latencies[key] = deque(maxlen=self._window)
+        samples.append(seconds)
+
+    def get_hedge_delay(self, key: str) -> float:
+        """Returns how long to wait for the primary before hedging."""
+        samples = self._latencies.get(key)
+        if not samples or len(samples) < self.MIN_SAMPLES:
+            return self.default_delay
+        ordered = sorted(samples)
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+        return max(self.min_delay, p95)
+
+    def can_hedge(self, key: str) -> bool:
+        # without enough samples, the p95 would be a guess
+        samples = self._latencies.get(key)
+        if not samples or len(samples) < self.MIN_SAMPLES:
+            return False
+        return self.num_hedged < self.budget * self.num_requests
+
+    def _start_request(self, key: str, request: Callable[[], Awaitable]) -> Tuple[asyncio.Future, float]:
+        start = time.monotonic()
+        task = asyncio.ensure_future(request())
+        def on_done(t):
+            if not t.cancelled() and t.exception() is None:
+                self.record_latency(key, time.monotonic() - start)
+        task.add_done_callback(on_done)
+        return task, start
+
+    def _cancel_loser(self, key: str, task: asyncio.Future, start: float) -> None:
+        # losers are recorded too, otherwise slow answers would never be sampled:
+        # the time they ran so far is a lower bound of their latency
+        if not task.done():
+            self.record_latency(key, time.monotonic() - start)
+            task.cancel()
+
+    async def run(self, key: str, primary: Callable[[], Awaitable],
+                  pick_secondary: Callable[[], Optional[Callable[[], Awaitable]]]) -> Any:
+        """Runs primary(), hedging it with the request returned by
+        pick_secondary() if it is slow. Errors of the primary propagate;
+        errors of the secondary are ignored.
+        The request that loses the race is cancelled.
+        """
+        self.num_requests += 1
+        primary_task, primary_start = self._start_request(key, primary)
+        secondary_task = None
+        try:
+            if not self.can_hedge(key):
+                return await primary_task
+            done, _ = await asyncio.wait([primary_task], timeout=self.get_hedge_delay(key))
+            secondary = None
+            if not done and self.can_hedge(key):
+                secondary = pick_secondary()
+            if secondary is None:
+                return await primary_task
+            self.num_hedged += 1
+            secondary_task, secondary_start = self._start_request(key, secondary)
+            pending = {primary_task, secondary_task}
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                if primary_task in done:
+                    self._cancel_loser(key, secondary_task, secondary_start)
+                    return primary_task.result()
+                elif secondary_task.cancelled() or secondary_task.exception() is not None:
+                    # the secondary is only a best effort; keep waiting for the primary
+                    continue
+                else:
+                    self._cancel_loser(key, primary_task, primary_start)
+                    return secondary_task.result()
+        except BaseException:
+            primary_task.cancel()
+            if secondary_task:
+                secondary_task.cancel()
+            raise
+
+
 _INSTANCE = None
 
 
@@ -288,6 +392,9 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
 
         blockchain.read_blockchains(self.config)
         blockchain.init_headers_file_for_best_chain()
+        headers_snapshot = self.config.get('headers_snapshot')
+        if headers_snapshot and os.path.exists(headers_snapshot):
+            blockchain.import_headers_snapshot(headers_snapshot)
         self.logger.info(f"blockchains {list(map(lambda b: b.forkpoint, blockchain.blockchains.values()))}")
         self._blockchain_preferred_block = self.config.get('blockchain_preferred_block', None)  # type: Dict[str, Any]
         if self._blockchain_preferred_block is None:
@@ -320,11 +427,19 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
 
         self.server_peers = {}  # returned by interface (servers that the main interface knows about)
         self._recent_servers = self._read_recent_servers()  # note: needs self.recent_servers_lock
+        # static info (banner, peers, ...) of servers we recently used as main interface
+        self._server_info_cache = self._read_server_info_cache()  # type: Dict[str, dict]
+        # server -> (cert file signature, SSLContext); reused so that TLS sessions can be resumed
+        self.tls_contexts = {}  # type: Dict[ServerAddr, Tuple[Any, ssl.SSLContext]]
 
         self.banner = ''
         self.donation_address = ''
         self.relay_fee = None  # type: Optional[int]
 
+        # opt-in: duplicate slow latency-critical requests to a second server
+        self.request_hedger = RequestHedger(budget=self.config.get('hedge_requests_budget', 0.05))
+        self._proof_verification_pool = None  # type: Optional[concurrent.futures.ProcessPoolExecutor]
+
         dir_path = os.path.join(self.config.path, 'certs')
         util.make_dir(dir_path)
 
@@ -387,6 +502,17 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
             self.channel_db = None
             self.path_finder = None
 
+    def get_proof_verification_pool(self) -> Optional[concurrent.futures.ProcessPoolExecutor]:
+        """Process pool shared by the SPV jobs of all wallets to verify large
+        backlogs of merkle proofs, if enabled with 'spv_verification_processes'.
+        """
+        num_processes = int(self.config.get('spv_verification_processes', 0))
+        if num_processes <= 0:
+            return None
+        if self._proof_verification_pool is None:
+            self._proof_verification_pool = util.create_process_pool(num_processes)
+        return self._proof_verification_pool
+
     def run_from_another_thread(self, coro, *, timeout=None):
         assert self._loop_thread != threading.current_thread(), 'must not be called from network thread'
         fut = asyncio.run_coroutine_threadsafe(coro, self.asyncio_loop)
@@ -426,6 +552,52 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
         except:
             pass
 
+    def _read_server_info_cache(self) -> Dict[str, dict]:
+        if not self.config.path:
+            return {}
+        path = os.path.join(self.config.path, "server_info_cache")
+        try:
+            with open(path, "r", encoding='utf-8') as f:
+                data = json.loads(f.read())
+            if not isinstance(data, dict):
+                return {}
+        except:
+            return {}
+        return {k: v for k, v in data.items() if self._is_valid_server_info_entry(v)}
+
+    @staticmethod
+    def _is_valid_server_info_entry(info) -> bool:
+        # the file might have been edited or corrupted; the rest of the entry is checked before use
+        if not isinstance(info, dict):
+            return False
+        timestamp = info.get('timestamp')
+        return isinstance(timestamp, (int, float)) and not isinstance(timestamp, bool)
+
+    def _save_server_info_cache(self):
+        if not self.config.path:
+            return
+        path = os.path.join(self.config.path, "server_info_cache")
+        now = time.time()
+        ttl = self.config.get('server_info_cache_ttl', SERVER_INFO_CACHE_TTL)
+        self._server_info_cache = {k: v for k, v in self._server_info_cache.items()
+                                   if self._is_valid_server_info_entry(v)
+                                   and now - v['timestamp'] < ttl}
+        s = json.dumps(self._server_info_cache, indent=4, sort_keys=True)
+        try:
+            with open(path, "w", encoding='utf-8') as f:
+                f.write(s)
+        except:
+            pass
+
+    def _get_cached_server_info(self, server: ServerAddr) -> Optional[dict]:
+        ttl = self.config.get('server_info_cache_ttl', SERVER_INFO_CACHE_TTL)
+        info = self._server_info_cache.get(str(server))
+        if not ttl or not self._is_valid_server_info_entry(info):
+            return None
+        if not (0 <= time.time() - info['timestamp'] < ttl):
+            return None
+        return info
+
     async def _server_is_lagging(self) -> bool:
         sh = self.get_server_height()
         if not sh:
@@ -452,21 +624,29 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
         await interface.ready
         session = interface.session
 
+        cached_info = self._get_cached_server_info(interface.server)
+        if cached_info is not None:
+            try:
+                self._apply_server_info(cached_info)
+            except Exception as e:
+                self.logger.info(f"ignoring cached server info for {interface.server}: {repr(e)}")
+            else:
+                self.logger.info(f"using cached server info for {interface.server}")
+                await self._request_fee_estimates(interface)
+                return
+
+        info = {}
         async def get_banner():
-            self.banner = await interface.get_server_banner()
-            self.notify('banner')
+            info['banner'] = await interface.get_server_banner()
         async def get_donation_address():
-            self.donation_address = await interface.get_donation_address()
+            info['donation_address'] = await interface.get_donation_address()
         async def get_server_peers():
             server_peers = await session.send_request('server.peers.subscribe')
             random.shuffle(server_peers)
             max_accepted_peers = len(constants.net.DEFAULT_SERVERS) + NUM_RECENT_SERVERS
-            server_peers = server_peers[:max_accepted_peers]
-            # note that 'parse_servers' also validates the data (which is untrusted input!)
-            self.server_peers = parse_servers(server_peers)
-            self.notify('servers')
+            info['peers'] = server_peers[:max_accepted_peers]
         async def get_relay_fee():
-            self.relay_fee = await interface.get_relay_fee()
+            info['relay_fee'] = await interface.get_relay_fee()
 
         async with TaskGroup() as group:
             await group.spawn(get_banner)
@@ -474,6 +654,25 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
             await group.spawn(get_server_peers)
             await group.spawn(get_relay_fee)
             await group.spawn(self._request_fee_estimates(interface))
+        self._apply_server_info(info)
+        info['timestamp'] = time.time()
+        self._server_info_cache[str(interface.server)] = info
+        self._save_server_info_cache()
+
+    def _apply_server_info(self, info: dict) -> None:
+        # note that 'parse_servers' also validates the data (which is untrusted input!)
+        server_peers = parse_servers(info['peers'])
+        relay_fee = info['relay_fee']
+        if not is_non_negative_integer(relay_fee):
+            raise RequestCorrupted(f'{relay_fee!r} should be a non-negative integer')
+        if not isinstance(info['banner'], str) or not isinstance(info['donation_address'], str):
+            raise RequestCorrupted('banner and donation address should be str')
+        self.banner = info['banner']
+        self.notify('banner')
+        self.donation_address = info['donation_address']
+        self.server_peers = server_peers
+        self.notify('servers')
+        self.relay_fee = relay_fee
 
     async def _request_fee_estimates(self, interface):
         self.config.requested_fee_estimates()
@@ -518,6 +717,26 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
         with self.interfaces_lock:
             return list(self.interfaces)
 
+    def get_request_stats(self) -> Dict[str, dict]:
+        """Per-server summary of recently traced requests."""
+        with self.interfaces_lock: interfaces = list(self.interfaces.values())
+        return {str(iface.server): {
+                    'main': iface == self.interface,
+                    'requests': iface.request_tracer.get_summary(),
+                } for iface in interfaces}
+
+    def get_chrome_trace(self) -> dict:
+        """Recently traced requests of all connected interfaces, in the
+        Chrome trace event format (load it in chrome://tracing or Perfetto).
+        """
+        with self.interfaces_lock: interfaces = list(self.interfaces.values())
+        events = []
+        for tid, iface in enumerate(interfaces, start=1):
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid,
+                           'args': {'name': str(iface.server)}})
+            events.extend(iface.request_tracer.get_chrome_trace_events(pid=1, tid=tid))
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
     def get_fee_estimates(self):
         from statistics import median
         from .simple_config import FEE_ETA_TARGETS
@@ -645,8 +864,53 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
         self.oneserver = oneserver
         self.num_server = NUM_TARGET_CONNECTED_SERVERS if not oneserver else 0
 
+    def _get_standby_interfaces(self) -> List[Interface]:
+        """Connected interfaces, other than the main one, that are ready to take
+        over immediately: on our chain, and synced to its tip.
+        """
+        chain = self.blockchain()
+        local_height = chain.height()
+        with self.interfaces_lock: interfaces = list(self.interfaces.values())
+        return [iface for iface in interfaces
+                if iface != self.interface
+                and iface.ready.done() and not iface.ready.cancelled()
+                and iface.blockchain == chain
+                and iface.tip >= local_height]
+
+    def get_num_standby_servers(self) -> int:
+        if self.oneserver:
+            return 0
+        return int(self.config.get('num_standby_servers', NUM_STANDBY_SERVERS))
+
+    def _get_num_target_interfaces(self) -> int:
+        if not self.num_server:
+            return 0
+        num_standby = self.get_num_standby_servers()
+        # connections that are lagging or on another chain cannot take over,
+        # so a few extra ones are made until there are enough warm standbys
+        num_missing = num_standby - len(self._get_standby_interfaces())
+        return max(self.num_server, num_standby + 1) + max(0, num_missing)
+
+    async def _failover_to_standby_interface(self) -> bool:
+        """Immediately switch to a warm standby interface, if there is one.
+        Note: the subscriptions of the old server cannot be carried over.
+        As with any switch, the wallets' synchronizers subscribe again on the
+        new server; addresses whose status did not change cost no further requests.
+        """
+        standbys = self._get_standby_interfaces()
+        if not standbys:
+            return False
+        start = time.monotonic()
+        iface = random.choice(standbys)
+        await self.switch_to_interface(iface.server)
+        self.logger.info(f"failed over to standby {iface.server} in {(time.monotonic() - start) * 1000:.1f} ms")
+        return True
+
     async def _switch_to_random_interface(self):
-        '''Switch to a random connected server other than the current one'''
+        '''Switch to a random connected server other than the current one.
+        Warm standbys are preferred.'''
+        if await self._failover_to_standby_interface():
+            return
         servers = self.get_interfaces()    # Those in connected state
         if self.default_server in servers:
             servers.remove(self.default_server)
@@ -758,10 +1022,15 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
         '''A connection to server either went down, or was never made.
         We distinguish by whether it is in self.interfaces.'''
         if not interface: return
+        was_main_interface = interface == self.interface
         if interface.server == self.default_server:
             self._set_status('disconnected')
         await self._close_interface(interface)
         util.trigger_callback('network_updated')
+        # hand off to a warm standby right away, instead of waiting for _maintain_sessions
+        if (was_main_interface and self.auto_connect
+                and self.taskgroup and not self.taskgroup.closed()):
+            await self._failover_to_standby_interface()
 
     def get_network_timeout_seconds(self, request_type=NetworkTimeout.Generic) -> int:
         if self.oneserver and not self.auto_connect:
@@ -864,6 +1133,30 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
             raise BestEffortRequestFailed('no interface to do request on... gave up.')
         return make_reliable_wrapper
 
+    def _pick_hedge_interface(self, main_iface: Interface) -> Optional[Interface]:
+        with self.interfaces_lock: interfaces = list(self.interfaces.values())
+        candidates = [iface for iface in interfaces
+                      if iface != main_iface
+                      and iface.ready.done() and not iface.ready.cancelled()
+                      and iface.blockchain == main_iface.blockchain]
+        return random.choice(candidates) if candidates else None
+
+    async def _send_maybe_hedged(self, key: str, make_request: Callable[[Interface], Awaitable]) -> Any:
+        """Sends request on the main interface. If 'hedge_requests' is enabled,
+        a slow request is also sent to another interface on the same chain.
+        """
+        iface = self.interface
+        if not self.config.get('hedge_requests', False):
+            return await make_request(iface)
+
+        def pick_secondary():
+            other = self._pick_hedge_interface(iface)
+            if other is None:
+                return None
+            self.logger.debug(f"hedging {key} request to {other.server}")
+            return lambda: make_request(other)
+        return await self.request_hedger.run(key, lambda: make_request(iface), pick_secondary)
+
     def catch_server_exceptions(func):
         @functools.wraps(func)
         async def wrapper(self, *args, **kwargs):
@@ -876,7 +1169,25 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
     @best_effort_reliable
     @catch_server_exceptions
     async def get_merkle_for_transaction(self, tx_hash: str, tx_height: int) -> dict:
-        return await self.interface.get_merkle_for_transaction(tx_hash=tx_hash, tx_height=tx_height)
+        return await self._send_maybe_hedged(
+            'blockchain.transaction.get_merkle',
+            lambda iface: iface.get_merkle_for_transaction(tx_hash=tx_hash, tx_height=tx_height))
+
+    @best_effort_reliable
+    async def get_merkle_for_transactions(
+            self, txs: Sequence[Tuple[str, int]]) -> List[Union[dict, UntrustedServerReturnedError]]:
+        """Merkle proofs of many (tx_hash, tx_height), requested in one batch.
+        A server error for a tx is returned in place of its proof.
+        """
+        results = await self.interface.get_merkle_for_transactions(txs)
+        ret = []
+        for res in results:
+            if isinstance(res, aiorpcx.jsonrpc.CodeMessageError):
+                res = UntrustedServerReturnedError(original_exception=res)
+            elif isinstance(res, Exception):
+                raise RequestCorrupted(f'bad response in get_merkle batch: {res!r}')
+            ret.append(res)
+        return ret
 
     @best_effort_reliable
     async def broadcast_transaction(self, tx: 'Transaction', *, timeout=None) -> None:
@@ -1088,7 +1399,9 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
     @best_effort_reliable
     @catch_server_exceptions
     async def get_transaction(self, tx_hash: str, *, timeout=None) -> str:
-        return await self.interface.get_transaction(tx_hash=tx_hash, timeout=timeout)
+        return await self._send_maybe_hedged(
+            'blockchain.transaction.get',
+            lambda iface: iface.get_transaction(tx_hash=tx_hash, timeout=timeout))
 
     @best_effort_reliable
     @catch_server_exceptions
@@ -1118,7 +1431,9 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
     @best_effort_reliable
     @catch_server_exceptions
     async def get_balance_for_scripthash(self, sh: str) -> dict:
-        return await self.interface.get_balance_for_scripthash(sh)
+        return await self._send_maybe_hedged(
+            'blockchain.scripthash.get_balance',
+            lambda iface: iface.get_balance_for_scripthash(sh))
 
     @best_effort_reliable
     @catch_server_exceptions
@@ -1254,6 +1569,9 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
         self.interfaces = {}
         self._connecting_ifaces.clear()
         self._closing_ifaces.clear()
+        if full_shutdown and self._proof_verification_pool:
+            self._proof_verification_pool.shutdown(wait=False)
+            self._proof_verification_pool = None
         if not full_shutdown:
             util.trigger_callback('network_updated')
 
@@ -1271,7 +1589,8 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
     async def _maintain_sessions(self):
         async def maybe_start_new_interfaces():
             num_existing_ifaces = len(self.interfaces) + len(self._connecting_ifaces) + len(self._closing_ifaces)
-            for i in range(self.num_server - num_existing_ifaces):
+            # keep enough connections around that there are warm standbys for the main interface
+            for i in range(self._get_num_target_interfaces() - num_existing_ifaces):
                 # FIXME this should try to honour "healthy spread of connected servers"
                 server = self._get_next_server_to_try()
                 if server:
@@ -43,15 +43,20 @@ class DecodedBech32(NamedTuple):
     data: Optional[Sequence[int]]  # 5-bit ints
 
 
+_GENERATOR = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
+# xor of the generator terms selected by each possible value of the top 5 bits
+_POLYMOD_TABLE = [0] * 32
+for _top in range(32):
+    for _i in range(5):
+        if (_top >> _i) & 1:
+            _POLYMOD_TABLE[_top] ^= _GENERATOR[_i]
+
+
 def bech32_polymod(values):
     """Internal function that computes the Bech32 checksum."""
-    generator = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
     chk = 1
     for value in values:
-        top = chk >> 25
-        chk = (chk & 0x1ffffff) << 5 ^ value
-        for i in range(5):
-            chk ^= generator[i] if ((top >> i) & 1) else 0
+        chk = ((chk & 0x1ffffff) << 5 ^ value) ^ _POLYMOD_TABLE[chk >> 25]
     return chk
 
 
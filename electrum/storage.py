@@ -63,6 +63,9 @@ class WalletStorage(Logger):
         self.logger.info(f"wallet path {self.path}")
         self.pubkey = None
         self.decrypted = ''
+        # the key the file on disk is encrypted with, see can_append
+        self._file_pubkey = None
+        self._has_incomplete_tail = False
         try:
             test_read_write_permissions(self.path)
         except IOError as e:
@@ -97,8 +100,27 @@ class WalletStorage(Logger):
         os.replace(temp_path, self.path)
         os.chmod(self.path, mode)
         self._file_exists = True
+        self._file_pubkey = self.pubkey
+        self._has_incomplete_tail = False
         self.logger.info(f"saved {self.path}")
 
+    def can_append(self) -> bool:
+        return (self.file_exists()
+                and self.is_past_initial_decryption()
+                and self._file_pubkey == self.pubkey
+                and not self._has_incomplete_tail)
+
+    def append(self, data: str) -> None:
+        """Appends 'data' as a new line to the file.
+        Encrypted files get one ciphertext per line.
+        """
+        assert self.can_append()
+        s = self.encrypt_before_writing(data)
+        with open(self.path, "a", encoding='utf-8') as f:
+            f.write('\n' + s)
+            f.flush()
+            os.fsync(f.fileno())
+
     def file_exists(self) -> bool:
         return self._file_exists
 
@@ -134,7 +156,7 @@ class WalletStorage(Logger):
 
     def _init_encryption_version(self):
         try:
-            magic = base64.b64decode(self.raw)[0:4]
+            magic = base64.b64decode(self.raw.split('\n', 1)[0])[0:4]
             if magic == b'BIE1':
                 return StorageEncryptionVersion.USER_PASSWORD
             elif magic == b'BIE2':
@@ -165,11 +187,25 @@ class WalletStorage(Logger):
         ec_key = self.get_eckey_from_password(password)
         if self.raw:
             enc_magic = self._get_encryption_magic()
-            s = zlib.decompress(ec_key.decrypt_message(self.raw, enc_magic))
-            s = s.decode('utf8')
+            # lines after the first one were added by append()
+            lines = self.raw.split('\n')
+            plaintexts = []
+            for i, line in enumerate(lines):
+                try:
+                    s = zlib.decompress(ec_key.decrypt_message(line, enc_magic))
+                except Exception:
+                    if i == 0 or i < len(lines) - 1:
+                        raise
+                    # interrupted while appending
+                    self.logger.warning('ignoring incomplete line at the end of wallet file')
+                    self._has_incomplete_tail = True
+                    break
+                plaintexts.append(s.decode('utf8'))
+            s = '\n'.join(plaintexts)
         else:
             s = ''
         self.pubkey = ec_key.get_public_key_hex()
+        self._file_pubkey = self.pubkey
         self.decrypted = s
 
     def encrypt_before_writing(self, plaintext: str) -> str:
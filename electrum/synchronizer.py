@@ -24,33 +24,48 @@
 # SOFTWARE.
 import asyncio
 import hashlib
-from typing import Dict, List, TYPE_CHECKING, Tuple, Set
+from typing import Dict, List, TYPE_CHECKING, Tuple, Set, Sequence
 from collections import defaultdict
 import logging
 
-from aiorpcx import TaskGroup, run_in_thread, RPCError
+from aiorpcx import run_in_thread, RPCError
 
 from . import util
 from .transaction import Transaction, PartialTransaction
 from .util import bh2u, make_aiohttp_session, NetworkJobOnDefaultServer, random_shuffled_copy
 from .bitcoin import address_to_scripthash, is_address
 from .logging import Logger
-from .interface import GracefulDisconnect, NetworkTimeout
+from .interface import GracefulDisconnect, NetworkTimeout, RequestTimedOut, MAX_INCOMING_MSG_SIZE
 
 if TYPE_CHECKING:
     from .network import Network
     from .address_synchronizer import AddressSynchronizer
 
 
+# addresses subscribed to per JSON-RPC batch, and max number of batches in flight
+SUBSCRIPTION_BATCH_SIZE = 100
+SUBSCRIPTION_BATCH_CONCURRENCY = 10
+# max histories/transactions requested per JSON-RPC batch, and how long (in seconds)
+# requests are collected before a batch is sent
+SYNC_BATCH_SIZE = 100
+SYNC_BATCH_DELAY = 0.05
+# max histories/transactions requested and not answered yet, over all batches
+SYNC_MAX_ITEMS_IN_FLIGHT = 500
+# Batches are also capped by the expected size of their response, as a response
+# over MAX_INCOMING_MSG_SIZE gets dropped (and the batch would time out).
+# These are rough estimates of the JSON size of a history item and of a tx.
+SYNC_BATCH_MAX_RESPONSE_SIZE = MAX_INCOMING_MSG_SIZE // 2
+HISTORY_ITEM_RESPONSE_SIZE = 120
+TX_RESPONSE_SIZE = 1000
+
+
 class SynchronizerFailure(Exception): pass
 
 
 def history_status(h):
     if not h:
         return None
-    status = ''
-    for tx_hash, height in h:
-        status += tx_hash + ':%d:' % height
+    status = ''.join(['%s:%d:' % (tx_hash, height) for tx_hash, height in h])
     return bh2u(hashlib.sha256(status.encode('ascii')).digest())
 
 
@@ -92,6 +107,14 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
     def add(self, addr):
         asyncio.run_coroutine_threadsafe(self._add_address(addr), self.asyncio_loop)
 
+    def add_many(self, addrs: Sequence[str]):
+        # one hop to the event loop for all of them; they get subscribed to in batches
+        asyncio.run_coroutine_threadsafe(self._add_addresses(list(addrs)), self.asyncio_loop)
+
+    async def _add_addresses(self, addrs: Sequence[str]):
+        for addr in addrs:
+            await self._add_address(addr)
+
     async def _add_address(self, addr: str):
         # note: this method is async as add_queue.put_nowait is not thread-safe.
         if not is_address(addr): raise ValueError(f"invalid bitcoin address {addr}")
@@ -104,23 +127,42 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
         raise NotImplementedError()  # implemented by subclasses
 
     async def send_subscriptions(self):
-        async def subscribe_to_address(addr):
-            h = address_to_scripthash(addr)
-            self.scripthash_to_address[h] = addr
-            self._requests_sent += 1
+        # Addresses are subscribed to in JSON-RPC batches, so that e.g. resubscribing
+        # a large wallet after a reconnect does not take a round-trip per address.
+        config = self.network.config
+        batch_size = max(1, int(config.get('subscription_batch_size', SUBSCRIPTION_BATCH_SIZE)))
+        batch_semaphore = asyncio.Semaphore(
+            max(1, int(config.get('subscription_batch_concurrency', SUBSCRIPTION_BATCH_CONCURRENCY))))
+
+        async def subscribe_to_addresses(addrs):
             try:
-                async with self._network_request_semaphore:
-                    await self.session.subscribe('blockchain.scripthash.subscribe', [h], self.status_queue)
-            except RPCError as e:
-                if e.message == 'history too large':  # no unique error code
-                    raise GracefulDisconnect(e, log_level=logging.ERROR) from e
-                raise
-            self._requests_answered += 1
-            self.requested_addrs.remove(addr)
+                hashes = []
+                for addr in addrs:
+                    h = address_to_scripthash(addr)
+                    self.scripthash_to_address[h] = addr
+                    hashes.append(h)
+                self._requests_sent += len(addrs)
+                try:
+                    async with self._network_request_semaphore:
+                        await self.session.subscribe_many('blockchain.scripthash.subscribe',
+                                                          [[h] for h in hashes], self.status_queue)
+                except RPCError as e:
+                    if e.message == 'history too large':  # no unique error code
+                        raise GracefulDisconnect(e, log_level=logging.ERROR) from e
+                    raise
+                self._requests_answered += len(addrs)
+                for addr in addrs:
+                    self.requested_addrs.remove(addr)
+            finally:
+                batch_semaphore.release()
 
         while True:
-            addr = await self.add_queue.get()
-            await self.taskgroup.spawn(subscribe_to_address, addr)
+            addrs = [await self.add_queue.get()]
+            # wait for a free slot first, so that batches fill up while all are busy
+            await batch_semaphore.acquire()
+            while len(addrs) < batch_size and not self.add_queue.empty():
+                addrs.append(self.add_queue.get_nowait())
+            await self.taskgroup.spawn(subscribe_to_addresses, addrs)
 
     async def handle_status(self):
         while True:
@@ -147,12 +189,19 @@ class Synchronizer(SynchronizerBase):
     def __init__(self, wallet: 'AddressSynchronizer'):
         self.wallet = wallet
         SynchronizerBase.__init__(self, wallet.network)
+        self._max_items_in_flight = max(1, int(self.network.config.get('synchronizer_max_items_in_flight',
+                                                                       SYNC_MAX_ITEMS_IN_FLIGHT)))
+        self._items_in_flight = asyncio.Semaphore(self._max_items_in_flight)
+        # batches take their items from _items_in_flight one at a time, holding this
+        self._items_in_flight_lock = asyncio.Lock()
 
     def _reset(self):
         super()._reset()
         self.requested_tx = {}
         self.requested_histories = set()
         self._stale_histories = dict()  # type: Dict[str, asyncio.Task]
+        self._history_queue = asyncio.Queue()  # type: asyncio.Queue[Tuple[str, str]]
+        self._tx_queue = asyncio.Queue()  # type: asyncio.Queue[Tuple[str, bool]]
 
     def diagnostic_name(self):
         return self.wallet.diagnostic_name()
@@ -164,8 +213,7 @@ class Synchronizer(SynchronizerBase):
                 and not self._stale_histories)
 
     async def _on_address_status(self, addr, status):
-        history = self.wallet.db.get_addr_history(addr)
-        if history_status(history) == status:
+        if self.wallet.get_address_history_status(addr) == status:
             return
         # No point in requesting history twice for the same announced status.
         # However if we got announced a new status, we should request history again:
@@ -174,11 +222,25 @@ class Synchronizer(SynchronizerBase):
         # request address history
         self.requested_histories.add((addr, status))
         self._stale_histories.pop(addr, asyncio.Future()).cancel()
-        h = address_to_scripthash(addr)
-        self._requests_sent += 1
-        async with self._network_request_semaphore:
-            result = await self.interface.get_history_for_scripthash(h)
-        self._requests_answered += 1
+        self._history_queue.put_nowait((addr, status))
+
+    async def _request_histories(self, items: List[Tuple[str, str]]):
+        self._requests_sent += len(items)
+        try:
+            results = await self.interface.get_history_for_scripthashes(
+                [address_to_scripthash(addr) for addr, status in items])
+        finally:
+            self._requests_answered += len(items)
+        first_error = None
+        for (addr, status), result in zip(items, results):
+            if isinstance(result, Exception):
+                first_error = first_error or result
+                continue
+            await self._on_history(addr, status, result)
+        if first_error is not None:
+            raise first_error
+
+    async def _on_history(self, addr, status, result):
         self.logger.info(f"receiving history {addr} {len(result)}")
         hist = list(map(lambda item: (item['tx_hash'], item['height']), result))
         # tx_fees
@@ -207,46 +269,125 @@ class Synchronizer(SynchronizerBase):
 
     async def _request_missing_txs(self, hist, *, allow_server_not_finding_tx=False):
         # "hist" is a list of [tx_hash, tx_height] lists
-        transaction_hashes = []
         for tx_hash, tx_height in hist:
             if tx_hash in self.requested_tx:
                 continue
             tx = self.wallet.db.get_transaction(tx_hash)
             if tx and not isinstance(tx, PartialTransaction):
                 continue  # already have complete tx
-            transaction_hashes.append(tx_hash)
             self.requested_tx[tx_hash] = tx_height
+            self._tx_queue.put_nowait((tx_hash, allow_server_not_finding_tx))
 
-        if not transaction_hashes: return
-        async with TaskGroup() as group:
-            for tx_hash in transaction_hashes:
-                await group.spawn(self._get_transaction(tx_hash, allow_server_not_finding_tx=allow_server_not_finding_tx))
-
-    async def _get_transaction(self, tx_hash, *, allow_server_not_finding_tx=False):
-        self._requests_sent += 1
+    async def _get_transactions(self, items: List[Tuple[str, bool]]):
+        self._requests_sent += len(items)
         try:
-            async with self._network_request_semaphore:
-                raw_tx = await self.interface.get_transaction(tx_hash)
-        except RPCError as e:
-            # most likely, "No such mempool or blockchain transaction"
-            if allow_server_not_finding_tx:
-                self.requested_tx.pop(tx_hash)
-                return
-            else:
-                raise
+            results = await self.interface.get_transactions([tx_hash for tx_hash, allow in items])
         finally:
-            self._requests_answered += 1
-        tx = Transaction(raw_tx)
-        if tx_hash != tx.txid():
-            raise SynchronizerFailure(f"received tx does not match expected txid ({tx_hash} != {tx.txid()})")
+            self._requests_answered += len(items)
+        first_error = None
+        for (tx_hash, allow_server_not_finding_tx), result in zip(items, results):
+            if isinstance(result, RPCError):
+                # most likely, "No such mempool or blockchain transaction"
+                if allow_server_not_finding_tx:
+                    self.requested_tx.pop(tx_hash)
+                    continue
+            if isinstance(result, Exception):
+                first_error = first_error or result
+                continue
+            self._on_transaction(tx_hash, result)
+        if first_error is not None:
+            raise first_error
+
+    def _on_transaction(self, tx_hash, tx: Transaction):
+        # note: the interface has already deserialized tx and checked its txid
         tx_height = self.requested_tx.pop(tx_hash)
         self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
-        self.logger.info(f"received tx {tx_hash} height: {tx_height} bytes: {len(raw_tx)}")
+        self.logger.info(f"received tx {tx_hash} height: {tx_height} bytes: {len(tx.serialize())}")
         # callbacks
         util.trigger_callback('new_transaction', self.wallet, tx)
 
+    def _estimate_history_response_size(self, item: Tuple[str, str]) -> int:
+        addr, status = item
+        # the new history is usually what we already have, plus a few txs
+        return HISTORY_ITEM_RESPONSE_SIZE * (len(self.wallet.db.get_addr_history(addr)) + 1)
+
+    def _estimate_tx_response_size(self, item: Tuple[str, bool]) -> int:
+        return TX_RESPONSE_SIZE
+
+    async def _send_batches(self, queue: asyncio.Queue, send_batch, estimate_response_size):
+        # Requests are collected for a short while and sent as JSON-RPC batches,
+        # so that e.g. restoring a large wallet does not take a round-trip per item.
+        config = self.network.config
+        batch_size = max(1, int(config.get('synchronizer_batch_size', SYNC_BATCH_SIZE)))
+        batch_size = min(batch_size, self._max_items_in_flight)
+        batch_delay = max(0, float(config.get('synchronizer_batch_delay', SYNC_BATCH_DELAY)))
+
+        async def send_in_halves(items):
+            nonlocal batch_size
+            try:
+                await send_batch(items)
+            except RequestTimedOut:
+                if len(items) == 1:
+                    raise
+                # The response might have been dropped for being too large, in which case
+                # the same batch would time out again. Send it in two halves, and use
+                # smaller batches from now on.
+                half = (len(items) + 1) // 2
+                batch_size = min(batch_size, half)
+                self.logger.info(f"batch of {len(items)} requests timed out. retrying in batches of {half}")
+                await send_in_halves(items[:half])
+                await send_in_halves(items[half:])
+
+        async def run_batch(items):
+            try:
+                await send_in_halves(items)
+            finally:
+                for _ in items:
+                    self._items_in_flight.release()
+                self._network_request_semaphore.release()
+
+        async def acquire_items_in_flight(num_items):
+            # all at once, so that another queue cannot hold part of what we need
+            acquired = 0
+            try:
+                async with self._items_in_flight_lock:
+                    while acquired < num_items:
+                        await self._items_in_flight.acquire()
+                        acquired += 1
+            except BaseException:
+                for _ in range(acquired):
+                    self._items_in_flight.release()
+                raise
+
+        next_item = None
+        while True:
+            items = [next_item if next_item is not None else await queue.get()]
+            next_item = None
+            if batch_delay:
+                await asyncio.sleep(batch_delay)
+            # wait for a free slot first, so that batches fill up while all are busy
+            await self._network_request_semaphore.acquire()
+            try:
+                response_size = estimate_response_size(items[0])
+                while len(items) < batch_size and not queue.empty():
+                    item = queue.get_nowait()
+                    response_size += estimate_response_size(item)
+                    if response_size > SYNC_BATCH_MAX_RESPONSE_SIZE:
+                        next_item = item  # starts the next batch
+                        break
+                    items.append(item)
+                await acquire_items_in_flight(len(items))
+            except BaseException:
+                self._network_request_semaphore.release()
+                raise
+            await self.taskgroup.spawn(run_batch, items)
+
     async def main(self):
         self.wallet.set_up_to_date(False)
+        await self.taskgroup.spawn(self._send_batches(
+            self._history_queue, self._request_histories, self._estimate_history_response_size))
+        await self.taskgroup.spawn(self._send_batches(
+            self._tx_queue, self._get_transactions, self._estimate_tx_response_size))
         # request missing txns, if any
         for addr in random_shuffled_copy(self.wallet.db.get_history()):
             history = self.wallet.db.get_addr_history(addr)
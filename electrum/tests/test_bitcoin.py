@@ -668,6 +668,17 @@ class Test_xprv_xpub(ElectrumTestCase):
         self.assertEqual("xpub6BJA1jSqiukeaesWfxe6sNK9CCGaujFFSJLomWHprUL9DePQ4JDkM5d88n49sMGJxrhpjazuXYWdMf17C9T5XnxkopaeS7jGk1GyyVziaMt", xpub)
         self.assertEqual("xprv9xJocDuwtYCMNAo3Zw76WENQeAS6WGXQ55RCy7tDJ8oALr4FWkuVoHJeHVAcAqiZLE7Je3vZJHxspZdFHfnBEjHqU5hG1Jaj32dVoS6XLT1", xprv)
 
+    def test_ckd_pub_range(self):
+        node = BIP32Node.from_xkey(self.xprv_xpub[0]['xpub'])
+        parent_pubkey = node.eckey.get_public_key_bytes(compressed=True)
+        pubkeys = bip32.CKD_pub_range(parent_pubkey, node.chaincode, 3, 23)
+        self.assertEqual([bip32.CKD_pub(parent_pubkey, node.chaincode, n)[0] for n in range(3, 23)], pubkeys)
+        self.assertEqual([], bip32.CKD_pub_range(parent_pubkey, node.chaincode, 5, 5))
+        with self.assertRaises(ValueError):
+            bip32.CKD_pub_range(parent_pubkey, node.chaincode, -1, 2)
+        with self.assertRaises(Exception):
+            bip32.CKD_pub_range(parent_pubkey, node.chaincode, 0, bip32.BIP32_PRIME + 1)
+
     def test_xpub_from_xprv(self):
         """We can derive the xpub key from a xprv."""
         for xprv_details in self.xprv_xpub:
@@ -1,11 +1,13 @@
 import shutil
 import tempfile
 import os
+from unittest import mock
 
 from electrum import constants, blockchain
 from electrum.simple_config import SimpleConfig
-from electrum.blockchain import Blockchain, deserialize_header, hash_header
+from electrum.blockchain import Blockchain, deserialize_header, hash_header, serialize_header, HEADER_SIZE
 from electrum.util import bh2u, bfh, make_dir
+from electrum.crypto import sha256
 
 from . import ElectrumTestCase
 
@@ -384,6 +386,207 @@ class TestBlockchain(ElectrumTestCase):
         self.assertEqual([chain_u], self.get_chains_that_contain_header_helper(self.HEADERS['O']))
         self.assertEqual([chain_z, chain_l], self.get_chains_that_contain_header_helper(self.HEADERS['I']))
 
+    def test_header_caches_follow_writes(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        for name in 'ABCDEFOP':
+            self._append_header(chain_u, self.HEADERS[name])
+        self.assertEqual(hash_header(self.HEADERS['O']), chain_u.get_hash(6))
+        self.assertEqual(self.HEADERS['O'], chain_u.read_header(6))
+        # read_header hands out copies of what it caches
+        chain_u.read_header(6)['nonce'] = 42
+        self.assertEqual(self.HEADERS['O'], chain_u.read_header(6))
+        # overwrite (and truncate) from height 6
+        chain_u.write(bfh(serialize_header(self.HEADERS['G'])), 6 * 80)
+        self.assertEqual(6, chain_u.height())
+        self.assertEqual(hash_header(self.HEADERS['G']), chain_u.get_hash(6))
+        self.assertEqual(self.HEADERS['G'], chain_u.read_header(6))
+        self.assertIsNone(chain_u.read_header(7))
+        self.assertEqual(hash_header(self.HEADERS['F']), chain_u.get_hash(5))
+
+    def test_appending_keeps_header_caches(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        for name in 'ABCDEF':
+            self._append_header(chain_u, self.HEADERS[name])
+        self.assertEqual(self.HEADERS['C'], chain_u.read_header(2))
+        self.assertEqual(hash_header(self.HEADERS['F']), chain_u.get_hash(5))
+        headers_mmap = chain_u._headers_mmap
+        self.assertIsNotNone(headers_mmap)
+        self._append_header(chain_u, self.HEADERS['O'])
+        self.assertIs(headers_mmap, chain_u._headers_mmap)
+        self.assertIn(2, chain_u._header_cache)
+        self.assertEqual(self.HEADERS['O'], chain_u.read_header(6))
+        self.assertEqual(hash_header(self.HEADERS['O']), chain_u.get_hash(6))
+
+    def _write_snapshot(self, names) -> str:
+        path = os.path.join(self.data_dir, 'headers_snapshot')
+        with open(path, 'wb') as f:
+            for name in names:
+                f.write(bfh(serialize_header(self.HEADERS[name])))
+        return path
+
+    def test_import_headers_snapshot(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        path = self._write_snapshot('ABCDEFOPQRSTU')
+        self.assertEqual(12, blockchain.import_headers_snapshot(path))
+        self.assertEqual(12, chain_u.height())
+        self.assertEqual(hash_header(self.HEADERS['U']), chain_u.get_hash(12))
+        # nothing to do the second time
+        self.assertEqual(-1, blockchain.import_headers_snapshot(path))
+        # neither a shorter nor a conflicting snapshot truncates the chain
+        self.assertEqual(-1, blockchain.import_headers_snapshot(self._write_snapshot('ABCDEF')))
+        self.assertEqual(-1, blockchain.import_headers_snapshot(self._write_snapshot('ABCDEFGHI')))
+        self.assertEqual(12, chain_u.height())
+        self.assertEqual(hash_header(self.HEADERS['O']), chain_u.get_hash(6))
+
+    def test_import_headers_snapshot_invalid(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        path = self._write_snapshot('ABCDEFGPQ')  # P does not follow G
+        self.assertEqual(-1, blockchain.import_headers_snapshot(path))
+        self.assertEqual(-1, chain_u.height())
+
+    def test_import_headers_snapshot_checkpoints(self):
+        # a period of synthetic headers, checkpointed at its last block
+        data = bytearray(bfh(serialize_header(self.HEADERS['A'])))
+        prev_hash = bfh(constants.net.GENESIS)[::-1]
+        for i in range(1, 2016):
+            raw_header = bytes(4) + prev_hash + sha256(bytes([i % 256, i // 256])) + bytes(12)
+            data += raw_header
+            prev_hash = sha256(sha256(raw_header))
+        path = os.path.join(self.data_dir, 'headers_snapshot')
+        with open(path, 'wb') as f:
+            f.write(data)
+        checkpoints = constants.net.CHECKPOINTS
+        try:
+            constants.net.CHECKPOINTS = [(bh2u(prev_hash[::-1]), 0)]
+            blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+                config=self.config, forkpoint=0, parent=None,
+                forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+            open(chain_u.path(), 'w+').close()
+            self.assertEqual(2015, blockchain.import_headers_snapshot(path))
+            self.assertEqual(2015, chain_u.height())
+            self.assertEqual(bh2u(prev_hash[::-1]), hash_header(chain_u.read_header(2015)))
+            # wrong checkpoint
+            constants.net.CHECKPOINTS = [('00' * 32, 0)]
+            open(chain_u.path(), 'w+').close()
+            chain_u.update_size()
+            self.assertEqual(-1, blockchain.import_headers_snapshot(path))
+        finally:
+            constants.net.CHECKPOINTS = checkpoints
+
+    def test_verify_chunk(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        for name in 'ABC':
+            self._append_header(chain_u, self.HEADERS[name])
+        chunk = b''.join(bfh(serialize_header(self.HEADERS[name])) for name in 'ABCDEFOPQRSTU')
+        chain_u.verify_chunk(0, chunk)
+        self.assertTrue(chain_u.connect_chunk(0, bh2u(chunk)))
+        self.assertEqual(12, chain_u.height())
+        # G does not link to E
+        bad_chunk = b''.join(bfh(serialize_header(self.HEADERS[name])) for name in 'ABCDEG')
+        with self.assertRaises(Exception):
+            chain_u.verify_chunk(0, bad_chunk)
+        # conflicts with the headers we have
+        fork_chunk = b''.join(bfh(serialize_header(self.HEADERS[name])) for name in 'ABCDEFGHI')
+        with self.assertRaises(Exception):
+            chain_u.verify_chunk(0, fork_chunk)
+
+
+class TestChainworkIndex(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        make_dir(os.path.join(self.electrum_path, 'forks'))
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+        blockchain.blockchains = {}
+
+    def _new_chain(self) -> Blockchain:
+        chain = Blockchain(config=self.config, forkpoint=0, parent=None,
+                           forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        blockchain.blockchains[constants.net.GENESIS] = chain
+        return chain
+
+    def _expected_chainwork(self, num_periods: int) -> int:
+        total = 0
+        target = blockchain.MAX_TARGET
+        for h, next_target in constants.net.CHECKPOINTS[:num_periods]:
+            total += 2016 * (((2 ** 256 - target - 1) // (target + 1)) + 1)
+            target = next_target
+        return total
+
+    def test_chainwork_of_checkpoints(self):
+        num_periods = len(constants.net.CHECKPOINTS)
+        chain = self._new_chain()
+        open(chain.path(), 'w+').close()
+        height = num_periods * 2016 - 1
+        self.assertEqual(self._expected_chainwork(num_periods), chain.get_chainwork(height))
+        self.assertEqual(self._expected_chainwork(10), chain.get_chainwork(10 * 2016 - 1))
+        self.assertTrue(os.path.exists(chain.path() + '.chainwork'))
+        # a new instance loads the index from disk
+        chain2 = self._new_chain()
+        # the last period is complete, but its work is added as a partial one
+        self.assertEqual(num_periods - 1, len(chain2._load_period_index()))
+        self.assertEqual(self._expected_chainwork(num_periods), chain2.get_chainwork(height))
+
+    def test_chainwork_index_is_extended_when_saving(self):
+        chain = self._new_chain()
+        open(chain.path(), 'w+').close()
+        chain.save_chunk(2, bytes(2016 * HEADER_SIZE))
+        self.assertEqual(3, len(chain._period_index))
+        self.assertTrue(os.path.exists(chain.path() + '.chainwork'))
+        self.assertEqual(3, len(self._new_chain()._load_period_index()))
+        self.assertEqual(self._expected_chainwork(3), chain.get_chainwork(3 * 2016 - 1))
+
+    def test_chainwork_index_is_validated(self):
+        chain = self._new_chain()
+        open(chain.path(), 'w+').close()
+        chain.get_chainwork(20 * 2016 - 1)
+        # corrupt an entry: it, and the ones after it, get recomputed
+        chain2 = self._new_chain()
+        entries = chain2._load_period_index()
+        h, work, target = entries[15]
+        entries[15] = ('00' * 32, work + 1, target)
+        self.assertEqual(self._expected_chainwork(20), chain2.get_chainwork(20 * 2016 - 1))
+        self.assertEqual(19, len(chain2._load_period_index()))
+        self.assertEqual(self._expected_chainwork(16), chain2.get_chainwork(16 * 2016 - 1))
+
+
+class TestVerifyChunkBelowCheckpoint(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+        blockchain.blockchains = {}
+
+    def test_zero_filled_headers_are_not_read(self):
+        chain = Blockchain(config=self.config, forkpoint=0, parent=None,
+                           forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        blockchain.blockchains[constants.net.GENESIS] = chain
+        open(chain.path(), 'w+').close()
+        chain.save_chunk(2, bytes(2016 * HEADER_SIZE))
+        chunk = bytes(2016 * HEADER_SIZE)
+        with mock.patch.object(chain, '_get_raw_hash') as get_raw_hash, \
+                mock.patch.object(Blockchain, 'verify_raw_headers') as verify_raw_headers:
+            chain.verify_chunk(1, chunk)
+        get_raw_hash.assert_not_called()
+        verify_raw_headers.assert_called_once_with(chunk, constants.net.CHECKPOINTS[0][0],
+                                                   constants.net.CHECKPOINTS[0][1],
+                                                   {2015: constants.net.CHECKPOINTS[1][0]})
+
 
 class TestVerifyHeader(ElectrumTestCase):
 
@@ -417,3 +620,20 @@ class TestVerifyHeader(ElectrumTestCase):
         with self.assertRaises(Exception):
             self.header["nonce"] = 42
             Blockchain.verify_header(self.header, self.prev_hash, self.target)
+
+    def test_verify_raw_headers(self):
+        data = bfh(self.valid_header)
+        self.assertEqual(hash_header(self.header),
+                         Blockchain.verify_raw_headers(data, self.prev_hash, self.target))
+        Blockchain.verify_raw_headers(data, self.prev_hash, self.target,
+                                      expected_hashes={0: hash_header(self.header)})
+        with self.assertRaises(Exception):
+            Blockchain.verify_raw_headers(data, self.prev_hash, self.target,
+                                          expected_hashes={0: self.prev_hash})
+        with self.assertRaises(Exception):
+            Blockchain.verify_raw_headers(data, "00" * 32, self.target)
+        with self.assertRaises(Exception):
+            Blockchain.verify_raw_headers(data, self.prev_hash, Blockchain.bits_to_target(0x1d00eeee))
+        with self.assertRaises(Exception):
+            self.header["nonce"] = 42
+            Blockchain.verify_raw_headers(bfh(serialize_header(self.header)), self.prev_hash, self.target)
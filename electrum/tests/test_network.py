@@ -1,13 +1,32 @@
 import asyncio
+import json
+import os
+import ssl
+import sys
+import time
 import tempfile
+import threading
 import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from aiorpcx import RPCError
+from aiorpcx.session import SessionKind
 
 from electrum import constants
 from electrum.simple_config import SimpleConfig
 from electrum import blockchain
-from electrum.interface import Interface, ServerAddr
+from electrum.interface import (Interface, ServerAddr, RequestTracer, RequestTrace,
+                                NotificationSession, RequestTimedOut)
+from electrum.network import RequestHedger, Network
+from electrum import synchronizer
+from electrum.synchronizer import Synchronizer, history_status
+from electrum.transaction import Transaction
+from electrum.bitcoin import address_to_scripthash
+from electrum.wallet_db import WalletDB
 from electrum.crypto import sha256
 from electrum.util import bh2u
+from electrum.logging import Logger
 
 from . import ElectrumTestCase
 
@@ -96,6 +115,52 @@ class TestNetwork(ElectrumTestCase):
         self.assertEqual(('catchup', 5), asyncio.get_event_loop().run_until_complete(ifa.sync_until(8, next_height=4)))
         self.assertEqual(self.interface.q.qsize(), 0)
 
+    def test_request_chunks_pipelined_connects_in_order(self):
+        connected = []
+        def mock_connect_chunk(index, hexdata):
+            connected.append((index, hexdata))
+            return True
+        async def mock_fetch_chunk(index, size):
+            await asyncio.sleep(0.01 * (5 - index))  # later chunks arrive first
+            return f"chunk{index}:{size}"
+        ifa = self.interface
+        ifa.network.interfaces = {}
+        ifa.network.interfaces_lock = threading.Lock()
+        ifa.blockchain.connect_chunk = mock_connect_chunk
+        ifa._fetch_chunk = mock_fetch_chunk
+        tip = 4 * 2016 + 5
+        self.assertEqual((True, tip + 1), asyncio.get_event_loop().run_until_complete(ifa._request_chunks(100, tip)))
+        self.assertEqual([(0, "chunk0:2016"), (1, "chunk1:2016"), (2, "chunk2:2016"),
+                          (3, "chunk3:2016"), (4, "chunk4:6")], connected)
+
+    def test_request_chunks_pipelined_stops_at_first_bad_chunk(self):
+        connected = []
+        def mock_connect_chunk(index, hexdata):
+            if index == 2:
+                return False
+            connected.append(index)
+            return True
+        async def mock_fetch_chunk(index, size):
+            return "00"
+        ifa = self.interface
+        ifa.network.interfaces = {}
+        ifa.network.interfaces_lock = threading.Lock()
+        ifa.blockchain.connect_chunk = mock_connect_chunk
+        ifa._fetch_chunk = mock_fetch_chunk
+        self.assertEqual((False, 2 * 2016), asyncio.get_event_loop().run_until_complete(ifa._request_chunks(100, 5 * 2016)))
+        self.assertEqual([0, 1], connected)
+
+    def test_chunk_sources_follow_our_chain(self):
+        ifa = self.interface
+        other_chain = blockchain.Blockchain(config=self.config, forkpoint=0, parent=None,
+                                            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        same = SimpleNamespace(session=True, tip=100, blockchain=ifa.blockchain)
+        forked = SimpleNamespace(session=True, tip=100, blockchain=other_chain)
+        behind = SimpleNamespace(session=True, tip=50, blockchain=ifa.blockchain)
+        ifa.network.interfaces = {'a': same, 'b': forked, 'c': behind, 'd': ifa}
+        ifa.network.interfaces_lock = threading.Lock()
+        self.assertEqual([ifa, same], ifa._get_chunk_sources(100))
+
     def mock_fork(self, bad_header):
         forkpoint = bad_header['block_height']
         b = blockchain.Blockchain(config=self.config, forkpoint=forkpoint, parent=None,
@@ -117,6 +182,540 @@ class TestNetwork(ElectrumTestCase):
         self.assertEqual(self.interface.q.qsize(), 0)
 
 
+class TestTlsSessionReuse(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+
+    def _make_interface(self, proxy=None):
+        ifa = MockInterface(self.config)
+        ifa.server = ServerAddr.from_str('mock-server:50002:s')
+        ifa.proxy = proxy
+        ifa.network.tls_contexts = {}
+        ifa.network.interface = ifa
+        os.makedirs(os.path.dirname(ifa.cert_path), exist_ok=True)
+        with open(ifa.cert_path, 'w') as f:
+            f.write('')  # CA signed
+        return ifa
+
+    def _connect(self, ifa, session):
+        # what open_session does once the version handshake is done
+        sslc = asyncio.get_event_loop().run_until_complete(ifa._get_ssl_context())
+        ssl_object = SimpleNamespace(session=session, session_reused=False)
+        transport = SimpleNamespace(get_extra_info=lambda name: ssl_object)
+        ifa.session = SimpleNamespace(transport=SimpleNamespace(_asyncio_transport=transport))
+        ifa._remember_tls_session(sslc)
+        return sslc
+
+    def test_context_and_session_are_reused(self):
+        ifa = self._make_interface()
+        sslc = self._connect(ifa, 'session1')
+        self.assertEqual('session1', sslc.tls_session)
+        self.assertIs(sslc, self._connect(ifa, 'session2'))
+        self.assertEqual('session2', sslc.tls_session)
+        with mock.patch.object(ssl.SSLContext, 'wrap_bio') as wrap_bio:
+            sslc.wrap_bio(ssl.MemoryBIO(), ssl.MemoryBIO(), server_hostname='mock-server')
+        self.assertEqual('session2', wrap_bio.call_args[1]['session'])
+
+    def test_no_session_resumption_over_proxy(self):
+        ifa = self._make_interface()
+        sslc = self._connect(ifa, 'session1')
+        ifa.proxy = SimpleNamespace()
+        self.assertIs(sslc, self._connect(ifa, 'session2'))
+        self.assertIsNone(sslc.tls_session)
+
+
+class TestServerInfoCache(ElectrumTestCase):
+
+    def _make_network(self, cache, ttl=3600):
+        network = Network.__new__(Network)
+        network.config = SimpleConfig({'electrum_path': self.electrum_path, 'server_info_cache_ttl': ttl})
+        with open(os.path.join(network.config.path, 'server_info_cache'), 'w') as f:
+            f.write(json.dumps(cache))
+        network._server_info_cache = network._read_server_info_cache()
+        return network
+
+    def test_expired_entries_are_not_used(self):
+        now = time.time()
+        network = self._make_network({'a:1:s': {'timestamp': now - 10}, 'b:1:s': {'timestamp': now - 7200}})
+        self.assertIsNotNone(network._get_cached_server_info(ServerAddr.from_str('a:1:s')))
+        self.assertIsNone(network._get_cached_server_info(ServerAddr.from_str('b:1:s')))
+        network._save_server_info_cache()
+        self.assertEqual(['a:1:s'], list(network._read_server_info_cache()))
+
+    def test_malformed_entries_are_dropped(self):
+        now = time.time()
+        network = self._make_network({'a:1:s': {'timestamp': now}, 'b:1:s': 'garbage',
+                                      'c:1:s': {'timestamp': 'yesterday'}, 'd:1:s': {}})
+        self.assertEqual(['a:1:s'], list(network._server_info_cache))
+        for server in ('b:1:s', 'c:1:s', 'd:1:s'):
+            self.assertIsNone(network._get_cached_server_info(ServerAddr.from_str(server)))
+        network._server_info_cache['e:1:s'] = [1, 2]
+        network._save_server_info_cache()
+        self.assertEqual(['a:1:s'], list(network._read_server_info_cache()))
+
+
+class TestStandbyFailover(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.get_event_loop()
+        self.chain = SimpleNamespace(height=lambda: 100)
+        network = Network.__new__(Network)
+        Logger.__init__(network)
+        network.config = SimpleConfig({'electrum_path': self.electrum_path})
+        network.oneserver = False
+        network.num_server = 10
+        network.interfaces_lock = threading.RLock()
+        network._blockchain = self.chain
+        self.main = self._make_iface('main')
+        network.interface = self.main
+        network.interfaces = {}
+        self.network = network
+
+    def _make_iface(self, name, *, tip=100, chain=None, ready=True):
+        fut = self.loop.create_future()
+        if ready:
+            fut.set_result(1)
+        return SimpleNamespace(server=ServerAddr.from_str(f'{name}:50002:s'), ready=fut, tip=tip,
+                               blockchain=chain or self.chain)
+
+    def _set_interfaces(self, *ifaces):
+        self.network.interfaces = {iface.server: iface for iface in (self.main,) + ifaces}
+
+    def test_standbys_are_synced_and_on_our_chain(self):
+        good = self._make_iface('good')
+        self._set_interfaces(good, self._make_iface('lagging', tip=99),
+                             self._make_iface('forked', chain=SimpleNamespace(height=lambda: 100)),
+                             self._make_iface('connecting', ready=False))
+        self.assertEqual([good], self.network._get_standby_interfaces())
+
+    def test_extra_connections_until_enough_standbys(self):
+        self._set_interfaces(self._make_iface('good'), self._make_iface('lagging', tip=99))
+        self.assertEqual(10 + 1, self.network._get_num_target_interfaces())
+        self._set_interfaces(self._make_iface('good1'), self._make_iface('good2'))
+        self.assertEqual(10, self.network._get_num_target_interfaces())
+        self.network.config.set_key('num_standby_servers', 12)
+        self.assertEqual(13 + 10, self.network._get_num_target_interfaces())
+        self.network.num_server = 0
+        self.assertEqual(0, self.network._get_num_target_interfaces())
+
+    def test_failover_switches_to_a_standby(self):
+        good = self._make_iface('good')
+        self._set_interfaces(good, self._make_iface('lagging', tip=50))
+        switched = []
+        async def switch_to_interface(server):
+            switched.append(server)
+        self.network.switch_to_interface = switch_to_interface
+        self.assertTrue(self.loop.run_until_complete(self.network._failover_to_standby_interface()))
+        self.assertEqual([good.server], switched)
+        self._set_interfaces(self._make_iface('lagging', tip=50))
+        self.assertFalse(self.loop.run_until_complete(self.network._failover_to_standby_interface()))
+        self.assertEqual([good.server], switched)
+
+
+class TestRequestHedger(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.get_event_loop()
+
+    async def _answer(self, result, delay):
+        await asyncio.sleep(delay)
+        return result
+
+    async def _fail(self, delay):
+        await asyncio.sleep(delay)
+        raise Exception("secondary failed")
+
+    def _make_hedger(self, **kwargs):
+        hedger = RequestHedger(**kwargs)
+        for i in range(RequestHedger.MIN_SAMPLES):
+            hedger.record_latency('m', 0.01)
+        return hedger
+
+    def test_hedge_delay_is_p95_of_latencies(self):
+        hedger = RequestHedger(min_delay=0)
+        self.assertEqual(hedger.default_delay, hedger.get_hedge_delay('m'))
+        for i in range(1, 101):
+            hedger.record_latency('m', i / 100)
+        self.assertEqual(0.96, hedger.get_hedge_delay('m'))
+        self.assertEqual(hedger.default_delay, hedger.get_hedge_delay('other'))
+
+    def test_fast_primary_is_not_hedged(self):
+        hedger = self._make_hedger(budget=1, min_delay=0.5)
+        pick_secondary = lambda: self.fail("should not hedge")
+        res = self.loop.run_until_complete(
+            hedger.run('m', lambda: self._answer('primary', 0), pick_secondary))
+        self.assertEqual('primary', res)
+        self.assertEqual(0, hedger.num_hedged)
+
+    def test_slow_primary_is_hedged(self):
+        hedger = self._make_hedger(budget=1)
+        res = self.loop.run_until_complete(
+            hedger.run('m', lambda: self._answer('primary', 5),
+                       lambda: (lambda: self._answer('secondary', 0))))
+        self.assertEqual('secondary', res)
+        self.assertEqual(1, hedger.num_hedged)
+
+    def test_failing_secondary_falls_back_to_primary(self):
+        hedger = self._make_hedger(budget=1)
+        res = self.loop.run_until_complete(
+            hedger.run('m', lambda: self._answer('primary', 0.05),
+                       lambda: (lambda: self._fail(0))))
+        self.assertEqual('primary', res)
+
+    def test_budget_limits_hedging(self):
+        hedger = self._make_hedger(budget=0)
+        res = self.loop.run_until_complete(
+            hedger.run('m', lambda: self._answer('primary', 0.05),
+                       lambda: (lambda: self._answer('secondary', 0))))
+        self.assertEqual('primary', res)
+        self.assertEqual(0, hedger.num_hedged)
+
+    def test_no_hedging_before_min_samples(self):
+        hedger = RequestHedger(budget=1, default_delay=0.01)
+        pick_secondary = lambda: self.fail("should not hedge")
+        res = self.loop.run_until_complete(
+            hedger.run('m', lambda: self._answer('primary', 0.05), pick_secondary))
+        self.assertEqual('primary', res)
+        self.assertEqual(0, hedger.num_hedged)
+        self.assertEqual(1, len(hedger._latencies['m']))
+
+    def test_loser_is_cancelled_and_recorded(self):
+        hedger = self._make_hedger(budget=1)
+        primary_finished = []
+        async def primary():
+            await asyncio.sleep(0.3)
+            primary_finished.append(True)
+            return 'primary'
+        res = self.loop.run_until_complete(
+            hedger.run('m', primary, lambda: (lambda: self._answer('secondary', 0))))
+        self.assertEqual('secondary', res)
+        # the primary's latency is at least the time it ran before being cancelled
+        self.assertEqual(RequestHedger.MIN_SAMPLES + 2, len(hedger._latencies['m']))
+        self.assertGreaterEqual(max(hedger._latencies['m']), 0.01)
+        self.loop.run_until_complete(asyncio.sleep(0.4))
+        self.assertEqual([], primary_finished)
+        self.assertEqual(RequestHedger.MIN_SAMPLES + 2, len(hedger._latencies['m']))
+
+
+class TestRequestTracer(ElectrumTestCase):
+
+    def test_ring_buffer_and_summary(self):
+        tracer = RequestTracer(size=3)
+        for i in range(4):
+            tracer.record(RequestTrace(method='blockchain.transaction.get', param_size=70,
+                                       send_time=100.0 + i, recv_time=100.5 + i,
+                                       response_size=500, outcome='ok'))
+        tracer.record(RequestTrace(method='server.ping', param_size=2, send_time=200.0,
+                                   recv_time=230.0, response_size=0, outcome='timeout'))
+        self.assertEqual(3, len(tracer.traces))
+        summary = tracer.get_summary()
+        self.assertEqual(2, summary['blockchain.transaction.get']['count'])
+        self.assertEqual(1000, summary['blockchain.transaction.get']['bytes_received'])
+        self.assertEqual(500.0, summary['blockchain.transaction.get']['latency_avg_ms'])
+        self.assertEqual({'timeout': 1}, summary['server.ping']['outcomes'])
+
+    def test_chrome_trace_events(self):
+        tracer = RequestTracer()
+        tracer.record(RequestTrace(method='server.ping', param_size=2, send_time=1.5,
+                                   recv_time=1.75, response_size=4, outcome='ok'))
+        events = tracer.get_chrome_trace_events(pid=1, tid=7)
+        self.assertEqual(1, len(events))
+        self.assertEqual('X', events[0]['ph'])
+        self.assertEqual(1_500_000, events[0]['ts'])
+        self.assertEqual(250_000, events[0]['dur'])
+        self.assertEqual(7, events[0]['tid'])
+
+    def test_disabled(self):
+        self.assertFalse(RequestTracer(size=0).is_enabled())
+
+    def test_tracing_is_opt_in(self):
+        config = SimpleConfig({'electrum_path': self.electrum_path})
+        self.assertFalse(MockInterface(config).request_tracer.is_enabled())
+        config.set_key('network_request_trace', True)
+        self.assertTrue(MockInterface(config).request_tracer.is_enabled())
+
+
+class MockTransport:
+    kind = SessionKind.CLIENT
+
+
+class MockSession(NotificationSession):
+    def __init__(self):
+        super().__init__(MockTransport(), interface=None)
+        self.requests = []
+
+    async def send_request(self, method, params, **kwargs):
+        self.requests.append((method, params))
+        await asyncio.sleep(0.01)
+        return 'status'
+
+    async def send_batch_request(self, method, params_list, **kwargs):
+        self.requests.append((method, list(params_list)))
+        await asyncio.sleep(0.01)
+        return [RPCError(1, 'history too large') if params == ['ff' * 32] else 'status'
+                for params in params_list]
+
+
+class TestNotificationSession(ElectrumTestCase):
+
+    def test_concurrent_subscriptions_share_one_request(self):
+        session = MockSession()
+        queues = [asyncio.Queue() for _ in range(5)]
+        sh = 'aa' * 32
+        async def f():
+            await asyncio.gather(*[session.subscribe('blockchain.scripthash.subscribe', [sh], q)
+                                   for q in queues])
+            await session.subscribe('blockchain.scripthash.subscribe', [sh], asyncio.Queue())
+        asyncio.get_event_loop().run_until_complete(f())
+        self.assertEqual(1, len(session.requests))
+        for q in queues:
+            self.assertEqual([sh, 'status'], q.get_nowait())
+
+    def test_unsubscribe(self):
+        session = MockSession()
+        q1, q2 = asyncio.Queue(), asyncio.Queue()
+        async def f():
+            await session.subscribe('blockchain.scripthash.subscribe', ['aa' * 32], q1)
+            await session.subscribe('blockchain.scripthash.subscribe', ['bb' * 32], q1)
+            await session.subscribe('blockchain.scripthash.subscribe', ['aa' * 32], q2)
+        asyncio.get_event_loop().run_until_complete(f())
+        session.unsubscribe(q1)
+        key_a = session.get_hashable_key_for_rpc_call('blockchain.scripthash.subscribe', ['aa' * 32])
+        key_b = session.get_hashable_key_for_rpc_call('blockchain.scripthash.subscribe', ['bb' * 32])
+        self.assertEqual([q2], session.subscriptions[key_a])
+        self.assertNotIn(key_b, session.subscriptions)
+        # the server keeps notifying us, the last result is kept around for a while
+        self.assertIn(key_b, session._unsubscribed_keys)
+        self.assertEqual('status', session._stale_cache[key_b])
+
+    def test_subscribe_many_sends_one_batch(self):
+        session = MockSession()
+        q = asyncio.Queue()
+        method = 'blockchain.scripthash.subscribe'
+        async def f():
+            await session.subscribe(method, ['aa' * 32], asyncio.Queue())
+            await session.subscribe_many(method, [['aa' * 32], ['bb' * 32], ['cc' * 32]], q)
+        asyncio.get_event_loop().run_until_complete(f())
+        self.assertEqual([(method, ['aa' * 32]), (method, [['bb' * 32], ['cc' * 32]])], session.requests)
+        self.assertEqual(['aa' * 32, 'status'], q.get_nowait())
+        self.assertEqual(['bb' * 32, 'status'], q.get_nowait())
+        self.assertEqual(['cc' * 32, 'status'], q.get_nowait())
+
+    def test_subscribe_many_concurrent_unsubscribe(self):
+        session = MockSession()
+        q1, q2 = asyncio.Queue(), asyncio.Queue()
+        method = 'blockchain.scripthash.subscribe'
+        send_batch_request = session.send_batch_request
+        async def unsubscribe_while_sending(*args, **kwargs):
+            session.unsubscribe(q1)
+            session.unsubscribe(q2)
+            return await send_batch_request(*args, **kwargs)
+        session.send_batch_request = unsubscribe_while_sending
+        async def f():
+            await session.subscribe(method, ['aa' * 32], q1)
+            await session.subscribe_many(method, [['aa' * 32], ['bb' * 32], ['cc' * 32]], q2)
+        asyncio.get_event_loop().run_until_complete(f())
+        self.assertEqual(['aa' * 32, 'status'], q2.get_nowait())
+        self.assertEqual(['bb' * 32, 'status'], q2.get_nowait())
+        self.assertEqual(['cc' * 32, 'status'], q2.get_nowait())
+
+    def test_subscribe_many_error(self):
+        session = MockSession()
+        q = asyncio.Queue()
+        method = 'blockchain.scripthash.subscribe'
+        coro = session.subscribe_many(method, [['ff' * 32], ['bb' * 32]], q)
+        with self.assertRaises(RPCError):
+            asyncio.get_event_loop().run_until_complete(coro)
+        # the other subscription went through
+        self.assertEqual(['bb' * 32, 'status'], q.get_nowait())
+        self.assertTrue(q.empty())
+
+    def test_stale_cache_is_bounded(self):
+        session = MockSession()
+        session._stale_cache_size = 2
+        async def f():
+            for i in range(4):
+                q = asyncio.Queue()
+                await session.subscribe('blockchain.scripthash.subscribe', [bytes([i]).hex() * 32], q)
+                session.unsubscribe(q)
+            # resubscribing to a key still in the stale cache needs no request
+            await session.subscribe('blockchain.scripthash.subscribe', [bytes([3]).hex() * 32], asyncio.Queue())
+        asyncio.get_event_loop().run_until_complete(f())
+        self.assertEqual(4, len(session.requests))
+        self.assertEqual(1, len(session._stale_cache))
+        self.assertEqual(3, len(session._unsubscribed_keys))
+
+    def test_compact_keys(self):
+        method = 'blockchain.scripthash.subscribe'
+        self.assertEqual(b'\x01' + bytes(range(32)),
+                         NotificationSession.get_hashable_key_for_rpc_call(method, [bytes(range(32)).hex()]))
+        self.assertEqual(b'\x02', NotificationSession.get_hashable_key_for_rpc_call('blockchain.headers.subscribe', []))
+        self.assertEqual((method, 'not hex'), NotificationSession.get_hashable_key_for_rpc_call(method, ['not hex']))
+        self.assertEqual((method, 'ab ' * 21 + 'a'),
+                         NotificationSession.get_hashable_key_for_rpc_call(method, ['ab ' * 21 + 'a']))
+
+    def test_compact_keys_of_many_subscriptions(self):
+        method = 'blockchain.scripthash.subscribe'
+        n = 5000
+        keys = set()
+        for i in range(n):
+            key = NotificationSession.get_hashable_key_for_rpc_call(method, [i.to_bytes(32, 'big').hex()])
+            # a one-byte method tag and the 32-byte scripthash, instead of a repr string
+            self.assertIs(bytes, type(key))
+            self.assertEqual(33, len(key))
+            keys.add(key)
+        self.assertEqual(n, len(keys))
+
+
+RAW_TX = ('01000000012a5c9a94fcde98f5581cd00162c60a13936ceb75389ea65bf38633b424eb4031000000006c493046022100a82bb'
+          'c57a0136751e5433f41cf000b3f1a99c6744775e76ec764fb78c54ee100022100f9e80b7de89de861dc6fb0c1429d5da72c2b6b'
+          '2ee2406bc9bfb1beedd729d985012102e61d176da16edd1d258a200ad9759ef63adf8e14cd97f53227bae35cdb84d2f6ffffffff'
+          '0140420f00000000001976a914230ac37834073a42146f11ef8414ae929feaafc388ac00000000')
+
+
+class MockWalletDB:
+    def get_addr_history(self, addr): return []
+    def get_transaction(self, tx_hash): return None
+
+
+class MockWallet:
+    def __init__(self, network):
+        self.network = network
+        self.db = MockWalletDB()
+        self.histories = {}
+        self.txs = {}
+    def diagnostic_name(self): return 'mock-wallet'
+    def get_address_history_status(self, addr): return None
+    def receive_history_callback(self, addr, hist, tx_fees): self.histories[addr] = hist
+    def receive_tx_callback(self, tx_hash, tx, tx_height): self.txs[tx_hash] = tx_height
+
+
+class MockSyncInterface:
+    def __init__(self, histories, *, max_batch_size=None):
+        self.histories = histories
+        self.max_batch_size = max_batch_size  # larger batches time out, like a dropped response
+        self.batches = []
+        self.items_in_flight = 0
+        self.max_items_in_flight = 0
+    async def _answer(self, num_items):
+        self.items_in_flight += num_items
+        self.max_items_in_flight = max(self.max_items_in_flight, self.items_in_flight)
+        try:
+            await asyncio.sleep(0.01)
+        finally:
+            self.items_in_flight -= num_items
+    async def get_history_for_scripthashes(self, shs):
+        self.batches.append(('history', list(shs)))
+        await self._answer(len(shs))
+        if self.max_batch_size is not None and len(shs) > self.max_batch_size:
+            raise RequestTimedOut('batch request timed out')
+        return [self.histories[sh] for sh in shs]
+    async def get_transactions(self, tx_hashes):
+        self.batches.append(('tx', list(tx_hashes)))
+        await self._answer(len(tx_hashes))
+        return [Transaction(RAW_TX) if tx_hash == Transaction(RAW_TX).txid() else RPCError(2, 'not found')
+                for tx_hash in tx_hashes]
+
+
+class TestSynchronizerBatching(ElectrumTestCase):
+
+    ADDRS = ['1BoatSLRHtKNngkdXEeobR76b53LETtpyT', '1MsHWS1BnwMc3tLE8G35UXsS58fKipzB7a',
+             '1Q1pE5vPGEEMqRcVRMbtBK842Y6Pzo6nK9', '12c6DSiU4Rq3P4ZxziKxzrL5LmMBrzjrJX']
+
+    def _sync_addresses(self, addrs, *, batch_size=3, max_batch_size=None, batch_delay=None,
+                        max_items_in_flight=None):
+        config = SimpleConfig({'electrum_path': self.electrum_path, 'synchronizer_batch_size': batch_size})
+        if batch_delay is not None:
+            config.set_key('synchronizer_batch_delay', batch_delay)
+        if max_items_in_flight is not None:
+            config.set_key('synchronizer_max_items_in_flight', max_items_in_flight)
+        network = MockNetwork()
+        network.config = config
+        network.interface = None
+        wallet = MockWallet(network)
+        txid = Transaction(RAW_TX).txid()
+        hist = [(txid, 1)]
+        histories = {address_to_scripthash(addr): [{'tx_hash': txid, 'height': 1}] for addr in addrs}
+        async def f():
+            sync = Synchronizer(wallet)
+            sync.interface = MockSyncInterface(histories, max_batch_size=max_batch_size)
+            async with sync.taskgroup as group:
+                await group.spawn(sync._send_batches(sync._history_queue, sync._request_histories,
+                                                     sync._estimate_history_response_size))
+                await group.spawn(sync._send_batches(sync._tx_queue, sync._get_transactions,
+                                                     sync._estimate_tx_response_size))
+                for addr in addrs:
+                    await sync._on_address_status(addr, history_status(hist))
+                await sync._request_missing_txs([('00' * 32, 2)], allow_server_not_finding_tx=True)
+                while not sync.is_up_to_date():
+                    await asyncio.sleep(0.01)
+                await group.cancel_remaining()
+            return sync
+        sync = asyncio.get_event_loop().run_until_complete(f())
+        return sync, wallet
+
+    def test_histories_and_txs_are_fetched_in_batches(self):
+        addrs = self.ADDRS
+        txid = Transaction(RAW_TX).txid()
+        hist = [(txid, 1)]
+        sync, wallet = self._sync_addresses(addrs)
+        batches = sync.interface.batches
+        self.assertEqual([[address_to_scripthash(addr) for addr in addrs[:3]],
+                          [address_to_scripthash(addrs[3])]],
+                         [params for kind, params in batches if kind == 'history'])
+        # each missing tx is requested once, although it is in the history of all addresses
+        self.assertEqual(sorted(['00' * 32, txid]),
+                         sorted(tx_hash for kind, params in batches if kind == 'tx' for tx_hash in params))
+        self.assertEqual({addr: hist for addr in addrs}, wallet.histories)
+        self.assertEqual({txid: 1}, wallet.txs)
+
+    def test_batches_are_capped_by_expected_response_size(self):
+        addrs = self.ADDRS
+        # room for the expected histories of two addresses
+        with mock.patch.object(synchronizer, 'SYNC_BATCH_MAX_RESPONSE_SIZE',
+                               2 * synchronizer.HISTORY_ITEM_RESPONSE_SIZE):
+            sync, wallet = self._sync_addresses(addrs, batch_size=100)
+        self.assertEqual([[address_to_scripthash(addr) for addr in addrs[:2]],
+                          [address_to_scripthash(addr) for addr in addrs[2:]]],
+                         [params for kind, params in sync.interface.batches if kind == 'history'])
+        self.assertEqual(set(addrs), set(wallet.histories))
+
+    def test_timed_out_batch_is_retried_in_halves(self):
+        addrs = self.ADDRS
+        shs = [address_to_scripthash(addr) for addr in addrs]
+        sync, wallet = self._sync_addresses(addrs, batch_size=4, max_batch_size=2)
+        self.assertEqual([shs, shs[:2], shs[2:]],
+                         [params for kind, params in sync.interface.batches if kind == 'history'])
+        self.assertEqual(set(addrs), set(wallet.histories))
+        sync, wallet = self._sync_addresses(addrs, batch_size=4, max_batch_size=1)
+        self.assertEqual([shs, shs[:2], shs[:1], shs[1:2], shs[2:], shs[2:3], shs[3:]],
+                         [params for kind, params in sync.interface.batches if kind == 'history'])
+        self.assertEqual(set(addrs), set(wallet.histories))
+
+    def test_items_in_flight_are_limited(self):
+        addrs = self.ADDRS
+        sync, wallet = self._sync_addresses(addrs, batch_size=1, batch_delay=0)
+        self.assertLess(2, sync.interface.max_items_in_flight)
+        sync, wallet = self._sync_addresses(addrs, batch_size=1, batch_delay=0, max_items_in_flight=2)
+        self.assertEqual(2, sync.interface.max_items_in_flight)
+        self.assertEqual(set(addrs), set(wallet.histories))
+        self.assertEqual(2, sync._items_in_flight._value)
+
+    def test_fetched_tx_is_deserialized_once(self):
+        txid = Transaction(RAW_TX).txid()
+        tx = Interface._deserialize_transaction_response(txid, RAW_TX)
+        self.assertEqual(txid, tx._cached_txid)
+        self.assertIsNotNone(tx._inputs)
+        # the db keeps the validated object instead of parsing it again
+        db = WalletDB('', manual_upgrades=False)
+        db.add_transaction(txid, tx)
+        self.assertIs(tx, db.get_transaction(txid))
+
+
 if __name__=="__main__":
     constants.set_regtest()
     unittest.main()
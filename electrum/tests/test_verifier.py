@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
-
 from electrum.bitcoin import hash_encode
+from electrum.crypto import sha256, sha256d
 from electrum.transaction import Transaction
-from electrum.util import bfh
-from electrum.verifier import SPV, InnerNodeOfSpvProofIsValidTx
+from electrum.util import bfh, create_process_pool
+from electrum.verifier import (SPV, InnerNodeOfSpvProofIsValidTx, MerkleVerifier, MerkleRootMismatch,
+                               MerkleVerificationFailure, verify_merkle_proofs)
 
 from . import TestCaseForTestnet
 
@@ -48,3 +49,56 @@ class VerifierTestCase(TestCaseForTestnet):
         f_tx_hash = hash_encode(bfh(VALID_64_BYTE_TX[:64]))
         with self.assertRaises(InnerNodeOfSpvProofIsValidTx):
             SPV.hash_merkle_root(fake_mbranch, f_tx_hash, 6)
+
+
+class MerkleVerifierTestCase(TestCaseForTestnet):
+
+    def setUp(self):
+        super().setUp()
+        # a block with 8 txs
+        self.leaves = [sha256(bytes([i])) for i in range(8)]
+        self.levels = [self.leaves]
+        while len(self.levels[-1]) > 1:
+            level = self.levels[-1]
+            self.levels.append([sha256d(level[i] + level[i+1]) for i in range(0, len(level), 2)])
+        self.merkle_root = hash_encode(self.levels[-1][0])
+
+    def _branch(self, pos):
+        return [hash_encode(level[(pos >> i) ^ 1]) for i, level in enumerate(self.levels[:-1])]
+
+    def test_verify_all_txs_of_block(self):
+        verifier = MerkleVerifier(self.merkle_root)
+        for pos, leaf in enumerate(self.leaves):
+            tx_hash = hash_encode(leaf)
+            self.assertEqual(self.merkle_root, SPV.hash_merkle_root(self._branch(pos), tx_hash, pos))
+            verifier.verify(tx_hash, self._branch(pos), pos)
+        # every inner node below the root got remembered
+        self.assertEqual(4 + 2 + 1, len(verifier._verified_nodes))
+
+    def test_wrong_branch_not_accepted_after_cache_is_warm(self):
+        verifier = MerkleVerifier(self.merkle_root)
+        verifier.verify(hash_encode(self.leaves[0]), self._branch(0), 0)
+        branch = self._branch(1)
+        branch[0] = hash_encode(sha256(b'x'))
+        with self.assertRaises(MerkleRootMismatch):
+            verifier.verify(hash_encode(self.leaves[1]), branch, 1)
+        with self.assertRaises(MerkleRootMismatch):
+            verifier.verify(hash_encode(self.leaves[1]), self._branch(1), 2)
+        with self.assertRaises(MerkleVerificationFailure):
+            verifier.verify(hash_encode(self.leaves[1]), self._branch(1), 8)
+
+    def test_inner_node_is_valid_tx(self):
+        fake_branch_node = hash_encode(bfh(VALID_64_BYTE_TX[:64]))
+        f_tx_hash = hash_encode(bfh(VALID_64_BYTE_TX[64:]))
+        with self.assertRaises(InnerNodeOfSpvProofIsValidTx):
+            MerkleVerifier(MERKLE_ROOT).verify(f_tx_hash, [fake_branch_node] + MERKLE_BRANCH, 7)
+
+    def test_verify_merkle_proofs_in_process_pool(self):
+        proofs = [(hash_encode(leaf), self._branch(pos), pos, self.merkle_root)
+                  for pos, leaf in enumerate(self.leaves)]
+        proofs.append((hash_encode(self.leaves[0]), self._branch(0), 1, self.merkle_root))
+        # workers are spawned: they import the modules they need themselves
+        with create_process_pool(1) as pool:
+            errors = pool.submit(verify_merkle_proofs, proofs).result()
+        self.assertEqual([None] * 8, errors[:8])
+        self.assertIsInstance(errors[8], MerkleRootMismatch)
@@ -7,6 +7,10 @@ from decimal import Decimal
 import time
 from io import StringIO
 import asyncio
+import copy
+import pickle
+import threading
+from unittest import mock
 
 from electrum.storage import WalletStorage
 from electrum.wallet_db import FINAL_SEED_VERSION
@@ -14,8 +18,12 @@ from electrum.wallet import (Abstract_Wallet, Standard_Wallet, create_new_wallet
                              restore_wallet_from_text, Imported_Wallet, Wallet)
 from electrum.exchange_rate import ExchangeBase, FxThread
 from electrum.util import TxMinedInfo, InvalidPassword
+from electrum.transaction import TxOutpoint
 from electrum.bitcoin import COIN
 from electrum.wallet_db import WalletDB
+from electrum.json_db import StoredList
+from electrum import wallet_db
+from electrum.address_synchronizer import HistoryIndex
 from electrum.simple_config import SimpleConfig
 from electrum import util
 
@@ -223,6 +231,24 @@ class TestCreateRestoreWallet(WalletTestCase):
         wallet.delete_address('bc1qnp78h78vp92pwdwq5xvh8eprlga5q8gu66960c')
         self.assertEqual(1, len(wallet.get_receiving_addresses()))
 
+    def test_import_addresses_in_bulk_from_file(self):
+        text = 'bc1q2ccr34wzep58d4239tl3x3734ttle92a8srmuw'
+        wallet = restore_wallet_from_text(text, path=self.wallet_path, config=self.config)['wallet']  # type: Imported_Wallet
+        path = os.path.join(self.user_dir, 'addresses.txt')
+        with open(path, 'w') as f:
+            f.write('1BoatSLRHtKNngkdXEeobR76b53LETtpyT\n\n'
+                    'bc1qnp78h78vp92pwdwq5xvh8eprlga5q8gu66960c\n'
+                    'bc1q2ccr34wzep58d4239tl3x3734ttle92a8srmuw\n'
+                    '1BoatSLRHtKNngkdXEeobR76b53LETtpyT\n'
+                    'not an address\n')
+        good, bad = wallet.import_addresses_from_file(path)
+        self.assertEqual(['1BoatSLRHtKNngkdXEeobR76b53LETtpyT', 'bc1qnp78h78vp92pwdwq5xvh8eprlga5q8gu66960c'], good)
+        self.assertEqual(['bc1q2ccr34wzep58d4239tl3x3734ttle92a8srmuw', '1BoatSLRHtKNngkdXEeobR76b53LETtpyT',
+                          'not an address'], [addr for addr, reason in bad])
+        self.assertEqual(3, len(wallet.get_addresses()))
+        for addr in good:
+            self.assertTrue(wallet.is_mine(addr))
+
     def test_restore_wallet_from_text_privkeys(self):
         text = 'p2wpkh:L4jkdiXszG26SUYvwwJhzGwg37H2nLhrbip7u6crmgNeJysv5FHL p2wpkh:L24GxnN7NNUAfCXA6hFzB1jt59fYAAiFZMcLaJ2ZSawGpM3uqhb1'
         d = restore_wallet_from_text(text, path=self.wallet_path, config=self.config)
@@ -300,3 +326,194 @@ class TestWalletPassword(WalletTestCase):
         with self.assertRaises(InvalidPassword):
             wallet.check_password("wrong password")
         wallet.check_password("1234")
+
+
+class TestWalletFileJournal(WalletTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.config.set_key('wallet_file_journal', True)
+        text = 'zpub6nydoME6CFdJtMpzHW5BNoPz6i6XbeT9qfz72wsRqGdgGEYeivso6xjfw8cGcCyHwF7BNW4LDuHF35XrZsovBLWMF4qXSjmhTXYiHbWqGLt'
+        self.wallet = restore_wallet_from_text(text, path=self.wallet_path, gap_limit=2, config=self.config)['wallet']
+
+    def _read_file(self):
+        with open(self.wallet_path, "r") as f:
+            return f.read()
+
+    def _load_db(self, password=None):
+        storage = WalletStorage(self.wallet_path)
+        if password is not None:
+            storage.decrypt(password)
+        return WalletDB(storage.read(), manual_upgrades=False)
+
+    def _make_changes(self):
+        wallet = self.wallet
+        addr = wallet.get_receiving_addresses()[0]
+        wallet.set_label(addr, 'first')
+        wallet.set_label('some txid', 'tx label')
+        wallet.set_label('some txid', None)
+        wallet.create_new_address(False)
+        wallet.create_new_address(True)
+        wallet.db.put('stored_height', 123)
+        wallet.db.add_prevout_by_scripthash('aa' * 32, prevout=TxOutpoint(bytes(32), 1), value=1000)
+
+    def test_save_appends_changes(self):
+        snapshot = self._read_file()
+        self._make_changes()
+        self.wallet.save_db()
+        contents = self._read_file()
+        self.assertTrue(contents.startswith(snapshot))
+        journal = contents[len(snapshot):]
+        self.assertEqual(1, journal.count('\n'))
+        self.assertLess(len(journal), 1000)
+        db = self._load_db()
+        self.assertEqual(json.loads(self.wallet.db.dump()), json.loads(db.dump()))
+        self.assertEqual('first', db.get('labels')[self.wallet.get_receiving_addresses()[0]])
+        self.assertEqual(3, len(db.get('addresses')['receiving']))
+        # nothing changed: nothing is appended
+        self.wallet.save_db()
+        self.assertEqual(contents, self._read_file())
+
+    def test_write_between_record_and_append(self):
+        self.wallet.save_db()
+        db = self.wallet.db
+        receiving = db.get('addresses')['receiving']
+        record_change = db.record_change
+        writers = []
+        def record_change_then_write(*args, **kwargs):
+            record_change(*args, **kwargs)
+            # another thread writes the db before the item is appended
+            writer = threading.Thread(target=db.write, args=(self.wallet.storage,))
+            writer.start()
+            writer.join(0.1)
+            writers.append(writer)
+        with mock.patch.object(db, 'record_change', record_change_then_write):
+            receiving.append('some address')
+        for writer in writers:
+            writer.join()
+        self.wallet.save_db()
+        self.assertEqual('some address', self._load_db().get('addresses')['receiving'][-1])
+
+    def test_failed_append_is_not_lost(self):
+        self.wallet.save_db()
+        storage = self.wallet.storage
+        # the append fails, and so does the full write it falls back to
+        self.wallet.set_label('txid1', 'first')
+        with mock.patch.object(storage, 'append', side_effect=OSError(28, 'No space left on device')), \
+                mock.patch.object(storage, 'write', side_effect=OSError(28, 'No space left on device')):
+            with self.assertRaises(OSError):
+                self.wallet.save_db()
+        self.assertTrue(self.wallet.db.modified())
+        self.wallet.save_db()
+        self.assertEqual('first', self._load_db().get('labels')['txid1'])
+        # the append fails, the full write succeeds
+        self.wallet.set_label('txid2', 'second')
+        with mock.patch.object(storage, 'append', side_effect=OSError(5, 'Input/output error')):
+            self.wallet.save_db()
+        self.assertFalse(self.wallet.db.modified())
+        db = self._load_db()
+        self.assertEqual(json.loads(self.wallet.db.dump()), json.loads(db.dump()))
+        self.assertEqual('second', db.get('labels')['txid2'])
+
+    def test_journal_is_compacted(self):
+        self._make_changes()
+        with mock.patch.object(wallet_db, 'MIN_JOURNAL_SIZE_FOR_COMPACTION', 0):
+            for i in range(20):
+                self.wallet.set_label(f'txid{i}', 'x' * 1000)
+                self.wallet.save_db()
+        # the journal never gets larger than the snapshot it follows
+        contents = self._read_file()
+        _, snapshot_size = json.JSONDecoder().raw_decode(contents)
+        self.assertLessEqual(len(contents) - snapshot_size, snapshot_size)
+        db = self._load_db()
+        self.assertEqual(json.loads(self.wallet.db.dump()), json.loads(db.dump()))
+
+    def test_incomplete_journal_line_is_ignored(self):
+        self.wallet.set_label('txid', 'saved')
+        self.wallet.save_db()
+        expected = json.loads(self.wallet.db.dump())
+        with open(self.wallet_path, "a") as f:
+            f.write('\n[["set", ["labels", "txid"], "not sa')
+        db = self._load_db()
+        self.assertEqual(expected, json.loads(db.dump()))
+        # the next write replaces the file
+        self.assertTrue(db.modified())
+        db.write(WalletStorage(self.wallet_path))
+        self.assertEqual(expected, json.loads(self._read_file()))
+
+    def test_encrypted_file(self):
+        self.wallet.update_password(None, "1234", encrypt_storage=True)
+        self.wallet.save_db()
+        self._make_changes()
+        self.wallet.save_db()
+        self.assertEqual(2, len(self._read_file().split('\n')))
+        db = self._load_db(password="1234")
+        self.assertEqual(json.loads(self.wallet.db.dump()), json.loads(db.dump()))
+
+
+class TestStoredList(ElectrumTestCase):
+
+    def _get_stored_list(self):
+        db = WalletDB('', manual_upgrades=False)
+        db.put('items', [1, [2, 3]])
+        db.set_modified(False)
+        db.enable_journal()
+        items = db.get('items')
+        self.assertIsInstance(items, StoredList)
+        return db, items
+
+    def test_copy_is_a_plain_list(self):
+        db, items = self._get_stored_list()
+        items_copy = copy.copy(items)
+        self.assertIs(list, type(items_copy))
+        self.assertEqual([1, [2, 3]], items_copy)
+        items_copy.append(4)
+        self.assertEqual([1, [2, 3]], db.get('items'))
+        self.assertIsNone(db.dump_journal())
+
+    def test_deepcopy_is_a_plain_list(self):
+        db, items = self._get_stored_list()
+        items_copy = copy.deepcopy({'items': items})['items']
+        self.assertIs(list, type(items_copy))
+        self.assertEqual([1, [2, 3]], items_copy)
+        items_copy[1].append(4)
+        self.assertEqual([1, [2, 3]], db.get('items'))
+        self.assertIsNone(db.dump_journal())
+        self.assertEqual([1, [2, 3]], pickle.loads(pickle.dumps(items)))
+
+
+class TestWalletDBHistory(ElectrumTestCase):
+
+    def test_add_empty_addr_histories(self):
+        db = WalletDB('', manual_upgrades=False)
+        hist = [('00' * 32, 1)]
+        db.set_addr_history('addr1', hist)
+        db.set_modified(False)
+        self.assertEqual(['addr2'], db.add_empty_addr_histories(['addr1', 'addr2']))
+        self.assertTrue(db.modified())
+        self.assertEqual(hist, db.get_addr_history('addr1'))
+        self.assertEqual([], db.get_addr_history('addr2'))
+        self.assertEqual(['addr1', 'addr2'], sorted(db.get_history()))
+        # importing an existing unused address is not new
+        self.assertEqual([], db.add_empty_addr_histories(['addr2']))
+        self.assertEqual([], db.get_addr_history('addr2'))
+
+
+class TestHistoryIndex(ElectrumTestCase):
+
+    def test_entries_are_ordered_with_running_balances(self):
+        index = HistoryIndex()
+        index.update('cc', (1e9, -1), 5)
+        index.update('aa', (100, 1), 10)
+        index.update('bb', (100, 0), -3)
+        self.assertEqual([('bb', -3, -3), ('aa', 10, 7), ('cc', 5, 12)], index.get_items())
+        # tx gets mined: it moves, and balances after its old and new position follow
+        index.update('cc', (99, 4), 5)
+        self.assertEqual([('cc', 5, 5), ('bb', -3, 2), ('aa', 10, 12)], index.get_items())
+        index.update('bb', (100, 0), -4)
+        self.assertEqual([('bb', -4, 1), ('aa', 10, 11)], index.get_items(1))
+        index.remove('cc')
+        index.remove('unknown')
+        self.assertEqual([('bb', -4, -4)], index.get_items(0, 1))
+        self.assertEqual(2, len(index))
+        self.assertNotIn('cc', index)
@@ -5,14 +5,16 @@ import tempfile
 from typing import Sequence
 import asyncio
 import copy
+import threading
 
 from electrum import storage, bitcoin, keystore, bip32, wallet
 from electrum import Transaction
 from electrum import SimpleConfig
-from electrum.address_synchronizer import TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT
+from electrum.address_synchronizer import TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT, TX_HEIGHT_LOCAL
+from electrum.synchronizer import history_status
 from electrum.wallet import (sweep, Multisig_Wallet, Standard_Wallet, Imported_Wallet,
                              restore_wallet_from_text, Abstract_Wallet, BumpFeeStrategy)
-from electrum.util import bfh, bh2u, create_and_start_event_loop, NotEnoughFunds
+from electrum.util import bfh, bh2u, create_and_start_event_loop, NotEnoughFunds, TxMinedInfo
 from electrum.transaction import (TxOutput, Transaction, PartialTransaction, PartialTxOutput,
                                   PartialTxInput, tx_from_any, TxOutpoint)
 from electrum.mnemonic import seed_type
@@ -430,6 +432,60 @@ class TestWalletKeystoreAddressIntegrityForMainnet(ElectrumTestCase):
         self.assertEqual(w.get_receiving_addresses()[0], '35LeC45QgCVeRor1tJD6LiDgPbybBXisns')
         self.assertEqual(w.get_change_addresses()[0], '39RhtDchc6igmx5tyoimhojFL1ZbQBrXa6')
 
+    @mock.patch.object(wallet.Abstract_Wallet, 'save_db')
+    def test_derive_addresses_in_bulk(self, mock_save_db):
+        ks1 = keystore.from_seed('bitter grass shiver impose acquire brush forget axis eager alone wine silver', '', False)
+        ks2 = keystore.from_seed('powerful random nobody notice nothing important anyway look away hidden message over', '', False)
+        ks3 = keystore.from_xpub('xpub661MyMwAqRbcGfCPEkkyo5WmcrhTq8mi3xuBS7VEZ3LYvsgY1cCFDbenT33bdD12axvrmXhuX3xkAbKci3yZY9ZEk8vhLic7KNhLjqdh5ec')
+        ks4 = keystore.from_xpub('xpub661MyMwAqRbcGNEPu3aJQqXTydqR9t49Tkwb4Esrj112kw8xLthv8uybxvaki4Ygt9xiwZUQGeFTG7T2TUzR3eA4Zp3aq5RXsABHFBUrq4c')
+        wallets = [
+            WalletIntegrityHelper.create_standard_wallet(ks1, config=self.config),
+            WalletIntegrityHelper.create_standard_wallet(ks2, config=self.config),
+            WalletIntegrityHelper.create_multisig_wallet([ks3, ks4], '2of2', config=self.config),
+        ]
+        for w in wallets:
+            for for_change in (0, 1):
+                expected = [w.derive_address(for_change, n) for n in range(3, 15)]
+                self.assertEqual(expected, w.derive_addresses(for_change, 3, 15))
+                self.config.set_key('wallet_derivation_processes', 2)
+                self.config.set_key('wallet_derivation_pool_min_addresses', 5)
+                try:
+                    self.assertEqual(expected, w.derive_addresses(for_change, 3, 15))
+                finally:
+                    self.config.set_key('wallet_derivation_processes', 0)
+        # the pool is reused across calls and wallets, until it is shut down
+        pool = wallet.get_derivation_pool(2)
+        self.assertIs(pool, wallet.get_derivation_pool(2))
+        wallet.shutdown_derivation_pool()
+        self.assertIsNot(pool, wallet.get_derivation_pool(2))
+        wallet.shutdown_derivation_pool()
+
+    @mock.patch.object(wallet.Abstract_Wallet, 'save_db')
+    def test_addresses_are_derived_without_holding_the_lock(self, mock_save_db):
+        ks = keystore.from_seed('bitter grass shiver impose acquire brush forget axis eager alone wine silver', '', False)
+        w = WalletIntegrityHelper.create_standard_wallet(ks, config=self.config)
+        derive_addresses = w.derive_addresses
+        lock_was_free = []
+        def derive_and_check_lock(*args):
+            w.derive_addresses = derive_addresses
+            # another thread creates an address meanwhile
+            def other_thread():
+                if w.lock.acquire(timeout=5):
+                    lock_was_free.append(True)
+                    w.lock.release()
+                    w.create_new_address(False)
+            t = threading.Thread(target=other_thread)
+            t.start()
+            t.join()
+            return derive_addresses(*args)
+        num_addr = len(w.get_receiving_addresses())
+        w.derive_addresses = derive_and_check_lock
+        addresses = w.create_new_addresses(False, 2)
+        self.assertEqual([True], lock_was_free)
+        self.assertEqual(num_addr + 3, len(w.get_receiving_addresses()))
+        self.assertEqual(w.get_receiving_addresses()[-2:], addresses)
+        self.assertEqual([w.derive_address(0, n) for n in range(num_addr + 3)], w.get_receiving_addresses())
+
     @mock.patch.object(wallet.Abstract_Wallet, 'save_db')
     def test_bip32_extended_version_bytes(self, mock_save_db):
         seed_words = 'crouch dumb relax small truck age shine pink invite spatial object tenant'
@@ -3152,6 +3208,29 @@ class TestWalletHistory_EvilGapLimit(TestCaseForTestnet):
                                    {})
         w.synchronize()
         self.assertEqual(9999788, sum(w.get_balance()))
+        self.assertEqual(25 + 1 + 20, len(w.get_receiving_addresses()))
+
+
+class TestWalletHistory_AddressStatus(TestCaseForTestnet):
+
+    def setUp(self):
+        super().setUp()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+
+    @mock.patch.object(wallet.Abstract_Wallet, 'save_db')
+    def test_address_history_status_is_cached(self, mock_save_db):
+        ks = keystore.from_xpub('vpub5Vhmk4dEJKanDTTw6immKXa3thw45u3gbd1rPYjREB6viP13sVTWcH6kvbR2YeLtGjradr6SFLVt9PxWDBSrvw1Dc1nmd3oko3m24CQbfaJ')
+        w = WalletIntegrityHelper.create_standard_wallet(ks, gap_limit=20, config=self.config)
+        addr = 'tb1qgh5c088he4d559wl0hw27hrdeg8p2z96pefn4q'  # HD index 1
+        self.assertIsNone(w.get_address_history_status(addr))
+        hist = [('268fce617aaaa4847835c2212b984d7b7741fdab65de22813288341819bc5656', 1316917)]
+        w.receive_history_callback(addr, hist, {})
+        self.assertEqual(history_status(hist), w.get_address_history_status(addr))
+        with mock.patch('electrum.address_synchronizer.history_status') as mock_history_status:
+            self.assertEqual(history_status(hist), w.get_address_history_status(addr))
+            mock_history_status.assert_not_called()
+        w.clear_history()
+        self.assertIsNone(w.get_address_history_status(addr))
 
 
 class TestWalletHistory_DoubleSpend(TestCaseForTestnet):
@@ -3202,3 +3281,240 @@ class TestWalletHistory_DoubleSpend(TestCaseForTestnet):
         txC = Transaction(self.transactions["2c9aa33d9c8ec649f9bfb84af027a5414b760be5231fe9eca4a95b9eb3f8a017"])
         w.add_transaction(txC)
         self.assertEqual(999890, sum(w.get_balance()))
+
+    @mock.patch.object(wallet.Abstract_Wallet, 'save_db')
+    def test_readers_get_the_last_complete_snapshots(self, mock_save_db):
+        w = restore_wallet_from_text("small rapid pattern language comic denial donate extend tide fever burden barrel",
+                                     path='if_this_exists_mocking_failed_648151893',
+                                     gap_limit=5,
+                                     config=self.config)['wallet']  # type: Abstract_Wallet
+        w.add_transaction(Transaction(self.transactions["a3849040f82705151ba12a4389310b58a17b78025d81116a3338595bdefa1625"]))
+        balance, history = w.get_balance(), w.get_history()
+        locked, write, written, finish, finished, release = (threading.Event() for i in range(6))
+        def writer():
+            with w.lock, w.transaction_lock:
+                with w._write_section():
+                    locked.set()
+                    write.wait()
+                    w.add_transaction(Transaction(self.transactions["0e2182ead6660790290371516cb0b80afa8baebd30dad42b5e58a24ceea17f1c"]))
+                    written.set()
+                    finish.wait()
+                finished.set()
+                release.wait()
+        def read_in_thread(read):
+            results = []
+            thread = threading.Thread(target=lambda: results.append(read()))
+            thread.start()
+            thread.join(0.1)
+            return thread, results
+        thread = threading.Thread(target=writer)
+        thread.start()
+        try:
+            locked.wait()
+            # while a write is in progress, readers get the snapshots taken before it
+            self.assertEqual(balance, w.get_balance())
+            self.assertEqual(history, w.get_history())
+            # coin selection always waits for the locks
+            utxos_reader, utxos = read_in_thread(w.get_utxos)
+            self.assertTrue(utxos_reader.is_alive())
+            write.set()
+            written.wait()
+            # the changes are not visible before the write is over
+            self.assertEqual(balance, w.get_balance())
+            self.assertEqual(history, w.get_history())
+            finish.set()
+            finished.wait()
+            # once it is over, the snapshots are no longer served
+            balance_reader, balances = read_in_thread(w.get_balance)
+            self.assertTrue(balance_reader.is_alive())
+        finally:
+            write.set()
+            finish.set()
+            release.set()
+            thread.join()
+        utxos_reader.join()
+        balance_reader.join()
+        self.assertNotEqual(balance, balances[0])
+        self.assertEqual(balances[0], w.get_balance())
+        self.assertEqual(2, len(w.get_history()))
+        self.assertEqual([utxo.prevout for utxo in w.get_utxos()], [utxo.prevout for utxo in utxos[0]])
+
+
+class TestWalletHistory_CoinbaseMaturity(TestCaseForTestnet):
+
+    def setUp(self):
+        super().setUp()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+
+    @mock.patch.object(wallet.Abstract_Wallet, 'save_db')
+    def test_new_blocks_only_invalidate_maturing_balances(self, mock_save_db):
+        w = restore_wallet_from_text("small rapid pattern language comic denial donate extend tide fever burden barrel",
+                                     path='if_this_exists_mocking_failed_648151893',
+                                     gap_limit=5,
+                                     config=self.config)['wallet']  # type: Abstract_Wallet
+        addr, other_addr = w.get_receiving_addresses()[:2]
+        script = bitcoin.address_to_script(addr)
+        coinbase_tx = Transaction(
+            '01000000' + '01' + '00' * 32 + 'ffffffff' + '0403a08601' + 'ffffffff'
+            + '01' + (50_000).to_bytes(8, 'little').hex() + bitcoin.var_int(len(script) // 2) + script
+            + '00000000')
+        w.db.put('stored_height', 150)
+        w.receive_tx_callback(coinbase_tx.txid(), coinbase_tx, 100)
+        w.on_blockchain_updated('blockchain_updated')
+        self.assertEqual((0, 0, 50_000), w.get_balance())
+        self.assertEqual((0, 0, 0), w.get_addr_balance(other_addr))
+        # still immature in the next block: nothing to recompute
+        w.db.put('stored_height', 198)
+        w.on_blockchain_updated('blockchain_updated')
+        self.assertIn(addr, w._get_addr_balance_cache)
+        self.assertEqual((0, 0, 50_000), w.get_balance())
+        # matures: only the balance of its address is recomputed
+        w.db.put('stored_height', 199)
+        w.on_blockchain_updated('blockchain_updated')
+        self.assertNotIn(addr, w._get_addr_balance_cache)
+        self.assertIn(other_addr, w._get_addr_balance_cache)
+        self.assertEqual((50_000, 0, 0), w.get_balance())
+        self.assertEqual(w.get_balance(), w.get_balance(w.get_addresses()))
+        # a reorg to a lower height drops everything
+        w.db.put('stored_height', 190)
+        w.on_blockchain_updated('blockchain_updated')
+        self.assertEqual({}, w._get_addr_balance_cache)
+        self.assertEqual((0, 0, 50_000), w.get_balance())
+
+
+class TestWalletHistory_BalanceCache(TestCaseForTestnet):
+
+    def setUp(self):
+        super().setUp()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+
+    @mock.patch.object(wallet.Abstract_Wallet, 'save_db')
+    @mock.patch('electrum.util.trigger_callback')
+    def test_balance_follows_tx_height(self, mock_trigger_callback, mock_save_db):
+        w = restore_wallet_from_text("small rapid pattern language comic denial donate extend tide fever burden barrel",
+                                     path='if_this_exists_mocking_failed_648151893',
+                                     gap_limit=5,
+                                     config=self.config)['wallet']  # type: Abstract_Wallet
+        addr = w.get_receiving_addresses()[0]
+        script = bitcoin.address_to_script(addr)
+        tx = Transaction(
+            '02000000' + '01' + '11' * 32 + '00000000' + '00' + 'fdffffff'
+            + '01' + (50_000).to_bytes(8, 'little').hex() + bitcoin.var_int(len(script) // 2) + script
+            + '00000000')
+        txid = tx.txid()
+        w.db.put('stored_height', 150)
+        w.receive_history_callback(addr, [(txid, 100)], {})
+        w.receive_tx_callback(txid, tx, 100)
+        self.assertEqual((50_000, 0, 0), w.get_balance())
+        w.add_verified_tx(txid, TxMinedInfo(height=100, timestamp=1, txpos=0, header_hash='00' * 32))
+        self.assertEqual((50_000, 0, 0), w.get_balance())
+        # the server no longer has it: the tx becomes local
+        w.receive_history_callback(addr, [], {})
+        self.assertEqual(TX_HEIGHT_LOCAL, w.get_tx_height(txid).height)
+        self.assertEqual((0, 50_000, 0), w.get_balance())
+        self.assertEqual((0, 50_000, 0), w.get_addr_balance(addr))
+        # mined again
+        w.receive_history_callback(addr, [(txid, 101)], {})
+        self.assertEqual((50_000, 0, 0), w.get_balance())
+        w.remove_unverified_tx(txid, 101)
+        self.assertEqual((0, 50_000, 0), w.get_balance())
+        # verified, then undone by a reorg
+        w.add_verified_tx(txid, TxMinedInfo(height=102, timestamp=1, txpos=0, header_hash='00' * 32))
+        self.assertEqual((50_000, 0, 0), w.get_balance())
+        self.assertEqual({txid}, w.undo_verifications(mock.Mock(read_header=lambda height: None), 101))
+        w.remove_unverified_tx(txid, 102)
+        self.assertEqual((0, 50_000, 0), w.get_balance())
+
+
+class TestWalletIndexes(TestCaseForTestnet):
+
+    FUNDING_TX = '01000000014576dacce264c24d81887642b726f5d64aa7825b21b350c7b75a57f337da6845010000006b483045022100a3f8b6155c71a98ad9986edd6161b20d24fad99b6463c23b463856c0ee54826d02200f606017fd987696ebbe5200daedde922eee264325a184d5bbda965ba5160821012102e5c473c051dae31043c335266d0ef89c1daab2f34d885cc7706b267f3269c609ffffffff0240420f00000000001600148a28bddb7f61864bdcf58b2ad13d5aeb3abc3c42a2ddb90e000000001976a914c384950342cb6f8df55175b48586838b03130fad88ac00000000'
+    # wallet1 -> wallet2 (spends FUNDING_TX), then wallet2 -> wallet1 (spends the former)
+    TX_1_TO_2 = '010000000001010392c1940e2ec9f2372919ca3887327fe5b98b866022cc79bab5cbed5a53d2ad0000000000feffffff0290d00300000000001976a914ea7804a2c266063572cc009a63dc25dcc0e9d9b588ac285e0b0000000000160014690b59a8140602fb23cc2904ece9cc4daf361052024730440220608a5339ca894592da82119e1e4a1d09335d70a552c683687223b8ed724465e902201b3f0feccf391b1b6257e4b18970ae57d7ca060af2dae519b3690baad2b2a34e0121030faee9b4a25b7db82023ca989192712cdd4cb53d3d9338591c7909e581ae1c0c00000000'
+    TX_2_TO_1 = '0100000001e228327e4c0bb80661d258d625f516307e7c127c7f3e2b476a22e89b4dae063c000000006a47304402200c7b06ff882db5ffe9d6e2a3cc2cabf5cd1b4224f1453d1e3dadd13b3d391e2c02201d23fde8482b05837f27d43021d17a1be2ee619dfc889ee80d4c2761e7c7ffb20121030b482838721a38d94847699fed8818b5c5f56500ef72f13489e365b65e5749cffeffffff02a086010000000000160014284520c815980d426264766d8d930013dd20aa6068360200000000001976a914ca4c60999c46c2108326590b125aefd476dcb11888ac00000000'
+
+    def setUp(self):
+        super().setUp()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+
+    def _create_wallets(self):
+        wallets = []
+        for seed_words in ('bitter grass shiver impose acquire brush forget axis eager alone wine silver',
+                           'cycle rocket west magnet parrot shuffle foot correct salt library feed song'):
+            ks = keystore.from_seed(seed_words, '', False)
+            wallets.append(WalletIntegrityHelper.create_standard_wallet(ks, gap_limit=2, config=self.config))
+        wallet1, wallet2 = wallets
+        for raw_tx, receivers in ((self.FUNDING_TX, (wallet1,)),
+                                  (self.TX_1_TO_2, (wallet1, wallet2)),
+                                  (self.TX_2_TO_1, (wallet1, wallet2))):
+            tx = Transaction(raw_tx)
+            for w in receivers:
+                w.receive_tx_callback(tx.txid(), tx, TX_HEIGHT_UNCONFIRMED)
+        return wallet1, wallet2
+
+    @mock.patch.object(wallet.Abstract_Wallet, 'save_db')
+    def test_history_index_matches_history_from_scratch(self, mock_save_db):
+        wallet1, wallet2 = self._create_wallets()
+        funding_txid = Transaction(self.FUNDING_TX).txid()
+        for w in (wallet1, wallet2):
+            self.assertEqual(w.get_history(domain=w.get_addresses()), w.get_history())
+            self.assertEqual(sum(w.get_balance()), w.get_history()[-1].balance)
+        # a verified tx moves before the unconfirmed ones
+        with mock.patch('electrum.util.trigger_callback'):
+            wallet1.add_verified_tx(funding_txid, TxMinedInfo(height=100, timestamp=1, txpos=2, header_hash='00' * 32))
+        self.assertEqual(wallet1.get_history(domain=wallet1.get_addresses()), wallet1.get_history())
+        self.assertEqual(funding_txid, wallet1.get_history()[0].txid)
+        self.assertEqual(wallet1.get_history()[1:], wallet1.get_history(start=1))
+        self.assertEqual(3, wallet1.get_history_len())
+        # removing a tx (and its child) drops them from the history
+        wallet1.remove_transaction(Transaction(self.TX_1_TO_2).txid())
+        self.assertEqual(wallet1.get_history(domain=wallet1.get_addresses()), wallet1.get_history())
+        self.assertEqual([funding_txid], [item.txid for item in wallet1.get_history()])
+        self.assertEqual(sum(wallet1.get_balance()), wallet1.get_history()[-1].balance)
+
+    @mock.patch.object(wallet.Abstract_Wallet, 'save_db')
+    def test_utxo_index_matches_utxos_from_scratch(self, mock_save_db):
+        wallet1, wallet2 = self._create_wallets()
+        for w in (wallet1, wallet2):
+            self.assertEqual(
+                sorted(txo.prevout.to_str() for addr in w.get_addresses()
+                       for txo in w.get_addr_outputs(addr).values() if txo.spent_height is None),
+                sorted(txo.prevout.to_str() for txo in w.get_utxos()))
+        # removing a tx (and its child) makes the coins it spent unspent again
+        wallet1.remove_transaction(Transaction(self.TX_1_TO_2).txid())
+        self.assertEqual([(Transaction(self.FUNDING_TX).txid(), 1000000)],
+                         [(txo.prevout.txid.hex(), txo.value_sats()) for txo in wallet1.get_utxos()])
+
+    @mock.patch.object(wallet.Abstract_Wallet, 'save_db')
+    def test_verified_txs_by_height_after_reorgs(self, mock_save_db):
+        wallet1, wallet2 = self._create_wallets()
+        funding_txid, txid_1_to_2, txid_2_to_1 = [
+            Transaction(raw_tx).txid() for raw_tx in (self.FUNDING_TX, self.TX_1_TO_2, self.TX_2_TO_1)]
+        def verify(txid, height):
+            with mock.patch('electrum.util.trigger_callback'):
+                wallet1.add_verified_tx(txid, TxMinedInfo(height=height, timestamp=1, txpos=0, header_hash='00' * 32))
+        verify(funding_txid, 100)
+        verify(txid_1_to_2, 101)
+        verify(txid_2_to_1, 102)
+        db = wallet1.db
+        self.assertEqual([funding_txid, txid_1_to_2, txid_2_to_1], db.list_verified_tx_above_height(0))
+        self.assertEqual([txid_1_to_2, txid_2_to_1], db.list_verified_tx_above_height(100))
+        self.assertEqual([], db.list_verified_tx_above_height(102))
+        # removed, then verified again at another height
+        db.remove_verified_tx(txid_1_to_2)
+        self.assertEqual([funding_txid, txid_2_to_1], db.list_verified_tx_above_height(0))
+        verify(txid_1_to_2, 103)
+        self.assertEqual([txid_2_to_1, txid_1_to_2], db.list_verified_tx_above_height(100))
+        # verified again at a new height, without being removed first
+        verify(txid_2_to_1, 104)
+        self.assertEqual([txid_1_to_2, txid_2_to_1], db.list_verified_tx_above_height(100))
+        # a reorg only undoes the verification of txs above the fork
+        new_chain = mock.Mock(read_header=lambda height: None)
+        self.assertEqual(set(), wallet1.undo_verifications(new_chain, 104))
+        self.assertEqual({txid_1_to_2, txid_2_to_1}, wallet1.undo_verifications(new_chain, 100))
+        self.assertEqual([funding_txid], db.list_verified_tx_above_height(0))
+        self.assertEqual(103, wallet1.get_tx_height(txid_1_to_2).height)
+        verify(txid_1_to_2, 101)
+        self.assertEqual([funding_txid, txid_1_to_2], db.list_verified_tx_above_height(0))
+        self.assertEqual({txid_1_to_2}, wallet1.undo_verifications(new_chain, 100))
+        self.assertEqual([funding_txid], db.list_verified_tx_above_height(0))
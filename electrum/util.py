@@ -32,6 +32,8 @@ from decimal import Decimal
 import traceback
 import urllib
 import threading
+import concurrent.futures
+import multiprocessing
 import hmac
 import stat
 from locale import localeconv
@@ -1259,6 +1261,15 @@ class NetworkJobOnDefaultServer(Logger, ABC):
         return s
 
 
+def create_process_pool(max_workers: int) -> concurrent.futures.ProcessPoolExecutor:
+    """Process pool for CPU-bound work. Its workers are spawned, not forked:
+    a forked child could inherit locks held by our other threads (the event
+    loop, the GUI), and deadlock on them.
+    """
+    return concurrent.futures.ProcessPoolExecutor(max_workers=max_workers,
+                                                  mp_context=multiprocessing.get_context('spawn'))
+
+
 def create_and_start_event_loop() -> Tuple[asyncio.AbstractEventLoop,
                                            asyncio.Future,
                                            threading.Thread]:
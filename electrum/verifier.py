@@ -22,7 +22,8 @@
 # SOFTWARE.
 
 import asyncio
-from typing import Sequence, Optional, TYPE_CHECKING
+from collections import OrderedDict
+from typing import Sequence, Optional, TYPE_CHECKING, Tuple, Dict, List
 
 import aiorpcx
 
@@ -46,6 +47,12 @@ class MerkleRootMismatch(MerkleVerificationFailure): pass
 class InnerNodeOfSpvProofIsValidTx(MerkleVerificationFailure): pass
 
 
+MERKLE_BATCH_SIZE = 100  # merkle proofs requested per JSON-RPC batch
+MERKLE_VERIFIER_CACHE_SIZE = 100  # blocks
+# backlog of proofs from which they get verified in a process pool, if there is one
+MIN_PROOFS_FOR_PROCESS_POOL = 1000
+
+
 class SPV(NetworkJobOnDefaultServer):
     """ Simple Payment Verification """
 
@@ -57,6 +64,7 @@ class SPV(NetworkJobOnDefaultServer):
         super()._reset()
         self.merkle_roots = {}  # txid -> merkle root (once it has been verified)
         self.requested_merkle = set()  # txid set of pending requests
+        self._merkle_verifiers = OrderedDict()  # type: OrderedDict[str, MerkleVerifier]  # header hash -> verifier (LRU)
 
     async def _run_tasks(self, *, taskgroup):
         await super()._run_tasks(taskgroup=taskgroup)
@@ -76,6 +84,7 @@ class SPV(NetworkJobOnDefaultServer):
     async def _request_proofs(self):
         local_height = self.blockchain.height()
         unverified = self.wallet.get_unverified_txs()
+        to_request = []  # type: List[Tuple[str, int]]
 
         for tx_hash, tx_height in unverified.items():
             # do not request merkle branch if we already requested it
@@ -93,21 +102,81 @@ class SPV(NetworkJobOnDefaultServer):
             # request now
             self.logger.info(f'requested merkle {tx_hash}')
             self.requested_merkle.add(tx_hash)
-            await self.taskgroup.spawn(self._request_and_verify_single_proof, tx_hash, tx_height)
+            to_request.append((tx_hash, tx_height))
+
+        config = self.network.config
+        batch_size = max(1, int(config.get('spv_merkle_batch_size', MERKLE_BATCH_SIZE)))
+        # big backlogs (initial sync, redoing verifications after a reorg)
+        # are verified off the event loop, if possible
+        use_pool = len(to_request) >= int(config.get('spv_process_pool_min_proofs', MIN_PROOFS_FOR_PROCESS_POOL))
+        for i in range(0, len(to_request), batch_size):
+            batch = to_request[i:i+batch_size]
+            if len(batch) == 1:
+                await self.taskgroup.spawn(self._request_and_verify_single_proof, *batch[0])
+            else:
+                await self.taskgroup.spawn(self._request_and_verify_proofs, batch, use_pool)
 
     async def _request_and_verify_single_proof(self, tx_hash, tx_height):
         try:
             async with self._network_request_semaphore:
                 merkle = await self.network.get_merkle_for_transaction(tx_hash, tx_height)
         except UntrustedServerReturnedError as e:
-            if not isinstance(e.original_exception, aiorpcx.jsonrpc.RPCError):
-                raise
-            self.logger.info(f'tx {tx_hash} not at height {tx_height}')
-            self.wallet.remove_unverified_tx(tx_hash, tx_height)
-            self.requested_merkle.discard(tx_hash)
+            self._on_merkle_request_error(tx_hash, tx_height, e)
             return
-        # Verify the hash of the server-provided merkle branch to a
-        # transaction matches the merkle root of its block
+        await self._verify_proof(tx_hash, tx_height, merkle)
+
+    async def _request_and_verify_proofs(self, txs: Sequence[Tuple[str, int]], use_pool: bool = False):
+        async with self._network_request_semaphore:
+            results = await self.network.get_merkle_for_transactions(txs)
+        pool = self.network.get_proof_verification_pool() if use_pool else None
+        if pool is None:
+            for (tx_hash, tx_height), merkle in zip(txs, results):
+                if isinstance(merkle, UntrustedServerReturnedError):
+                    self._on_merkle_request_error(tx_hash, tx_height, merkle)
+                    continue
+                await self._verify_proof(tx_hash, tx_height, merkle)
+            return
+        proofs = []
+        for (tx_hash, tx_height), merkle in zip(txs, results):
+            if isinstance(merkle, UntrustedServerReturnedError):
+                self._on_merkle_request_error(tx_hash, tx_height, merkle)
+                continue
+            proofs.append((tx_hash, *await self._get_proof_and_header(tx_hash, tx_height, merkle)))
+        jobs = [(tx_hash, merkle_branch, pos, header.get('merkle_root'))
+                for tx_hash, tx_height, pos, merkle_branch, header in proofs if header]
+        loop = asyncio.get_event_loop()
+        job_errors = iter(await loop.run_in_executor(pool, verify_merkle_proofs, jobs))
+        # apply the results in order
+        for tx_hash, tx_height, pos, merkle_branch, header in proofs:
+            if not header:
+                error = MissingBlockHeader("merkle verification failed for {} (missing header {})"
+                                           .format(tx_hash, tx_height))
+            else:
+                error = next(job_errors)
+            if error is not None:
+                self._on_merkle_verification_failure(tx_hash, error)
+            self._add_verified_tx(tx_hash, tx_height, pos, header)
+
+    def _on_merkle_request_error(self, tx_hash: str, tx_height: int, e: UntrustedServerReturnedError) -> None:
+        if not isinstance(e.original_exception, aiorpcx.jsonrpc.RPCError):
+            raise e
+        self.logger.info(f'tx {tx_hash} not at height {tx_height}')
+        self.wallet.remove_unverified_tx(tx_hash, tx_height)
+        self.requested_merkle.discard(tx_hash)
+
+    def _get_merkle_verifier(self, header: dict) -> 'MerkleVerifier':
+        header_hash = hash_header(header)
+        verifier = self._merkle_verifiers.get(header_hash)
+        if verifier is None:
+            verifier = self._merkle_verifiers[header_hash] = MerkleVerifier(header.get('merkle_root'))
+            if len(self._merkle_verifiers) > MERKLE_VERIFIER_CACHE_SIZE:
+                self._merkle_verifiers.popitem(last=False)
+        else:
+            self._merkle_verifiers.move_to_end(header_hash)
+        return verifier
+
+    async def _get_proof_and_header(self, tx_hash: str, tx_height: int,
+                                    merkle: dict) -> Tuple[int, int, Sequence[str], Optional[dict]]:
         if tx_height != merkle.get('block_height'):
             self.logger.info('requested tx_height {} differs from received tx_height {} for txid {}'
                              .format(tx_height, merkle.get('block_height'), tx_hash))
@@ -117,14 +186,27 @@ class SPV(NetworkJobOnDefaultServer):
         # we need to wait if header sync/reorg is still ongoing, hence lock:
         async with self.network.bhi_lock:
             header = self.network.blockchain().read_header(tx_height)
+        return tx_height, pos, merkle_branch, header
+
+    async def _verify_proof(self, tx_hash: str, tx_height: int, merkle: dict):
+        # Verify the hash of the server-provided merkle branch to a
+        # transaction matches the merkle root of its block
+        tx_height, pos, merkle_branch, header = await self._get_proof_and_header(tx_hash, tx_height, merkle)
         try:
-            verify_tx_is_in_block(tx_hash, merkle_branch, pos, header, tx_height)
+            verify_tx_is_in_block(tx_hash, merkle_branch, pos, header, tx_height,
+                                  merkle_verifier=self._get_merkle_verifier(header) if header else None)
         except MerkleVerificationFailure as e:
-            if self.network.config.get("skipmerklecheck"):
-                self.logger.info(f"skipping merkle proof check {tx_hash}")
-            else:
-                self.logger.info(repr(e))
-                raise GracefulDisconnect(e) from e
+            self._on_merkle_verification_failure(tx_hash, e)
+        self._add_verified_tx(tx_hash, tx_height, pos, header)
+
+    def _on_merkle_verification_failure(self, tx_hash: str, e: MerkleVerificationFailure) -> None:
+        if self.network.config.get("skipmerklecheck"):
+            self.logger.info(f"skipping merkle proof check {tx_hash}")
+        else:
+            self.logger.info(repr(e))
+            raise GracefulDisconnect(e) from e
+
+    def _add_verified_tx(self, tx_hash: str, tx_height: int, pos: int, header: dict) -> None:
         # we passed all the tests
         self.merkle_roots[tx_hash] = header.get('merkle_root')
         self.requested_merkle.discard(tx_hash)
@@ -193,15 +275,89 @@ class SPV(NetworkJobOnDefaultServer):
         return not self.requested_merkle
 
 
+class MerkleVerifier:
+    """Verifies merkle branches against the merkle root of one block, on bytes.
+    Remembers the inner nodes of the branches it verified, so the branch of
+    another tx of the block only gets hashed up to where it joins one of them.
+    """
+
+    def __init__(self, merkle_root: str):
+        self.merkle_root = merkle_root
+        self._merkle_root_bytes = hash_decode(merkle_root)
+        self._depth = None  # type: Optional[int]
+        self._verified_nodes = {}  # type: Dict[Tuple[int, int], bytes]  # (level, index) -> hash
+
+    def verify(self, tx_hash: str, merkle_branch: Sequence[str], leaf_pos_in_tree: int) -> None:
+        try:
+            h = hash_decode(tx_hash)
+            merkle_branch_bytes = [hash_decode(item) for item in merkle_branch]
+            index = int(leaf_pos_in_tree)  # raise if invalid
+        except Exception as e:
+            raise MerkleVerificationFailure(e)
+        if index < 0:
+            raise MerkleVerificationFailure('leaf_pos_in_tree must be non-negative')
+        if index >> len(merkle_branch_bytes) != 0:
+            raise MerkleVerificationFailure(f'leaf_pos_in_tree too large for branch')
+        # all the branches of a block have the same length
+        use_cache = self._depth == len(merkle_branch_bytes)
+        new_nodes = []
+        for level, item in enumerate(merkle_branch_bytes, start=1):
+            if len(item) != 32:
+                raise MerkleVerificationFailure('all merkle branch items have to 32 bytes long')
+            inner_node = (item + h) if (index & 1) else (h + item)
+            SPV._raise_if_valid_tx(inner_node)
+            h = sha256d(inner_node)
+            index >>= 1
+            if use_cache and self._verified_nodes.get((level, index)) == h:
+                break  # from here on, the path is known to lead to the merkle root
+            new_nodes.append(((level, index), h))
+        else:
+            if h != self._merkle_root_bytes:
+                raise MerkleRootMismatch("merkle verification failed for {} ({} != {})".format(
+                    tx_hash, self.merkle_root, hash_encode(h)))
+            if self._depth is None:
+                self._depth = len(merkle_branch_bytes)
+        if self._depth == len(merkle_branch_bytes):
+            self._verified_nodes.update(new_nodes)
+
+
+def verify_merkle_proofs(
+        proofs: Sequence[Tuple[str, Sequence[str], int, str]]) -> List[Optional[MerkleVerificationFailure]]:
+    """Verify (tx_hash, merkle_branch, leaf_pos_in_tree, merkle_root) proofs.
+    Meant to run in a worker process: returns the failure of each proof, or None.
+    """
+    verifiers = {}  # type: Dict[str, MerkleVerifier]
+    errors = []
+    for tx_hash, merkle_branch, leaf_pos_in_tree, merkle_root in proofs:
+        verifier = verifiers.get(merkle_root)
+        if verifier is None:
+            verifier = verifiers[merkle_root] = MerkleVerifier(merkle_root)
+        try:
+            if len(merkle_branch) > 30:
+                raise MerkleVerificationFailure(f"merkle branch too long: {len(merkle_branch)}")
+            verifier.verify(tx_hash, merkle_branch, leaf_pos_in_tree)
+        except MerkleVerificationFailure as e:
+            errors.append(e)
+        else:
+            errors.append(None)
+    return errors
+
+
 def verify_tx_is_in_block(tx_hash: str, merkle_branch: Sequence[str],
                           leaf_pos_in_tree: int, block_header: Optional[dict],
-                          block_height: int) -> None:
-    """Raise MerkleVerificationFailure if verification fails."""
+                          block_height: int, *, merkle_verifier: MerkleVerifier = None) -> None:
+    """Raise MerkleVerificationFailure if verification fails.
+    merkle_verifier, if given, must be the one of block_header.
+    """
     if not block_header:
         raise MissingBlockHeader("merkle verification failed for {} (missing header {})"
                                  .format(tx_hash, block_height))
     if len(merkle_branch) > 30:
         raise MerkleVerificationFailure(f"merkle branch too long: {len(merkle_branch)}")
+    if merkle_verifier is not None:
+        assert merkle_verifier.merkle_root == block_header.get('merkle_root')
+        merkle_verifier.verify(tx_hash, merkle_branch, leaf_pos_in_tree)
+        return
     calc_merkle_root = SPV.hash_merkle_root(merkle_branch, tx_hash, leaf_pos_in_tree)
     if block_header.get('merkle_root') != calc_merkle_root:
         raise MerkleRootMismatch("merkle verification failed for {} ({} != {})".format(
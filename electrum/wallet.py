@@ -40,11 +40,13 @@ from functools import partial
 from collections import defaultdict
 from numbers import Number
 from decimal import Decimal
-from typing import TYPE_CHECKING, List, Optional, Tuple, Union, NamedTuple, Sequence, Dict, Any, Set
+from typing import TYPE_CHECKING, List, Optional, Tuple, Union, NamedTuple, Sequence, Dict, Any, Set, Iterable
 from abc import ABC, abstractmethod
 import itertools
 import threading
 import enum
+import concurrent.futures
+import atexit
 
 from aiorpcx import TaskGroup, timeout_after, TaskTimeout, ignore_after
 
@@ -67,7 +69,7 @@ from .keystore import (load_keystore, Hardware_KeyStore, KeyStore, KeyStoreWithM
 from .util import multisig_type
 from .storage import StorageEncryptionVersion, WalletStorage
 from .wallet_db import WalletDB
-from . import transaction, bitcoin, coinchooser, paymentrequest, ecc, bip32
+from . import transaction, bitcoin, coinchooser, paymentrequest, ecc, bip32, constants
 from .transaction import (Transaction, TxInput, UnknownTxinType, TxOutput,
                           PartialTransaction, PartialTxInput, PartialTxOutput, TxOutpoint)
 from .plugin import run_hook
@@ -97,6 +99,39 @@ TX_STATUS = [
     _('Local'),
 ]
 
+# gap-limit expansions from which addresses get derived in a process pool, if enabled
+MIN_ADDRESSES_FOR_PROCESS_POOL = 1000
+
+_derivation_pool = None  # type: Optional[concurrent.futures.ProcessPoolExecutor]
+_derivation_pool_size = 0
+_derivation_pool_lock = threading.Lock()
+
+
+def get_derivation_pool(num_processes: int) -> concurrent.futures.ProcessPoolExecutor:
+    """Process pool shared by all wallets to derive addresses in bulk.
+    It is created on first use, and again only if num_processes changes.
+    """
+    global _derivation_pool, _derivation_pool_size
+    with _derivation_pool_lock:
+        if _derivation_pool is None or _derivation_pool_size != num_processes:
+            if _derivation_pool is not None:
+                _derivation_pool.shutdown(wait=False)
+            _derivation_pool = util.create_process_pool(num_processes)
+            _derivation_pool_size = num_processes
+        return _derivation_pool
+
+
+def shutdown_derivation_pool() -> None:
+    global _derivation_pool, _derivation_pool_size
+    with _derivation_pool_lock:
+        if _derivation_pool is not None:
+            _derivation_pool.shutdown(wait=False)
+            _derivation_pool = None
+            _derivation_pool_size = 0
+
+
+atexit.register(shutdown_derivation_pool)
+
 
 class BumpFeeStrategy(enum.Enum):
     COINCHOOSER = enum.auto()
@@ -260,6 +295,32 @@ class TxWalletDetails(NamedTuple):
     is_lightning_funding_tx: bool
 
 
+def derive_addresses_from_chain_nodes(
+        chain_nodes: Sequence[Tuple[bytes, bytes]],
+        start: int,
+        stop: int,
+        *,
+        txin_type: str,
+        multisig_m: Optional[int],
+        net,
+) -> List[str]:
+    """Derives the addresses at indices start..stop-1 of a chain, from the
+    (pubkey, chaincode) of that chain for each keystore. multisig_m is None
+    for single-key wallets. Meant to run in a worker process.
+    """
+    pubkey_ranges = [bip32.CKD_pub_range(pubkey, chaincode, start, stop)
+                     for pubkey, chaincode in chain_nodes]
+    addresses = []
+    for pubkeys in zip(*pubkey_ranges):
+        pubkeys = [pk.hex() for pk in pubkeys]
+        if multisig_m is None:
+            addresses.append(bitcoin.pubkey_to_address(txin_type, pubkeys[0], net=net))
+        else:
+            redeem_script = transaction.multisig_script(sorted(pubkeys), multisig_m)
+            addresses.append(bitcoin.redeem_script_to_address(txin_type, redeem_script, net=net))
+    return addresses
+
+
 class Abstract_Wallet(AddressSynchronizer, ABC):
     """
     Wallet classes are created to handle various address generation methods.
@@ -268,6 +329,8 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
 
     LOGGING_SHORTCUT = 'w'
     max_change_outputs = 3
+    # whether derive_addresses_from_chain_nodes computes the same addresses as pubkeys_to_address
+    can_derive_addresses_in_process_pool = False
     gap_limit_for_change = 10
 
     txin_type: str
@@ -282,6 +345,9 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
         assert self.config is not None, "config must not be None"
         self.db = db
         self.storage = storage
+        if self.config.get('wallet_file_journal', False):
+            # only append what changed to the wallet file when saving
+            self.db.enable_journal()
         # load addresses needs to be called before constructor for sanity checks
         db.load_addresses(self.wallet_type)
         self.keystore = None  # type: Optional[KeyStore]  # will be set by load_keystore
@@ -2067,7 +2133,7 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
     def import_address(self, address: str) -> str:
         raise Exception("this wallet cannot import addresses")
 
-    def import_addresses(self, addresses: List[str], *,
+    def import_addresses(self, addresses: Iterable[str], *,
                          write_to_disk=True) -> Tuple[List[str], List[Tuple[str, str]]]:
         raise Exception("this wallet cannot import addresses")
 
@@ -2685,24 +2751,36 @@ class Imported_Wallet(Simple_Wallet):
     def get_change_addresses(self, **kwargs):
         return self.get_addresses()
 
-    def import_addresses(self, addresses: List[str], *,
+    def import_addresses(self, addresses: Iterable[str], *,
                          write_to_disk=True) -> Tuple[List[str], List[Tuple[str, str]]]:
+        """Imports addresses in bulk: they are validated first, then added to
+        the db at once and handed to the synchronizer in a single call.
+        """
         good_addr = []  # type: List[str]
         bad_addr = []  # type: List[Tuple[str, str]]
+        good_addr_set = set()  # type: Set[str]
         for address in addresses:
             if not bitcoin.is_address(address):
                 bad_addr.append((address, _('invalid address')))
                 continue
-            if self.db.has_imported_address(address):
+            if address in good_addr_set or self.db.has_imported_address(address):
                 bad_addr.append((address, _('address already in wallet')))
                 continue
             good_addr.append(address)
-            self.db.add_imported_address(address, {})
-            self.add_address(address)
+            good_addr_set.add(address)
+        self.db.add_imported_addresses(good_addr)
+        self.add_addresses(good_addr)
         if write_to_disk:
             self.save_db()
         return good_addr, bad_addr
 
+    def import_addresses_from_file(self, path: str, *,
+                                   write_to_disk=True) -> Tuple[List[str], List[Tuple[str, str]]]:
+        """Imports the addresses listed in a file, one per line."""
+        with open(path, 'r', encoding='utf-8') as f:
+            return self.import_addresses(filter(None, (line.strip() for line in f)),
+                                         write_to_disk=write_to_disk)
+
     def import_address(self, address: str) -> str:
         good_addr, bad_addr = self.import_addresses([address])
         if good_addr and good_addr[0] == address:
@@ -2717,17 +2795,22 @@ class Imported_Wallet(Simple_Wallet):
             raise UserFacingException("cannot delete last remaining address from wallet")
         transactions_to_remove = set()  # only referred to by this address
         transactions_new = set()  # txs that are not only referred to by address
-        with self.lock:
+        with self._write_section():
             for addr in self.db.get_history():
                 details = self.get_address_history(addr)
                 if addr == address:
                     for tx_hash, height in details:
                         transactions_to_remove.add(tx_hash)
+                        # its delta on the wallet changes, even if it stays
+                        self._history_index_dirty.add(tx_hash)
                 else:
                     for tx_hash, height in details:
                         transactions_new.add(tx_hash)
             transactions_to_remove -= transactions_new
             self.db.remove_addr_history(address)
+            self._history_status.pop(address, None)
+            self._utxo_index_dirty.add(address)
+            self._invalidate_addr_balance(address)
             for tx_hash in transactions_to_remove:
                 self.remove_transaction(tx_hash)
         self.set_label(address, None)
@@ -2866,6 +2949,7 @@ class Deterministic_Wallet(Abstract_Wallet):
 
     def __init__(self, db, storage, *, config):
         self._ephemeral_addr_to_addr_index = {}  # type: Dict[str, Sequence[int]]
+        self._synchronize_lock = threading.RLock()
         Abstract_Wallet.__init__(self, db, storage, config=config)
         self.gap_limit = db.get('gap_limit', 20)
         # generate addresses now. note that without libsecp this might block
@@ -2954,6 +3038,44 @@ class Deterministic_Wallet(Abstract_Wallet):
         pubkeys = self.derive_pubkeys(for_change, n)
         return self.pubkeys_to_address(pubkeys)
 
+    def derive_addresses(self, for_change: int, start: int, stop: int) -> List[str]:
+        """Returns derive_address(for_change, n) for start <= n < stop.
+        Large ranges are derived in a process pool if 'wallet_derivation_processes' is set.
+        """
+        for_change = int(for_change)
+        num_processes = int(self.config.get('wallet_derivation_processes', 0))
+        min_addresses = int(self.config.get('wallet_derivation_pool_min_addresses', MIN_ADDRESSES_FOR_PROCESS_POOL))
+        if num_processes > 0 and stop - start >= min_addresses:
+            addresses = self._derive_addresses_in_process_pool(for_change, start, stop, num_processes=num_processes)
+            if addresses is not None:
+                return addresses
+        pubkey_ranges = [ks.derive_pubkey_range(for_change, start, stop) for ks in self.get_keystores()]
+        return [self.pubkeys_to_address([pk.hex() for pk in pubkeys])
+                for pubkeys in zip(*pubkey_ranges)]
+
+    def _get_multisig_m_for_derivation(self) -> Optional[int]:
+        """The multisig_m derive_addresses_from_chain_nodes needs, if
+        can_derive_addresses_in_process_pool.
+        """
+        return None
+
+    def _derive_addresses_in_process_pool(self, for_change: int, start: int, stop: int, *,
+                                          num_processes: int) -> Optional[List[str]]:
+        if not self.can_derive_addresses_in_process_pool:
+            return None
+        keystores = self.get_keystores()
+        if not all(isinstance(ks, keystore.Xpub) for ks in keystores):
+            return None
+        multisig_m = self._get_multisig_m_for_derivation()
+        chain_nodes = [ks.get_chain_node(for_change) for ks in keystores]
+        chunk_size = -(-(stop - start) // num_processes)
+        chunk_starts = range(start, stop, chunk_size)
+        chunk_stops = [min(n + chunk_size, stop) for n in chunk_starts]
+        job = partial(derive_addresses_from_chain_nodes, chain_nodes,
+                      txin_type=self.txin_type, multisig_m=multisig_m, net=constants.net)
+        chunks = get_derivation_pool(num_processes).map(job, chunk_starts, chunk_stops)
+        return [addr for chunk in chunks for addr in chunk]
+
     def export_private_key_for_path(self, path: Union[Sequence[int], str], password: Optional[str]) -> str:
         if isinstance(path, str):
             path = convert_bip32_path_to_list_of_uint32(path)
@@ -2983,35 +3105,50 @@ class Deterministic_Wallet(Abstract_Wallet):
 
     def create_new_address(self, for_change: bool = False):
         assert type(for_change) is bool
-        with self.lock:
+        return self.create_new_addresses(for_change, 1)[0]
+
+    def create_new_addresses(self, for_change: bool, count: int) -> List[str]:
+        assert type(for_change) is bool
+        while True:
             n = self.db.num_change_addresses() if for_change else self.db.num_receiving_addresses()
-            address = self.derive_address(int(for_change), n)
-            self.db.add_change_address(address) if for_change else self.db.add_receiving_address(address)
-            self.add_address(address)
-            if for_change:
-                # note: if it's actually "old", it will get filtered later
-                self._not_old_change_addresses.append(address)
-            return address
+            # derive without holding the lock: a large gap limit can take a while
+            addresses = self.derive_addresses(int(for_change), n, n + count)
+            with self.lock:
+                num_addr = self.db.num_change_addresses() if for_change else self.db.num_receiving_addresses()
+                if num_addr != n:
+                    continue  # another thread created addresses meanwhile; derive the next ones
+                for address in addresses:
+                    self.db.add_change_address(address) if for_change else self.db.add_receiving_address(address)
+                self.add_addresses(addresses)
+                if for_change:
+                    # note: if it's actually "old", it will get filtered later
+                    self._not_old_change_addresses.extend(addresses)
+                return addresses
 
     def synchronize_sequence(self, for_change):
         limit = self.gap_limit_for_change if for_change else self.gap_limit
         while True:
             num_addr = self.db.num_change_addresses() if for_change else self.db.num_receiving_addresses()
             if num_addr < limit:
-                self.create_new_address(for_change)
+                self.create_new_addresses(for_change, limit - num_addr)
                 continue
             if for_change:
                 last_few_addresses = self.get_change_addresses(slice_start=-limit)
             else:
                 last_few_addresses = self.get_receiving_addresses(slice_start=-limit)
-            if any(map(self.address_is_old, last_few_addresses)):
-                self.create_new_address(for_change)
+            # new addresses are unused, so enough of them to push the last
+            # old address out of the window can be created at once
+            num_after_last_old = next((k for k, addr in enumerate(reversed(last_few_addresses))
+                                       if self.address_is_old(addr)), None)
+            if num_after_last_old is not None:
+                self.create_new_addresses(for_change, limit - num_after_last_old)
             else:
                 break
 
     @AddressSynchronizer.with_local_height_cached
     def synchronize(self):
-        with self.lock:
+        # not self.lock, so that address derivation does not block other threads
+        with self._synchronize_lock:
             self.synchronize_sequence(False)
             self.synchronize_sequence(True)
 
@@ -3101,6 +3238,7 @@ class Simple_Deterministic_Wallet(Simple_Wallet, Deterministic_Wallet):
 
 class Standard_Wallet(Simple_Deterministic_Wallet):
     wallet_type = 'standard'
+    can_derive_addresses_in_process_pool = True
 
     def pubkeys_to_address(self, pubkeys):
         pubkey = pubkeys[0]
@@ -3109,6 +3247,7 @@ class Standard_Wallet(Simple_Deterministic_Wallet):
 
 class Multisig_Wallet(Deterministic_Wallet):
     # generic m of n
+    can_derive_addresses_in_process_pool = True
 
     def __init__(self, db, storage, *, config):
         self.wallet_type = db.get('wallet_type')
@@ -3122,6 +3261,9 @@ class Multisig_Wallet(Deterministic_Wallet):
         redeem_script = self.pubkeys_to_scriptcode(pubkeys)
         return bitcoin.redeem_script_to_address(self.txin_type, redeem_script)
 
+    def _get_multisig_m_for_derivation(self):
+        return self.m
+
     def pubkeys_to_scriptcode(self, pubkeys: Sequence[str]) -> str:
         return transaction.multisig_script(sorted(pubkeys), self.m)
 
@@ -27,6 +27,7 @@ import ast
 import json
 import copy
 import threading
+import bisect
 from collections import defaultdict
 from typing import Dict, Optional, List, Tuple, Set, Iterable, NamedTuple, Sequence, TYPE_CHECKING, Union
 import binascii
@@ -40,7 +41,7 @@ from .logging import Logger
 from .lnutil import LOCAL, REMOTE, FeeUpdate, UpdateAddHtlc, LocalConfig, RemoteConfig, Keypair, OnlyPubkeyKeypair, RevocationStore
 from .lnutil import ImportedChannelBackupStorage, OnchainChannelBackupStorage
 from .lnutil import ChannelConstraints, Outpoint, ShachainElement
-from .json_db import StoredDict, JsonDB, locked, modifier
+from .json_db import StoredDict, JsonDB, locked, modifier, apply_journal_record
 from .plugin import run_hook, plugin_loaders
 from .paymentrequest import PaymentRequest
 from .submarine_swaps import SwapData
@@ -57,6 +58,11 @@ FINAL_SEED_VERSION = 41     # electrum >= 2.7 will set this to prevent
                             # old versions from overwriting new format
 
 
+# the journal (see JsonDB.enable_journal) is compacted into a new snapshot
+# once it gets larger than the snapshot, or than this many bytes
+MIN_JOURNAL_SIZE_FOR_COMPACTION = 100_000
+
+
 class TxFeesValue(NamedTuple):
     fee: Optional[int] = None
     is_calculated_by_us: bool = False
@@ -69,6 +75,9 @@ class WalletDB(JsonDB):
         JsonDB.__init__(self, {})
         self._manual_upgrades = manual_upgrades
         self._called_after_upgrade_tasks = False
+        # sizes of what is in the wallet file, see _write
+        self._snapshot_size = 0
+        self._journal_size = 0
         if raw:  # loading existing db
             self.load_data(raw)
             self.load_plugins()
@@ -79,21 +88,25 @@ class WalletDB(JsonDB):
     def load_data(self, s):
         try:
             self.data = json.loads(s)
+            self._snapshot_size = len(s)
         except:
             try:
-                d = ast.literal_eval(s)
-                labels = d.get('labels', {})
-            except Exception as e:
-                raise WalletFileException("Cannot read wallet file. (parsing failed)")
-            self.data = {}
-            for key, value in d.items():
+                self.data = self._load_journaled_data(s)
+            except ValueError:
                 try:
-                    json.dumps(key)
-                    json.dumps(value)
-                except:
-                    self.logger.info(f'Failed to convert label to json format: {key}')
-                    continue
-                self.data[key] = value
+                    d = ast.literal_eval(s)
+                    labels = d.get('labels', {})
+                except Exception as e:
+                    raise WalletFileException("Cannot read wallet file. (parsing failed)")
+                self.data = {}
+                for key, value in d.items():
+                    try:
+                        json.dumps(key)
+                        json.dumps(value)
+                    except:
+                        self.logger.info(f'Failed to convert label to json format: {key}')
+                        continue
+                    self.data[key] = value
         if not isinstance(self.data, dict):
             raise WalletFileException("Malformed wallet file (not dict)")
 
@@ -105,6 +118,33 @@ class WalletDB(JsonDB):
         elif not self._manual_upgrades:
             self.upgrade()
 
+    def _load_journaled_data(self, s: str) -> dict:
+        """Reads a snapshot followed by journal lines, as appended by _write.
+        Raises ValueError if 's' is not in that format.
+        """
+        decoder = json.JSONDecoder()
+        data, end = decoder.raw_decode(s, len(s) - len(s.lstrip()))
+        if not isinstance(data, dict):
+            raise ValueError('snapshot is not a dict')
+        lines = [line for line in s[end:].split('\n') if line.strip()]
+        if not lines:
+            raise ValueError('no journal')
+        for i, line in enumerate(lines):
+            try:
+                records = json.loads(line)
+            except ValueError:
+                if i < len(lines) - 1:
+                    raise WalletFileException("Cannot read wallet file. (journal is corrupted)")
+                # interrupted while appending. the next write has to replace the file.
+                self.logger.warning('ignoring incomplete journal entry at the end of wallet file')
+                self.set_modified(True)
+                break
+            for record in records:
+                apply_journal_record(data, record)
+        self._snapshot_size = end
+        self._journal_size = len(s) - end
+        return data
+
     def requires_split(self):
         d = self.get('accounts', {})
         return len(d) > 1
@@ -1013,17 +1053,20 @@ class WalletDB(JsonDB):
         assert isinstance(scripthash, str)
         assert isinstance(prevout, TxOutpoint)
         assert isinstance(value, int)
-        if scripthash not in self._prevouts_by_scripthash:
-            self._prevouts_by_scripthash[scripthash] = set()
-        self._prevouts_by_scripthash[scripthash].add((prevout.to_str(), value))
+        # sets are replaced instead of mutated in place, so that the change gets recorded
+        prevouts = set(self._prevouts_by_scripthash.get(scripthash, ()))
+        prevouts.add((prevout.to_str(), value))
+        self._prevouts_by_scripthash[scripthash] = prevouts
 
     @modifier
     def remove_prevout_by_scripthash(self, scripthash: str, *, prevout: TxOutpoint, value: int) -> None:
         assert isinstance(scripthash, str)
         assert isinstance(prevout, TxOutpoint)
         assert isinstance(value, int)
-        self._prevouts_by_scripthash[scripthash].discard((prevout.to_str(), value))
-        if not self._prevouts_by_scripthash[scripthash]:
+        prevouts = self._prevouts_by_scripthash[scripthash] - {(prevout.to_str(), value)}
+        if prevouts:
+            self._prevouts_by_scripthash[scripthash] = prevouts
+        else:
             self._prevouts_by_scripthash.pop(scripthash)
 
     @locked
@@ -1038,7 +1081,9 @@ class WalletDB(JsonDB):
         assert isinstance(tx, Transaction), tx
         # note that tx might be a PartialTransaction
         # serialize and de-serialize tx now. this might e.g. convert a complete PartialTx to a Tx
-        tx = tx_from_any(str(tx))
+        # (a plain Transaction is stored as is, keeping its deserialized form and cached txid)
+        if isinstance(tx, PartialTransaction):
+            tx = tx_from_any(str(tx))
         if not tx_hash:
             raise Exception("trying to add tx to db without txid")
         if tx_hash != tx.txid():
@@ -1083,6 +1128,15 @@ class WalletDB(JsonDB):
         assert isinstance(addr, str)
         self.history[addr] = hist
 
+    @modifier
+    def add_empty_addr_histories(self, addrs: Sequence[str]) -> Sequence[str]:
+        """Adds an empty history for the addresses that are not in the
+        history yet. Returns those addresses."""
+        new_addrs = [addr for addr in addrs if addr not in self.history]
+        for addr in new_addrs:
+            self.history[addr] = []
+        return new_addrs
+
     @modifier
     def remove_addr_history(self, addr: str) -> None:
         assert isinstance(addr, str)
@@ -1104,17 +1158,34 @@ class WalletDB(JsonDB):
                            txpos=txpos,
                            header_hash=header_hash)
 
+    @locked
+    def list_verified_tx_above_height(self, height: int) -> Sequence[str]:
+        """Returns the verified txs mined at a height > height, lowest first."""
+        i = bisect.bisect_left(self._verified_tx_by_height, (height + 1, ''))
+        return [txid for tx_height, txid in self._verified_tx_by_height[i:]]
+
     @modifier
     def add_verified_tx(self, txid: str, info: TxMinedInfo):
         assert isinstance(txid, str)
         assert isinstance(info, TxMinedInfo)
+        self._remove_verified_tx_height(txid)
         self.verified_tx[txid] = (info.height, info.timestamp, info.txpos, info.header_hash)
+        bisect.insort(self._verified_tx_by_height, (info.height, txid))
 
     @modifier
     def remove_verified_tx(self, txid: str):
         assert isinstance(txid, str)
+        self._remove_verified_tx_height(txid)
         self.verified_tx.pop(txid, None)
 
+    def _remove_verified_tx_height(self, txid: str) -> None:
+        if txid not in self.verified_tx:
+            return
+        key = (self.verified_tx[txid][0], txid)
+        i = bisect.bisect_left(self._verified_tx_by_height, key)
+        assert self._verified_tx_by_height[i] == key
+        del self._verified_tx_by_height[i]
+
     def is_in_verified_tx(self, txid: str) -> bool:
         assert isinstance(txid, str)
         return txid in self.verified_tx
@@ -1226,6 +1297,12 @@ class WalletDB(JsonDB):
         assert isinstance(addr, str)
         self.imported_addresses[addr] = d
 
+    @modifier
+    def add_imported_addresses(self, addrs: Iterable[str]) -> None:
+        for addr in addrs:
+            assert isinstance(addr, str)
+            self.imported_addresses[addr] = {}
+
     @modifier
     def remove_imported_address(self, addr: str) -> None:
         assert isinstance(addr, str)
@@ -1275,6 +1352,8 @@ class WalletDB(JsonDB):
         self.spent_outpoints = self.get_dict('spent_outpoints')  # txid -> output_index -> next_txid
         self.history = self.get_dict('addr_history')             # address -> list of (txid, height)
         self.verified_tx = self.get_dict('verified_tx3')         # txid -> (height, timestamp, txpos, header_hash)
+        # sorted (height, txid) of verified_tx, so that reorgs only look at the txs above the fork
+        self._verified_tx_by_height = sorted((v[0], txid) for txid, v in self.verified_tx.items())  # type: List[Tuple[int, str]]
         self.tx_fees = self.get_dict('tx_fees')                  # type: Dict[str, TxFeesValue]
         # scripthash -> set of (outpoint, value)
         self._prevouts_by_scripthash = self.get_dict('prevouts_by_scripthash')  # type: Dict[str, Set[Tuple[str, int]]]
@@ -1299,6 +1378,7 @@ class WalletDB(JsonDB):
         self.transactions.clear()
         self.history.clear()
         self.verified_tx.clear()
+        self._verified_tx_by_height.clear()
         self.tx_fees.clear()
         self._prevouts_by_scripthash.clear()
 
@@ -1360,9 +1440,30 @@ class WalletDB(JsonDB):
             return
         if not self.modified():
             return
+        if self.is_journal_available() and storage.can_append():
+            journal_str = self.dump_journal()
+            if journal_str is None:
+                self.set_modified(False)
+                return
+            # compacting bounds both the file size and the time to replay it on load
+            if self._journal_size + len(journal_str) <= max(self._snapshot_size, MIN_JOURNAL_SIZE_FOR_COMPACTION):
+                try:
+                    storage.append(journal_str)
+                except Exception as e:
+                    # the changes are no longer in the journal, and the file might end
+                    # with part of them: only a full write can save them now
+                    self.logger.warning(f"could not append to wallet file, writing it whole: {e!r}")
+                    self.set_modified(True)
+                else:
+                    self._journal_size += len(journal_str) + 1
+                    self.set_modified(False)
+                    return
         json_str = self.dump(human_readable=not storage.is_encrypted())
         storage.write(json_str)
+        self._snapshot_size = len(json_str)
+        self._journal_size = 0
         self.set_modified(False)
+        self.reset_journal()
 
     def is_ready_to_be_used_by_wallet(self):
         return not self.requires_upgrade() and self._called_after_upgrade_tasks